@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from functools import partial
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+import incremental_features  # noqa: E402
+import storage  # noqa: E402
+from incremental_features import FeatureStage  # noqa: E402
+from rolling_features import (INPUT_COLUMNS, affected, affected_from, compute_features, feature_columns,  # noqa: E402
+                              needed)
+
+
+def get_args():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("FLIGHTS_CSV", help="Provide the CSV file (or Parquet directory) containing the flight "
+                                                "history")
+    arg_parser.add_argument("--window-hours", type=int, default=3,
+                            help="Length of the window of recent delays per airport, airline and route")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="Only compute the features which may depend on flights added, updated or removed "
+                                 "since the last run (e.g. by delay_history.py -m update)")
+    args = arg_parser.parse_args()
+    print(f"Program arguments: {args}")
+    return args
+
+
+def main():
+    args = get_args()
+    window = pd.Timedelta(hours=args.window_hours)
+    output_file = storage.with_suffix(args.FLIGHTS_CSV, "-congestion")
+    stage = FeatureStage(input_columns=INPUT_COLUMNS, columns=feature_columns(window),
+                         compute=partial(compute_features, window=window), affected_from=affected_from,
+                         affected=affected, needed=partial(needed, window=window))
+    start = time.time()
+    result = incremental_features.run(stage, args.FLIGHTS_CSV, output_file, {"window": window}, args.incremental)
+    print(result)
+    print(f"Wrote result to {output_file} ({time.time() - start:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from functools import partial
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+import incremental_features  # noqa: E402
+import storage  # noqa: E402
+from inbound_legs import (FEATURE_COLUMNS, INPUT_COLUMNS, affected, affected_from, compute_features,  # noqa: E402
+                          needed)
+from incremental_features import FeatureStage  # noqa: E402
+
+
+def get_args():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument("FLIGHTS_CSV", help="Provide the CSV file (or Parquet directory) containing the flight "
+                                                "history")
+    arg_parser.add_argument("--turnaround-hours", type=int, default=6,
+                            help="Longest scheduled time between the arrival of the inbound leg and the departure")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="Only compute the features which may depend on flights added, updated or removed "
+                                 "since the last run (e.g. by delay_history.py -m update)")
+    args = arg_parser.parse_args()
+    print(f"Program arguments: {args}")
+    return args
+
+
+def main():
+    args = get_args()
+    window = pd.Timedelta(hours=args.turnaround_hours)
+    output_file = storage.with_suffix(args.FLIGHTS_CSV, "-inbound")
+    stage = FeatureStage(input_columns=INPUT_COLUMNS, columns=FEATURE_COLUMNS,
+                         compute=partial(compute_features, window=window), affected_from=affected_from,
+                         affected=affected, needed=partial(needed, window=window))
+    start = time.time()
+    result = incremental_features.run(stage, args.FLIGHTS_CSV, output_file, {"window": window}, args.incremental)
+    print(result)
+    print(f"Wrote result to {output_file} ({time.time() - start:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
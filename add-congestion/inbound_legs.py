@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from rolling_features import delay_values, group_keys
+
+MINUTE = pd.Timedelta(minutes=1)
+# longest scheduled time between the arrival of an inbound leg and the departure it is matched with
+TURNAROUND_WINDOW = pd.Timedelta(hours=6)
+FEATURE_COLUMNS = ["inbound_flight_iata", "inbound_delay", "inbound_gap_min"]
+INPUT_COLUMNS = ["flight_iata", "airline_iata", "dep_iata", "arr_iata", "dep_time_utc", "arr_time_utc", "delayed"]
+
+
+def last_before(event_keys: pd.Series, event_times: pd.Series, query_keys: pd.Series, query_times: pd.Series,
+                window: pd.Timedelta):
+    """
+    Row of the latest event with the same key as the query and a time in [query time - window, query time) for
+    every query, -1 if there is none. Like window_stats of rolling_features.py, the events are sorted by (key, time)
+    once as one integer per event, and the queries are found with a binary search: O(n log n) in the number of
+    events and queries.
+    """
+    matches = np.full(len(query_keys), -1, dtype=np.int64)
+    codes, _ = pd.factorize(pd.concat([event_keys, query_keys], ignore_index=True))
+    event_codes, query_codes = codes[:len(event_keys)], codes[len(event_keys):]
+    event_seconds = event_times.to_numpy(dtype="datetime64[s]").astype(np.int64)
+    query_seconds = query_times.to_numpy(dtype="datetime64[s]").astype(np.int64)
+    events = np.flatnonzero((event_codes >= 0) & event_times.notnull().to_numpy())
+    queries = np.flatnonzero((query_codes >= 0) & query_times.notnull().to_numpy())
+    if len(events) == 0 or len(queries) == 0:
+        return matches
+
+    # (key, time) as one sortable integer: key * span + seconds since the earliest window start
+    window_seconds = int(window.total_seconds())
+    base = min(event_seconds[events].min(), query_seconds[queries].min()) - window_seconds
+    span = max(event_seconds[events].max(), query_seconds[queries].max()) - base + 1
+    positions = event_codes[events] * span + (event_seconds[events] - base)
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+
+    query_positions = query_codes[queries] * span + (query_seconds[queries] - base)
+    # the last event before the query, of the same key if it is not before the window start
+    latest = np.searchsorted(positions, query_positions, side="left") - 1
+    found = latest >= 0
+    found[found] = positions[latest[found]] >= query_positions[found] - window_seconds
+    matches[queries[found]] = events[order[latest[found]]]
+    return matches
+
+
+def compute_features(flights: pd.DataFrame, window: pd.Timedelta = TURNAROUND_WINDOW):
+    """
+    Returns the inbound leg of every departure as DataFrame with the same index: the latest flight of the same
+    airline scheduled to arrive at the departure airport within the window before the scheduled departure, its
+    flight number, its delay and the scheduled gap between its arrival and the departure in minutes.
+    The delay is the final delay of the inbound leg, which is only known before the departure if it arrived
+    earlier.
+    """
+    arrival_keys = group_keys(flights, ["airline_iata", "arr_iata"])
+    departure_keys = group_keys(flights, ["airline_iata", "dep_iata"])
+    matches = last_before(arrival_keys, flights["arr_time_utc"], departure_keys, flights["dep_time_utc"], window)
+    found = matches >= 0
+    inbound = matches[found]
+
+    flight_iata = np.full(len(flights), np.nan, dtype=object)
+    flight_iata[found] = flights["flight_iata"].to_numpy(dtype=object)[inbound]
+    delay = np.full(len(flights), np.nan)
+    delay[found] = delay_values(flights)[inbound]
+    gap = np.full(len(flights), np.nan)
+    gap[found] = ((flights["dep_time_utc"].to_numpy()[found] - flights["arr_time_utc"].to_numpy()[inbound])
+                  / MINUTE.to_timedelta64())
+    return pd.DataFrame({"inbound_flight_iata": flight_iata, "inbound_delay": delay, "inbound_gap_min": gap},
+                        index=flights.index)
+
+
+def affected_from(changed: pd.DataFrame):
+    """
+    Departure time from which the features may depend on the changed flights: they can only be the inbound leg
+    of flights departing after their arrival, which is after their own departure
+    """
+    return changed["dep_time_utc"].min()
+
+
+def affected(flights: pd.DataFrame, start: pd.Timestamp):
+    """
+    The flights whose inbound leg may be one of the flights departing from start on
+    """
+    return flights["dep_time_utc"] >= start
+
+
+def needed(flights: pd.DataFrame, first_departure: pd.Timestamp, window: pd.Timedelta = TURNAROUND_WINDOW):
+    """
+    The flights which can be the inbound legs of flights departing from first_departure on: flights scheduled to
+    arrive from the start of the earliest window on
+    """
+    return flights["arr_time_utc"] >= first_departure - window
@@ -0,0 +1,113 @@
+import os
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+import storage
+from delay_history import FLIGHT_KEY
+
+
+@dataclass
+class FeatureStage:
+    """
+    Features of flights which depend on other flights, e.g. on the flights of the same hour or of a window before
+    the departure, and can be updated incrementally:
+
+    * compute(flights[input_columns]) returns the feature `columns` as DataFrame with the index of the flights
+    * affected_from(changed) returns the departure time from which the features may depend on the changed
+      flights (new, updated or removed ones)
+    * affected(flights, start) is True for the flights whose features may change by flights changed from start on
+    * needed(flights, first_departure) is True for the flights which are needed to compute the features of the
+      flights departing from first_departure on, the earliest departure of the affected flights
+    """
+    input_columns: list
+    columns: list
+    compute: Callable
+    affected_from: Callable
+    affected: Callable
+    needed: Callable
+
+
+def state_file(output_file: str):
+    return f"{output_file.removesuffix('.gz').removesuffix('.csv').removesuffix('.parquet')}-state.pkl"
+
+
+def load_state(output_file: str, params: dict):
+    """
+    The state of the last run if it wrote output_file with the same parameters, else None
+    """
+    if not os.path.exists(output_file) or not os.path.isfile(state_file(output_file)):
+        return None
+    state = pd.read_pickle(state_file(output_file))
+    return state if isinstance(state, dict) and state.get("params") == params else None
+
+
+def save_state(output_file: str, params: dict):
+    pd.to_pickle({"params": params}, state_file(output_file))
+
+
+def run(stage: FeatureStage, flights_file: str, output_file: str, params: dict, incremental: bool):
+    """
+    Adds the features of the stage to the flights of flights_file and writes them to output_file. With
+    incremental, the flights are compared with the previous output_file and only the features which may depend
+    on new, updated or removed flights are computed again; the result is the same as of a full run.
+    Returns the written flights, or the previous output if no flight changed.
+    """
+    state = load_state(output_file, params) if incremental else None
+    flights = storage.read_flights(flights_file)
+    if state is None:
+        result = pd.concat([flights, stage.compute(flights[stage.input_columns])], axis=1)
+        storage.write_flights(result, output_file)
+    else:
+        result = update(stage, flights, output_file)
+    save_state(output_file, params)
+    return result
+
+
+def update(stage: FeatureStage, flights: pd.DataFrame, output_file: str):
+    existing = storage.read_flights(output_file)
+    new = ~_rows_in(flights[stage.input_columns], existing[stage.input_columns])
+    removed = ~_rows_in(existing[stage.input_columns], flights[stage.input_columns])
+    if not new.any() and not removed.any():
+        print(f"Incremental: no new, updated or removed flights, {output_file} is up to date")
+        return existing
+    changed = pd.concat([flights.loc[new, stage.input_columns], existing.loc[removed, stage.input_columns]])
+    start = stage.affected_from(changed)
+    recompute = np.asarray(stage.affected(flights, start))
+    first_departure = flights.loc[recompute, "dep_time_utc"].min()
+    timeline = flights.loc[recompute | np.asarray(stage.needed(flights, first_departure)), stage.input_columns]
+    print(f"Incremental: {new.sum()} new or updated and {removed.sum()} removed flights, computing the features of "
+          f"{recompute.sum()} flights from {start} on with {len(timeline) - recompute.sum()} flights as context")
+    # only removed flights may leave no flight to compute
+    computed = (stage.compute(timeline).loc[flights.index[recompute]] if recompute.any()
+                else pd.DataFrame(columns=stage.columns))
+
+    # the features of all other flights are unchanged, they are taken from the previous output by flight key
+    unaffected = existing[~np.asarray(stage.affected(existing, start))]
+    kept = unaffected.drop_duplicates(subset=FLIGHT_KEY).set_index(FLIGHT_KEY)[stage.columns]
+    kept = kept.reindex(pd.MultiIndex.from_frame(flights.loc[~recompute, FLIGHT_KEY]))
+    kept.index = flights.index[~recompute]
+    result = pd.concat([flights, pd.concat([kept, computed]).loc[flights.index]], axis=1)
+    if storage.is_partitioned(output_file):
+        # only the months from the first affected departure on are rewritten
+        month = pd.Timestamp(start).replace(day=1).normalize()
+        storage.write_flights(result[result["dep_time_utc"] >= month], output_file, overwrite_all=False)
+    else:
+        storage.write_flights(result, output_file)
+    return result
+
+
+def _rows_in(frame: pd.DataFrame, other: pd.DataFrame):
+    """
+    Whether every row of frame is also a row of other, compared by the hash of all columns
+    """
+    return np.isin(_row_hashes(frame), _row_hashes(other))
+
+
+def _row_hashes(frame: pd.DataFrame):
+    # CSV and Parquet files may be read with other time units and string dtypes
+    frame = frame.apply(lambda c: c.astype("datetime64[ns]") if pd.api.types.is_datetime64_any_dtype(c)
+                        else c.astype(object))
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from pandas.api.indexers import BaseIndexer
+
+HOUR = pd.Timedelta(hours=1)
+DELAY_WINDOW = pd.Timedelta(hours=3)
+# groups of flights whose recent delays are aggregated, by their key columns
+DELAY_GROUPS = {
+    "dep_airport": ["dep_iata"],
+    "arr_airport": ["arr_iata"],
+    "airline": ["airline_iata"],
+    "route": ["dep_iata", "arr_iata"],
+}
+INPUT_COLUMNS = ["flight_iata", "airline_iata", "dep_iata", "arr_iata", "dep_time_utc", "arr_time_utc",
+                 "arr_actual_utc", "delayed"]
+
+
+class _WindowBounds(BaseIndexer):
+    # precomputed [start, end) row ranges for pandas' rolling aggregations
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None, closed=None, step=None):
+        return self.start, self.end
+
+
+def feature_columns(window: pd.Timedelta = DELAY_WINDOW):
+    suffix = f"{int(window / HOUR)}h"
+    return (["dep_hour_departures", "arr_hour_arrivals"]
+            + [f"{group}_delay_{stat}_{suffix}" for group in DELAY_GROUPS for stat in ["count", "mean", "p90"]])
+
+
+def known_times(flights: pd.DataFrame):
+    """
+    Time from which the delay of a flight is known: its actual arrival, else the scheduled arrival plus the
+    delay, but never before its scheduled departure
+    """
+    delays = pd.to_timedelta(delay_values(flights), unit="min")
+    known = flights["arr_actual_utc"].fillna(flights["arr_time_utc"] + delays)
+    return known.mask(known < flights["dep_time_utc"], flights["dep_time_utc"])
+
+
+def delay_values(flights: pd.DataFrame):
+    # the nullable delays of the schema as floats with NaN
+    return pd.to_numeric(flights["delayed"]).astype(np.float64).to_numpy()
+
+
+def group_keys(flights: pd.DataFrame, columns: list):
+    keys = flights[columns[0]].astype(object)
+    for column in columns[1:]:
+        keys = keys + "-" + flights[column].astype(object)
+    return keys
+
+
+def window_stats(event_keys: pd.Series, event_times: pd.Series, event_values: np.ndarray,
+                 query_keys: pd.Series, query_times: pd.Series, window: pd.Timedelta):
+    """
+    Count, mean and 90th percentile of the values of the events with the same key as the query and a time in
+    [query time - window, query time). Events are sorted by (key, time) once; the window of every query is a
+    range of the sorted events found with a binary search, counts and means come from cumulative sums and the
+    percentile from pandas' sliding-window quantile over the ranges.
+    """
+    n_queries = len(query_keys)
+    count = np.zeros(n_queries, dtype=np.int64)
+    mean = np.full(n_queries, np.nan)
+    p90 = np.full(n_queries, np.nan)
+    codes, _ = pd.factorize(pd.concat([event_keys, query_keys], ignore_index=True))
+    event_codes, query_codes = codes[:len(event_keys)], codes[len(event_keys):]
+    event_seconds = event_times.to_numpy(dtype="datetime64[s]").astype(np.int64)
+    query_seconds = query_times.to_numpy(dtype="datetime64[s]").astype(np.int64)
+    events = (event_codes >= 0) & event_times.notnull().to_numpy() & ~np.isnan(event_values)
+    queries = np.flatnonzero((query_codes >= 0) & query_times.notnull().to_numpy())
+    if not events.any() or len(queries) == 0:
+        return count, mean, p90
+
+    # (key, time) as one sortable integer: key * span + seconds since the earliest window start
+    window_seconds = int(window.total_seconds())
+    base = min(event_seconds[events].min(), query_seconds[queries].min()) - window_seconds
+    span = max(event_seconds[events].max(), query_seconds[queries].max()) - base + 1
+    positions = event_codes[events] * span + (event_seconds[events] - base)
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+    values = event_values[events][order]
+
+    query_positions = query_codes[queries] * span + (query_seconds[queries] - base)
+    query_order = np.argsort(query_positions, kind="stable")
+    query_positions = query_positions[query_order]
+    start = np.searchsorted(positions, query_positions - window_seconds, side="left")
+    end = np.searchsorted(positions, query_positions, side="left")
+
+    sums = np.concatenate([[0.0], np.cumsum(values)])
+    n = end - start
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(n > 0, (sums[end] - sums[start]) / n, np.nan)
+    # the windows of the sorted queries move forward, so the quantile slides over the events
+    length = max(len(values), len(start))
+    padded = pd.Series(np.concatenate([values, np.full(length - len(values), np.nan)]))
+    bounds = _WindowBounds(start=_pad(start, length), end=_pad(end, length))
+    quantiles = padded.rolling(bounds, min_periods=1).quantile(0.9).to_numpy()[:len(start)]
+
+    target = queries[query_order]
+    count[target] = n
+    mean[target] = means
+    p90[target] = quantiles
+    return count, mean, p90
+
+
+def _pad(bounds: np.ndarray, length: int):
+    return np.concatenate([bounds, np.full(length - len(bounds), bounds[-1])]).astype(np.int64)
+
+
+def compute_features(flights: pd.DataFrame, window: pd.Timedelta = DELAY_WINDOW):
+    """
+    Returns the rolling features of the flights as DataFrame with the same index. Every flight only sees the
+    delays of flights that were known before its scheduled departure, and the schedule (which is published in
+    advance) for the number of departures at its departure airport in its departure hour and of arrivals at its
+    arrival airport in its arrival hour.
+    """
+    columns = feature_columns(window)
+    features = {}
+    dep_hours = flights["dep_time_utc"].dt.floor("h")
+    arr_hours = flights["arr_time_utc"].dt.floor("h")
+    features[columns[0]] = flights.groupby([flights["dep_iata"], dep_hours], observed=True, dropna=False)[
+        "dep_iata"].transform("size").to_numpy()
+    features[columns[1]] = flights.groupby([flights["arr_iata"], arr_hours], observed=True, dropna=False)[
+        "arr_iata"].transform("size").to_numpy()
+
+    known = known_times(flights)
+    delays = delay_values(flights)
+    for i, (group, key_columns) in enumerate(DELAY_GROUPS.items()):
+        keys = group_keys(flights, key_columns)
+        stats = window_stats(keys, known, delays, keys, flights["dep_time_utc"], window)
+        for column, values in zip(columns[2 + 3 * i:5 + 3 * i], stats):
+            features[column] = values
+    return pd.DataFrame(features, index=flights.index)
+
+
+def affected_from(changed: pd.DataFrame):
+    """
+    Hour from which the features may depend on the changed flights: the hours of their departures and arrivals,
+    as their delays are only known after their departure
+    """
+    return pd.concat([changed["dep_time_utc"], changed["arr_time_utc"]]).min().floor("h")
+
+
+def affected(flights: pd.DataFrame, start: pd.Timestamp):
+    """
+    The flights whose features may depend on flights departing or arriving from start on: flights departing
+    from then on, and flights arriving in an hour counted from then on
+    """
+    latest = np.maximum(flights["dep_time_utc"].dt.floor("h"),
+                        flights["arr_time_utc"].dt.floor("h").fillna(flights["dep_time_utc"]))
+    return latest >= start
+
+
+def needed(flights: pd.DataFrame, first_departure: pd.Timestamp, window: pd.Timedelta = DELAY_WINDOW):
+    """
+    The flights which are needed to compute the features of flights departing from first_departure on: flights
+    whose delay becomes known or which depart or arrive from the start of the earliest window on
+    """
+    latest = np.maximum(np.maximum(flights["dep_time_utc"], flights["arr_time_utc"]),
+                        known_times(flights).fillna(flights["dep_time_utc"]))
+    return latest >= first_departure.floor("h") - window
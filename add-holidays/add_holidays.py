@@ -1,81 +1,99 @@
+import os
+import sys
 from argparse import ArgumentParser
 
-import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+import storage  # noqa: E402
+from airport_index import AIRPORTS_JSON, AirportIndex  # noqa: E402
+from holiday_calendar import add_holiday_features, holiday_years  # noqa: E402
+from metrics import Metrics, add_metrics_arguments, path_size  # noqa: E402
 
-# information from: https://www.timeanddate.com/holidays/vietnam/2023
-VN_HOLIDAYS = {
-    "2022-10-20": "Vietnamese Women's Day",
-    "2022-10-31": "Halloween",
-    "2022-12-22": "Solstice",
-    "2022-12-24": "Christmas Eve",
-    "2022-12-25": "Christmas Day",
-    "2022-12-31": "International New Year's Eve",
-    "2023-01-01": "International New Year's Day",
-    "2023-01-02": "Day off for International New Year's Day",
-    "2023-01-20": "Lunar New Year",
-    "2023-01-21": "Lunar New Year",
-    "2023-01-22": "Lunar New Year",
-    "2023-01-23": "Lunar New Year",
-    "2023-01-24": "Lunar New Year",
-    "2023-01-25": "Lunar New Year",
-    "2023-01-26": "Lunar New Year",
-    "2023-02-14": "Valentine's Day",
-    "2023-03-21": "March Equinox",
-    "2023-04-09": "Easter Sunday",
-    "2023-04-29": "Hung Kings Festival",
-    "2023-04-30": "Liberation/Reunification Day",
-    "2023-05-01": "Labor Day",
-    "2023-05-02": "Day off Hung Kings Festival",
-    "2023-05-03": "Day off Liberation/Reunification Day",
-    "2023-05-05": "Vesak",
-    "2023-06-21": "June Solstice",
-    "2023-06-28": "Vietnamese Family Day",
-    "2023-09-01": "Independence Day Holiday",
-    "2023-09-02": "Independence Day",
-    "2023-09-03": "Independence Day Holiday",
-    "2023-09-04": "Independence Day observed",
-    "2023-09-23": "Equinox",
-    "2023-10-20": "Vietnamese Women's Day",
-    "2023-10-31": "Halloween",
-    "2023-12-22": "Solstice",
-    "2023-12-24": "Christmas Eve",
-    "2023-12-25": "Christmas Day",
-    "2023-12-31": "International New Year's Eve"
-}
 
-
-def get_input_file():
+def get_args():
     arg_parser = ArgumentParser()
-    arg_parser.add_argument("FLIGHTS_CSV", help="Provide the CSV file containing the flight history")
+    arg_parser.add_argument("FLIGHTS_CSV", help="Provide the CSV file (or Parquet directory) containing the flight "
+                                                "history")
+    storage.add_filter_arguments(arg_parser)
+    storage.add_chunk_argument(arg_parser)
+    add_metrics_arguments(arg_parser)
     args = arg_parser.parse_args()
     print(f"Program arguments: {args}")
-    return args.FLIGHTS_CSV
+    return args
+
+
+def add_holidays(flights, airport_index, years: dict = None, calendars: dict = None):
+    """
+    :param years: years of the calendars per time column, by default the years of the flights
+    :param calendars: cache of the loaded calendars per time column, for the chunks of the same flights
+    """
+    years = years or {}
+    calendars = calendars if calendars is not None else {}
+    # holidays by the calendar of the airport's country in its local date, 'holiday' is the one of the arrival
+    flights = add_holiday_features(flights, "arr_time_utc", "arr_iata", airport_index, "arr", name_column="holiday",
+                                   years=years.get("arr_time_utc"), calendars=calendars.setdefault("arr_time_utc", {}))
+    return add_holiday_features(flights, "dep_time_utc", "dep_iata", airport_index, "dep",
+                                years=years.get("dep_time_utc"), calendars=calendars.setdefault("dep_time_utc", {}))
+
 
+def calendar_years(path: str, chunk_size: int, filters: dict):
+    """
+    Years of the calendars per time column for all flights of the file, so that every chunk is mapped with the
+    calendars of the in-memory run. Only the time columns are read.
+    """
+    bounds = {}
+    for chunk in storage.iter_flights(path, chunk_size, columns=["arr_time_utc", "dep_time_utc"], **filters):
+        for column in chunk.columns:
+            times = chunk[column].dropna()
+            if len(times):
+                low, high = bounds.get(column, (times.min(), times.max()))
+                bounds[column] = (min(low, times.min()), max(high, times.max()))
+    return {column: holiday_years(*bound) for column, bound in bounds.items()}
 
-def load_flights():
-    input_file = get_input_file()
-    flights = pd.read_csv(input_file)
-    for col in ["dep_time_utc", "dep_actual_utc", "arr_time_utc", "arr_actual_utc"]:
-        flights[col] = pd.to_datetime(flights[col])
-    return flights
 
+def stream_holidays(args, metrics: Metrics, output_file: str):
+    """
+    Maps the holidays chunk by chunk and appends every chunk to the output file
+    """
+    filters = storage.filters_from_args(args)
+    airport_index = AirportIndex.load(AIRPORTS_JSON)
+    with metrics.stage("calendar_years", bytes_read=path_size(args.FLIGHTS_CSV)):
+        years = calendar_years(args.FLIGHTS_CSV, args.chunk_size, filters)
+    calendars = {}
+    with metrics.stage("stream", bytes_read=path_size(args.FLIGHTS_CSV)) as stage:
+        def chunks():
+            for chunk in storage.iter_flights(args.FLIGHTS_CSV, args.chunk_size, **filters):
+                stage.rows_in = (stage.rows_in or 0) + len(chunk)
+                yield add_holidays(chunk, airport_index, years, calendars)
+                print(f"Mapped holidays of {stage.rows_in} flights")
 
-def get_holiday(time_dt):
-    date = time_dt.strftime("%Y-%m-%d")
-    if date in VN_HOLIDAYS:
-        return VN_HOLIDAYS[date]
-    return None
+        stage.rows_out = storage.write_flight_chunks(chunks(), output_file)
+        stage.bytes_written = path_size(output_file)
 
 
 def main():
-    flights = load_flights()
-    flights['holiday'] = flights['arr_time_utc'].map(get_holiday)
-    flights.info()
-    print(flights.head())
-    output_file = get_input_file()
-    output_file = output_file.replace(".csv", "-holidays.csv")
-    flights.to_csv(output_file, header=True, index=False)
-    print(f"Wrote result to {output_file}")
+    args = get_args()
+    metrics = Metrics.from_args("add_holidays", args)
+    success = False
+    try:
+        output_file = storage.with_suffix(args.FLIGHTS_CSV, "-holidays")
+        if args.chunk_size:
+            stream_holidays(args, metrics, output_file)
+        else:
+            with metrics.stage("read", bytes_read=path_size(args.FLIGHTS_CSV)) as stage:
+                flights = storage.read_flights(args.FLIGHTS_CSV, **storage.filters_from_args(args))
+                stage.rows_out = len(flights)
+            with metrics.stage("holidays", rows_in=len(flights)) as stage:
+                flights = add_holidays(flights, AirportIndex.load(AIRPORTS_JSON))
+                stage.rows_out = len(flights)
+            flights.info()
+            print(flights.head())
+            with metrics.stage("write", rows_in=len(flights)) as stage:
+                storage.write_flights(flights, output_file)
+                stage.bytes_written = path_size(output_file)
+        print(f"Wrote result to {output_file}")
+        success = True
+    finally:
+        metrics.write(success)
 
 
 if __name__ == '__main__':
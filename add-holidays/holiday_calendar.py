@@ -0,0 +1,201 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from config import config
+
+# <country code>.csv files with "date" and "name" columns,
+# e.g. VN.csv with information from: https://www.timeanddate.com/holidays/vietnam/2023
+HOLIDAYS_DIR = f"{config.data_dir}/holidays"
+
+# holidays on the same date every year, as (month, day): name
+FIXED_HOLIDAYS = {
+    "VN": {
+        (1, 1): "International New Year's Day",
+        (2, 14): "Valentine's Day",
+        (4, 30): "Liberation/Reunification Day",
+        (5, 1): "Labor Day",
+        (6, 28): "Vietnamese Family Day",
+        (9, 2): "Independence Day",
+        (10, 20): "Vietnamese Women's Day",
+        (10, 31): "Halloween",
+        (12, 24): "Christmas Eve",
+        (12, 25): "Christmas Day",
+        (12, 31): "International New Year's Eve",
+    },
+}
+
+
+def csv_holidays(country: str, years):
+    csv_file = os.path.join(HOLIDAYS_DIR, f"{country}.csv")
+    if not os.path.isfile(csv_file):
+        return None
+    holidays = pd.read_csv(csv_file, parse_dates=["date"])
+    return holidays[holidays["date"].dt.year.isin(years)]
+
+
+def fixed_date_holidays(country: str, years):
+    if country not in FIXED_HOLIDAYS:
+        return None
+    rows = [(pd.Timestamp(year=year, month=month, day=day), name)
+            for year in years for (month, day), name in FIXED_HOLIDAYS[country].items()]
+    return pd.DataFrame(rows, columns=["date", "name"])
+
+
+def package_holidays(country: str, years):
+    """
+    Public holidays of the `holidays` package (pip install holidays). Without the package, a warning names the
+    years which are not covered by the CSV file of the country.
+    """
+    try:
+        import holidays
+    except ImportError:
+        _warn_missing_package(country, years)
+        return None
+    try:
+        country_holidays = holidays.country_holidays(country, years=list(years))
+    except (NotImplementedError, KeyError):
+        return None
+    return pd.DataFrame({"date": pd.to_datetime(list(country_holidays.keys())),
+                         "name": list(country_holidays.values())})
+
+
+def _warn_missing_package(country: str, years):
+    from_csv = csv_holidays(country, years)
+    covered = set() if from_csv is None else set(from_csv["date"].dt.year)
+    missing = tuple(sorted(set(years) - covered))
+    if missing and (country, missing) not in _WARNED:
+        _WARNED.add((country, missing))
+        print(f"WARNING: the holidays package is not installed (pip install holidays), the holidays of {country} in "
+              f"{', '.join(map(str, missing))} are incomplete: moving holidays like Lunar New Year or Easter are "
+              f"missing and flights on them get no holiday features")
+
+
+# (country, years) which were warned about, every calendar is only warned about once
+_WARNED = set()
+
+# Sources of holidays in order of priority: if several sources have a holiday on the same date, the name of the
+# first one is used. Additional sources can be appended, they are called with a country code and a list of years.
+CALENDAR_PROVIDERS = [csv_holidays, fixed_date_holidays, package_holidays]
+
+
+@dataclass
+class HolidayCalendar:
+    """
+    Sorted holiday dates of one country as days since epoch, with their name and the length of the holiday
+    period (run of consecutive holidays) they belong to
+    """
+    days: np.ndarray
+    names: np.ndarray
+    period_lengths: np.ndarray
+
+    @staticmethod
+    def load(country: str, years):
+        frames = [f for f in (provider(country, years) for provider in CALENDAR_PROVIDERS) if f is not None]
+        if not frames:
+            return None
+        holidays = pd.concat(frames, ignore_index=True)
+        holidays = holidays.drop_duplicates(subset="date", keep="first").sort_values(by="date")
+        if holidays.empty:
+            return None
+        days = holidays["date"].to_numpy().astype("datetime64[D]").astype(np.int64)
+
+        # number the runs of consecutive days and count their lengths
+        period_ids = np.cumsum(np.diff(days, prepend=days[0] - 2) > 1)
+        period_lengths = np.bincount(period_ids)[period_ids]
+        return HolidayCalendar(days=days, names=holidays["name"].to_numpy(dtype=object),
+                               period_lengths=period_lengths)
+
+    def features(self, days: np.ndarray):
+        """
+        Looks up days (days since epoch) with a binary search in the sorted holiday dates. Returns the index of
+        the holiday into `names` (or -1), days to the next holiday, days since the last holiday and whether the
+        day lies in a holiday period of at least two days. Days without a next/last holiday in the calendar get -1.
+        """
+        next_idx = np.searchsorted(self.days, days, side="left")
+        has_next = next_idx < len(self.days)
+        next_idx = np.minimum(next_idx, len(self.days) - 1)
+        last_idx = np.searchsorted(self.days, days, side="right") - 1
+        has_last = last_idx >= 0
+        last_idx = np.maximum(last_idx, 0)
+
+        is_holiday = has_next & (self.days[next_idx] == days)
+        holiday_idx = np.where(is_holiday, next_idx, -1)
+        days_to = np.where(has_next, self.days[next_idx] - days, -1)
+        days_since = np.where(has_last, days - self.days[last_idx], -1)
+        in_period = is_holiday & (self.period_lengths[next_idx] >= 2)
+        return holiday_idx, days_to, days_since, in_period
+
+
+def local_days(times_utc: pd.Series, timezones: pd.Categorical):
+    """
+    Converts UTC times to local calendar days (days since epoch) with one vectorized conversion per time zone.
+    Times at airports with unknown time zone stay in UTC.
+    """
+    local = times_utc.to_numpy(dtype="datetime64[ns]").copy()
+    codes = np.asarray(timezones.codes)
+    for code in np.unique(codes[codes >= 0]):
+        mask = codes == code
+        converted = times_utc[mask].dt.tz_localize("UTC").dt.tz_convert(timezones.categories[code])
+        local[mask] = converted.dt.tz_localize(None).to_numpy(dtype="datetime64[ns]")
+    return local.astype("datetime64[D]").astype(np.int64)
+
+
+def holiday_years(time_min: pd.Timestamp, time_max: pd.Timestamp):
+    """
+    Years of the calendars for times between time_min and time_max: a year more on both sides, so that the next
+    and the last holiday are found
+    """
+    return range(time_min.year - 1, time_max.year + 2)
+
+
+def add_holiday_features(flights: pd.DataFrame, time_column: str, iata_column: str, airport_index, prefix: str,
+                         name_column: str = None, years=None, calendars: dict = None):
+    """
+    Adds the holiday of the airport-local date of `time_column` and the columns <prefix>_days_to_holiday,
+    <prefix>_days_since_holiday and <prefix>_holiday_period. The holiday calendar is chosen by the country of
+    the airport in `iata_column`.
+
+    :param years: years of the calendars, by default the years of the times and one year before and after
+    :param calendars: cache of the loaded calendars per country, only valid for the same `years`
+    """
+    n = len(flights)
+    name_codes = np.full(n, -1, dtype=np.int32)
+    name_categories = {}
+    days_to = np.full(n, -1, dtype=np.int32)
+    days_since = np.full(n, -1, dtype=np.int32)
+    in_period = np.zeros(n, dtype=bool)
+
+    times = flights[time_column]
+    valid = times.notnull().to_numpy()
+    positions = airport_index.positions(flights[iata_column])
+    days = local_days(times, airport_index.timezone(positions))
+    countries = airport_index.country_code(positions)
+    if valid.any():
+        if years is None:
+            years = holiday_years(times.min(), times.max())
+        if calendars is None:
+            calendars = {}
+        country_codes = np.asarray(countries.codes)
+        for code in np.unique(country_codes[valid & (country_codes >= 0)]):
+            country = countries.categories[code]
+            if country not in calendars:
+                calendars[country] = HolidayCalendar.load(country, years)
+            calendar = calendars[country]
+            if calendar is None:
+                continue
+            mask = valid & (country_codes == code)
+            holiday_idx, days_to[mask], days_since[mask], in_period[mask] = calendar.features(days[mask])
+            # holiday names are stored as categorical codes of the names of all calendars
+            calendar_codes = np.array([name_categories.setdefault(name, len(name_categories))
+                                       for name in calendar.names], dtype=np.int32)
+            name_codes[mask] = np.where(holiday_idx >= 0, calendar_codes[holiday_idx], -1)
+
+    names = pd.Categorical.from_codes(name_codes, categories=list(name_categories))
+    flights[name_column or f"{prefix}_holiday"] = names
+    flights[f"{prefix}_days_to_holiday"] = days_to
+    flights[f"{prefix}_days_since_holiday"] = days_since
+    flights[f"{prefix}_holiday_period"] = in_period
+    return flights
@@ -1,10 +1,17 @@
 #!/usr/bin/python3
+import os
+import sys
 import time
 
 import pandas as pd
 
 from argparse import ArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+import storage  # noqa: E402
+from metrics import Metrics, add_metrics_arguments, path_size  # noqa: E402
+from weather_store import WeatherStore, add_weather  # noqa: E402
+
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', None)
 pd.set_option('display.max_rows', 20)
@@ -12,47 +19,64 @@ pd.set_option('display.max_rows', 20)
 parser = ArgumentParser(prog='add-weather-from-existing', description='Merges informations from @weather_csv with @flights_csv data and write it to @output_csv.',
                         epilog='Example usage: $> ./add-weather-from-existing.py data/weather.csv.gz data/flightHistory.csv data/o.csv')
 parser.add_argument("weather", help="CSV file of weather reports.", metavar='weather_csv')
-parser.add_argument("flights", help='A CSV file of flight delays.', metavar='flights_csv')
-parser.add_argument("output", help='Output CSV file.', metavar='output_csv')
+parser.add_argument("flights", help='A CSV file (or Parquet directory) of flight delays.', metavar='flights_csv')
+parser.add_argument("output", help='Output CSV file (or Parquet directory).', metavar='output_csv')
+parser.add_argument("--interpolation", choices=["round", "nearest", "linear"], default="round",
+                    help="How flight times are matched to the hourly weather: round to the hour (like dt.round), "
+                         "nearest hour or linear interpolation between the surrounding hours.")
+storage.add_filter_arguments(parser)
+storage.add_chunk_argument(parser)
+add_metrics_arguments(parser)
 args = parser.parse_args()
+metrics = Metrics.from_args("add_weather", args)
+success = False
+
+
+def stream_weather(weather: WeatherStore):
+    """
+    Joins the weather chunk by chunk and appends every chunk to the output, only the weather store is shared
+    """
+    with metrics.stage("stream", bytes_read=path_size(args.flights)) as stage:
+        def chunks():
+            for chunk in storage.iter_flights(args.flights, args.chunk_size, **storage.filters_from_args(args)):
+                stage.rows_in = (stage.rows_in or 0) + len(chunk)
+                yield add_weather(chunk, weather, args.interpolation)
+                print(f"Appended weather to {stage.rows_in} flights")
+
+        stage.rows_out = storage.write_flight_chunks(chunks(), args.output)
+        stage.bytes_written = path_size(args.output)
+
+
+try:
+    print("Opening @weather store")
+    with metrics.stage("weather_store", bytes_read=path_size(args.weather)):
+        weather = WeatherStore.open(args.weather)
+    print(">Done")
+
+    if args.chunk_size:
+        print(f"Streaming @flights in chunks of {args.chunk_size} to {args.output}")
+        stream_weather(weather)
+        print(">Done")
+    else:
+        print("Reading @flights data frame")
+        with metrics.stage("read", bytes_read=path_size(args.flights)) as stage:
+            flights = storage.read_flights(args.flights, **storage.filters_from_args(args))
+            stage.rows_out = len(flights)
+        print(">Done")
+
+        print("Append weather info to arrival and departure flights")
+        start = time.time()
+        with metrics.stage("weather", rows_in=len(flights)) as stage:
+            flights = add_weather(flights, weather, args.interpolation)
+            stage.rows_out = len(flights)
+        print(flights)
+        print(f">Done ({time.time() - start}s)")
 
-print("Reading @flights data frame")
-flights = pd.read_csv(args.flights, header=0, parse_dates=["arr_time_utc", "dep_time_utc"])
-print(">Done")
-
-print("Reading @weather data frame")
-weather = pd.read_csv(args.weather, header=0, parse_dates=True, index_col=["date", "iata"],
-                      date_format="%Y-%m-%d %H:%M:%S.%f")
-print(">Done")
-
-print("Renaming arrival/departure weather columns")
-arrival_weather = weather.add_prefix("arr_")
-departure_weather = weather.add_prefix("dep_")
-print(">Done")
-# release memory:
-del weather
-
-print("Adding columns with hour-rounded time")
-flights["arr_hour"] = flights["arr_time_utc"].dt.round("H")
-flights["dep_hour"] = flights["dep_time_utc"].dt.round("H")
-
-print("Append weather info to arrival flights")
-start = time.time()
-flights = pd.merge(flights, arrival_weather, left_on=["arr_hour", "arr_iata"], right_index=True, how="left")
-print(flights)
-print(f">Done ({time.time() - start}s)")
-
-print("Append weather info to departure flights")
-start = time.time()
-flights = pd.merge(flights, departure_weather, left_on=["dep_hour", "dep_iata"], right_index=True, how="left")
-print(flights)
-print(f">Done ({time.time() - start}s)")
-
-print("Drop intermediate columns")
-start = time.time()
-flights.drop(columns=["arr_hour", "dep_hour"], inplace=True)
-print(f">Done ({time.time() - start}s)")
-
-print(f"Write data to {args.output}")
-flights.to_csv(args.output, index=False)
-print(">Done")
+        print(f"Write data to {args.output}")
+        with metrics.stage("write", rows_in=len(flights)) as stage:
+            storage.write_flights(flights, args.output)
+            stage.bytes_written = path_size(args.output)
+        print(">Done")
+    success = True
+finally:
+    metrics.write(success)
@@ -2,38 +2,58 @@
 # WARNING: Not yet tested once
 # Note: You must install these packages:
 # pip install openmeteo-requests
-# pip install requests-cache retry-requests numpy pandas pandasql sqlalchemy==1.4.46
-# Get CSV with iata locations:
+# pip install requests-cache retry-requests numpy pandas
+# Airport locations are taken from data/airports.json, alternatively get CSV with iata locations:
 # git clone https://github.com/ip2location/ip2location-iata-icao.git
 #
 # Or, if you like to live by the mountain cliff and don't use venv:
 # sudo pip install openmeteo-requests --break-system-packages
-# sudo pip install requests-cache retry-requests numpy pandas pandasql --break-system-packages
-# sudo pip install sqlalchemy==1.4.46 --break-system-package
-# 
-# WARNING: SQLAlchemy 2.* has some problems parsing even simple query, so downgrade it to 1.4.46 is necessary
+# sudo pip install requests-cache retry-requests numpy pandas --break-system-packages
 
 import datetime
+import os
+import sys
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import openmeteo_requests
 import pandas as pd
 import requests_cache
-from pandasql import sqldf  # Because working with sql is way simpler
 from retry_requests import retry
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+from airport_index import AIRPORTS_JSON, AirportIndex  # noqa: E402
+from grid_matcher import assign_hourly  # noqa: E402
+from metrics import Metrics, add_metrics_arguments, path_size  # noqa: E402
+from weather_planner import QuotaLedger, existing_days, missing_ranges, plan_chunks, request_weight  # noqa: E402
+
 OUTFILE = f"../data/weather.csv.gz"
+QUOTA_FILE = "../data/weather-quota.json"
 AFFECTED_AIRPORTS_CSV = "../data/affected-airports.csv"
+# format of the 'date' column in the weather CSV
+WEATHER_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# results of a chunk
+WRITTEN, NO_QUOTA, FAILED = "written", "no quota", "failed"
 
 parser = ArgumentParser(prog='get-weather', description='Write weather information to CSV file',
                         epilog='Example usage: $> ./add-weather.py 2023-12-01 2023-12-02')
-parser.add_argument("--airports", help="CSV file listing airports' IATA/ICAO and latlong.",
-                    metavar='airports_csv', default="ip2location-iata-icao/iata-icao.csv")
+parser.add_argument("--airports", help="airports.json or ip2location CSV file listing airports' IATA and latlong.",
+                    metavar='airports_file', default=AIRPORTS_JSON)
+parser.add_argument("--max-weight", type=float, default=50,
+                    help="Maximum weight of a single request (Open-Meteo counts requests with more than 10 variables "
+                         "or 2 weeks per location as several)")
+parser.add_argument("--daily-limit", type=float, default=10000, help="Request weight allowed per day")
+parser.add_argument("--workers", type=int, default=4, help="Number of concurrent requests")
+parser.add_argument("--url", default="https://archive-api.open-meteo.com/v1/archive",
+                    help="Archive API endpoint, e.g. a local stand-in for testing")
 parser.add_argument("FROM", help="Start date (yyyy-mm-dd)")
 parser.add_argument("TO", help="End date (yyyy-mm-dd)")
+add_metrics_arguments(parser)
 args = parser.parse_args()
-
-print("Querying API request dates")
+metrics = Metrics.from_args("get_weather", args)
 
 start_date = args.FROM
 end_date = args.TO
@@ -41,20 +61,49 @@ end_date = args.TO
 print(f"start_date: {start_date}")
 print(f"end_date: {end_date}")
 
-# Concat the result of two queries with python because SQLite doesn't have OUTER JOIN
 unique_iatas = pd.read_csv(AFFECTED_AIRPORTS_CSV)
 print(f"unique_iatas: {unique_iatas}")
 
-airport_locations = pd.read_csv(args.airports, header=0, usecols=["iata", "latitude", "longitude"])
-coordinates = sqldf('''SELECT a.iata, a.latitude, a.longitude 
-	FROM unique_iatas AS u INNER JOIN airport_locations AS a 
-	ON u.iata == a.iata''')
+# Look up the coordinates in the cached airport index
+airport_index = AirportIndex.load(args.airports)
+positions = airport_index.positions(unique_iatas["iata"])
+found = positions >= 0
+coordinates = pd.DataFrame({"iata": unique_iatas["iata"][found].to_numpy(),
+                            "latitude": airport_index.latitude(positions[found]),
+                            "longitude": airport_index.longitude(positions[found])})
 print(coordinates)
-missing_iata = sqldf("SELECT iata FROM unique_iatas where iata not in (SELECT iata from airport_locations)")
+missing_iata = unique_iatas[~found]
 print(f"[WARNING] Airports with no location:\n{missing_iata}")
 
-latitudes = coordinates['latitude'].values.tolist()
-longitudes = coordinates['longitude'].values.tolist()
+HOURLY_VARIABLES = [
+    "temperature_2m",
+    "relative_humidity_2m",
+    "precipitation",
+    "rain",
+    "snowfall",
+    "weather_code",
+    "cloud_cover",
+    "cloud_cover_low",
+    "cloud_cover_mid",
+    "cloud_cover_high",
+    "wind_speed_10m",
+    "wind_speed_100m",
+    "wind_gusts_10m"
+]
+
+print(f"Planning requests for days without weather in {OUTFILE}")
+date_format = "%Y-%m-%d"
+with metrics.stage("plan", bytes_read=path_size(OUTFILE)) as plan_stage:
+    existing = existing_days(OUTFILE)
+    ranges = missing_ranges(coordinates["iata"], datetime.datetime.strptime(start_date, date_format).date(),
+                            datetime.datetime.strptime(end_date, date_format).date(), existing)
+    chunks = plan_chunks(ranges, len(HOURLY_VARIABLES), args.max_weight)
+    plan_stage.rows_out = len(chunks)
+total_weight = sum(request_weight(len(c.iatas), c.n_days, len(HOURLY_VARIABLES)) for c in chunks)
+ledger = QuotaLedger(QUOTA_FILE, args.daily_limit)
+print(f"{len(chunks)} requests with a total weight of {total_weight:.1f}, "
+      f"{args.daily_limit - ledger.used:.1f} of {args.daily_limit} left for today")
+print(">Done")
 
 ## FROM HERE ON IS CODE GENERATED BY OPEN-METEO
 ## TWEAKED A LITTLE
@@ -63,103 +112,104 @@ longitudes = coordinates['longitude'].values.tolist()
 cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
 retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
 openmeteo = openmeteo_requests.Client(session=retry_session)
-
-# Make sure all required weather variables are listed here
-# The order of variables in hourly or daily is important to assign them correctly below
-url = "https://archive-api.open-meteo.com/v1/archive"
-# The list of weather parameters we're interested in
-params = {
-    "latitude": latitudes,
-    "longitude": longitudes,
-    "start_date": start_date,
-    "end_date": end_date,
-    "hourly": [
-        "temperature_2m",
-        "relative_humidity_2m",
-        "precipitation",
-        "rain",
-        "snowfall",
-        "weather_code",
-        "cloud_cover",
-        "cloud_cover_low",
-        "cloud_cover_mid",
-        "cloud_cover_high",
-        "wind_speed_10m",
-        "wind_speed_100m",
-        "wind_gusts_10m"
-    ],
-}
-
-date_format = "%Y-%m-%d"
-date_diff = datetime.datetime.strptime(end_date, date_format) - datetime.datetime.strptime(start_date, date_format)
-approx_weight = {len(latitudes) * len(params['hourly']) / 14 * date_diff.days * 0.1}
-print(
-    f"Requesting open-meteo API. Approx query weight: {approx_weight}. That's {approx_weight}/10000 request limit per day.")
-# TODO: Figure out how to query a lot, but not too much, at once
-# WARNING: You are going to overshoot your limit of 10000 requests/day with just 1 request this big 
-responses = openmeteo.weather_api(url, params=params)
-print(">Done")
-
-print("Merging all airport weather reports together")
-all_weathers_dfs = []
-for weather_at_each_airport in responses:
-    response = weather_at_each_airport
-    # print(f"Coordinates {response.Latitude()}°E {response.Longitude()}°N")
-    # print(f"Elevation {response.Elevation()} m asl")
-    # print(f"Timezone {response.Timezone()} {response.TimezoneAbbreviation()}")
-    # print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")
-
-    # Process hourly data. The order of variables needs to be the same as requested.
-    hourly = response.Hourly()
-    hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
-    hourly_relative_humidity_2m = hourly.Variables(1).ValuesAsNumpy()
-    hourly_precipitation = hourly.Variables(2).ValuesAsNumpy()
-    hourly_rain = hourly.Variables(3).ValuesAsNumpy()
-    hourly_snowfall = hourly.Variables(4).ValuesAsNumpy()
-    hourly_weather_code = hourly.Variables(5).ValuesAsNumpy()
-    hourly_cloud_cover = hourly.Variables(6).ValuesAsNumpy()
-    hourly_cloud_cover_low = hourly.Variables(7).ValuesAsNumpy()
-    hourly_cloud_cover_mid = hourly.Variables(8).ValuesAsNumpy()
-    hourly_cloud_cover_high = hourly.Variables(9).ValuesAsNumpy()
-    hourly_wind_speed_10m = hourly.Variables(10).ValuesAsNumpy()
-    hourly_wind_speed_100m = hourly.Variables(11).ValuesAsNumpy()
-    hourly_wind_gusts_10m = hourly.Variables(12).ValuesAsNumpy()
-
-    hourly_data = {"date": pd.date_range(
-        start=pd.to_datetime(hourly.Time(), unit="s"),
-        end=pd.to_datetime(hourly.TimeEnd(), unit="s"),
-        freq=pd.Timedelta(seconds=hourly.Interval()),
-        inclusive="left"
-    )}
-    hourly_data["temperature_2m"] = hourly_temperature_2m
-    hourly_data["relative_humidity_2m"] = hourly_relative_humidity_2m
-    hourly_data["precipitation"] = hourly_precipitation
-    hourly_data["rain"] = hourly_rain
-    hourly_data["snowfall"] = hourly_snowfall
-    hourly_data["weather_code"] = hourly_weather_code
-    hourly_data["cloud_cover"] = hourly_cloud_cover
-    hourly_data["cloud_cover_low"] = hourly_cloud_cover_low
-    hourly_data["cloud_cover_mid"] = hourly_cloud_cover_mid
-    hourly_data["cloud_cover_high"] = hourly_cloud_cover_high
-    hourly_data["wind_speed_10m"] = hourly_wind_speed_10m
-    hourly_data["wind_speed_100m"] = hourly_wind_speed_100m
-    hourly_data["wind_gusts_10m"] = hourly_wind_gusts_10m
-
-    hourly_dataframe = pd.DataFrame(data=hourly_data)
-    #### OPEN-METEO CODE SECTION ENDS ####
-
-    lat = response.Latitude()
-    long = response.Longitude()
-    # The returned coordinates are not exactly accurate, so we have to take them with a grain of salt
-    airport_correspond_to_latlong = f"(SELECT * FROM coordinates AS c WHERE ABS(c.latitude - {lat}) < 0.2 AND (c.longitude - {long}) < 0.2)"
-
-    # Bind the weather information to each airport
-    airport_weather_df = sqldf(f'''SELECT * from {airport_correspond_to_latlong} CROSS JOIN hourly_dataframe''')
-    all_weathers_dfs.append(airport_weather_df)
-all_weathers_dfs = pd.concat(all_weathers_dfs)
-all_weathers_dfs.drop_duplicates(subset=["iata", "date"], ignore_index=True, inplace=True)
-print(">Done")
-
-print(f"Saving weather reports to {OUTFILE}")
-all_weathers_dfs.to_csv(OUTFILE, index=False, compression="gzip")
-print(">Done")
+write_lock = threading.Lock()
+http = metrics.http_stats("open_meteo")
+written_rows = []
+
+
+def observe_response(response, *args, **kwargs):
+    # answers from the local cache are no API requests, retries are recorded by urllib3 in the response
+    if getattr(response, "from_cache", False):
+        return
+    retries = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+    http.retry(len(retries))
+    http.observe(response.elapsed.total_seconds(), response.ok)
+
+
+retry_session.hooks["response"].append(observe_response)
+
+
+def responses_to_frame(responses, chunk_coordinates):
+    hourly_frames = []
+    for response in responses:
+        # Process hourly data. The order of variables needs to be the same as requested.
+        hourly = response.Hourly()
+        hourly_data = {"date": pd.date_range(
+            start=pd.to_datetime(hourly.Time(), unit="s"),
+            end=pd.to_datetime(hourly.TimeEnd(), unit="s"),
+            freq=pd.Timedelta(seconds=hourly.Interval()),
+            inclusive="left"
+        )}
+        for i, variable in enumerate(HOURLY_VARIABLES):
+            hourly_data[variable] = hourly.Variables(i).ValuesAsNumpy()
+
+        hourly_frames.append(pd.DataFrame(data=hourly_data))
+        #### OPEN-METEO CODE SECTION ENDS ####
+
+    # The returned coordinates are those of the grid cell, so each airport gets the weather of the nearest one
+    grid_lat = np.array([response.Latitude() for response in responses])
+    grid_lon = np.array([response.Longitude() for response in responses])
+    return assign_hourly(chunk_coordinates, grid_lat, grid_lon, hourly_frames, WEATHER_DATE_FORMAT)
+
+
+def fetch_chunk(chunk):
+    """
+    Requests the weather of one chunk if today's quota allows it and appends it to OUTFILE. Returns WRITTEN,
+    NO_QUOTA or FAILED; a failed chunk is logged and requested again by the next run.
+    """
+    weight = request_weight(len(chunk.iatas), chunk.n_days, len(HOURLY_VARIABLES))
+    if not ledger.reserve(weight):
+        return NO_QUOTA
+
+    chunk_coordinates = coordinates[coordinates["iata"].isin(chunk.iatas)]
+    params = {
+        "latitude": chunk_coordinates["latitude"].tolist(),
+        "longitude": chunk_coordinates["longitude"].tolist(),
+        "start_date": chunk.start.strftime(date_format),
+        "end_date": chunk.end.strftime(date_format),
+        "hourly": HOURLY_VARIABLES,
+    }
+    print(f"Requesting {chunk.start} to {chunk.end} for {', '.join(chunk.iatas)} (weight {weight:.1f})")
+    start = time.perf_counter()
+    try:
+        responses = openmeteo.weather_api(args.url, params=params)
+    except Exception as e:
+        # a request which failed after all retries never reaches the response hook, and isn't counted by the API
+        http.observe(time.perf_counter() - start, ok=False)
+        ledger.release(weight)
+        print(f"[ERROR] Request of {chunk.start} to {chunk.end} for {', '.join(chunk.iatas)} failed: {e}")
+        return FAILED
+    try:
+        weather = responses_to_frame(responses, chunk_coordinates)
+    except Exception as e:
+        print(f"[ERROR] Response of {chunk.start} to {chunk.end} for {', '.join(chunk.iatas)} is invalid: {e!r}")
+        return FAILED
+    if weather.empty:
+        print(f"[WARNING] No weather matched {', '.join(chunk.iatas)}")
+        return WRITTEN
+    # every chunk is appended right away as a new gzip member, so an interrupted run only repeats unfinished chunks
+    with write_lock:
+        weather.to_csv(OUTFILE, mode="a", header=not os.path.isfile(OUTFILE), index=False, compression="gzip")
+        written_rows.append(len(weather))
+    return WRITTEN
+
+
+print(f"Requesting open-meteo API with {args.workers} workers")
+size_before = path_size(OUTFILE)
+success = False
+try:
+    with metrics.stage("fetch", rows_in=len(chunks)) as fetch_stage:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(fetch_chunk, chunks))
+        fetch_stage.rows_out = sum(written_rows)
+        fetch_stage.extra["failed_requests"] = results.count(FAILED)
+        fetch_stage.bytes_written = path_size(OUTFILE) - size_before
+    success = True
+finally:
+    metrics.write(success)
+print(f">Done ({results.count(WRITTEN)} of {len(chunks)} requests, used weight {ledger.used:.1f} of "
+      f"{args.daily_limit} today)")
+if FAILED in results:
+    print(f"{results.count(FAILED)} requests failed, run again to request their days.")
+if NO_QUOTA in results:
+    print("Daily limit reached, run again tomorrow to request the remaining days.")
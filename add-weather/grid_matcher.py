@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0
+# Open-Meteo returns the coordinates of the grid cell, which may be some kilometres away from the airport
+MAX_DISTANCE_KM = 25.0
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km, broadcast over numpy arrays of degrees
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def match_nearest(airport_lat, airport_lon, grid_lat, grid_lon, max_distance_km: float = MAX_DISTANCE_KM):
+    """
+    Returns for every airport the index of the nearest grid point, -1 if none is within max_distance_km.
+    The distances of all (airport, grid point) pairs are computed in one broadcast.
+    """
+    if len(grid_lat) == 0:
+        return np.full(len(airport_lat), -1)
+    distances = haversine_km(np.asarray(airport_lat)[:, None], np.asarray(airport_lon)[:, None],
+                             np.asarray(grid_lat)[None, :], np.asarray(grid_lon)[None, :])
+    nearest = distances.argmin(axis=1)
+    within = distances[np.arange(len(nearest)), nearest] <= max_distance_km
+    return np.where(within, nearest, -1)
+
+
+def assign_hourly(coordinates: pd.DataFrame, grid_lat, grid_lon, hourly_frames, date_format: str):
+    """
+    Binds the hourly weather of the nearest grid point to each airport of `coordinates` (iata, latitude,
+    longitude). The airport columns are repeated and the hourly columns concatenated as whole arrays.
+    """
+    matches = match_nearest(coordinates["latitude"], coordinates["longitude"], grid_lat, grid_lon)
+    airports = coordinates[matches >= 0]
+    matches = matches[matches >= 0]
+    if len(matches) == 0:
+        return pd.DataFrame(columns=list(coordinates.columns) + ["date"])
+
+    lengths = np.array([len(hourly_frames[m]) for m in matches])
+    weather = {column: np.repeat(airports[column].to_numpy(), lengths) for column in coordinates.columns}
+    hourly = pd.concat([hourly_frames[m] for m in matches], ignore_index=True)
+    weather["date"] = hourly["date"].dt.strftime(date_format).to_numpy()
+    # float64 like the existing weather files, Open-Meteo returns float32
+    for column in hourly.columns.drop("date"):
+        weather[column] = hourly[column].to_numpy(dtype=np.float64)
+    return pd.DataFrame(weather)
@@ -0,0 +1,126 @@
+import json
+import math
+import os
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# rows of the weather CSV which are read at once while scanning for existing days
+CHUNK_SIZE = 500_000
+
+
+def request_weight(n_locations: int, n_days: int, n_variables: int):
+    """
+    Open-Meteo counts a request as several if it covers more than 10 variables or more than 2 weeks per location
+    """
+    return n_locations * max(1.0, n_variables / 10) * max(1.0, n_days / 14)
+
+
+@dataclass
+class Chunk:
+    iatas: list
+    start: date
+    end: date
+
+    @property
+    def n_days(self):
+        return (self.end - self.start).days + 1
+
+
+def existing_days(weather_csv: str):
+    """
+    Returns the days (datetime64[D] arrays) with weather per airport in the existing weather CSV
+    """
+    if not os.path.isfile(weather_csv):
+        return {}
+    days = {}
+    for chunk in pd.read_csv(weather_csv, usecols=["iata", "date"], chunksize=CHUNK_SIZE):
+        chunk_days = pd.to_datetime(chunk["date"], format="ISO8601").to_numpy().astype("datetime64[D]")
+        for iata, idx in chunk.groupby("iata").indices.items():
+            days.setdefault(iata, []).append(np.unique(chunk_days[idx]))
+    return {iata: np.unique(np.concatenate(arrays)) for iata, arrays in days.items()}
+
+
+def missing_ranges(iatas, date_from: date, date_to: date, existing: dict):
+    """
+    Returns (iata, start, end) for every run of consecutive days in [date_from, date_to] without weather
+    """
+    all_days = np.arange(np.datetime64(date_from, "D"), np.datetime64(date_to, "D") + 1)
+    ranges = []
+    for iata in iatas:
+        missing = all_days[~np.isin(all_days, existing.get(iata, []))]
+        if len(missing) == 0:
+            continue
+        # split where consecutive missing days are more than one day apart
+        breaks = np.flatnonzero(np.diff(missing).astype(np.int64) > 1) + 1
+        for run in np.split(missing, breaks):
+            ranges.append((iata, run[0].item(), run[-1].item()))
+    return ranges
+
+
+def plan_chunks(ranges, n_variables: int, max_weight: float):
+    """
+    Splits the missing ranges into requests of at most max_weight. Airports with the same missing range share
+    requests, as Open-Meteo accepts several locations per request.
+    """
+    max_days = max(1, int(14 * max_weight / max(1.0, n_variables / 10)))
+    by_range = {}
+    for iata, start, end in ranges:
+        by_range.setdefault((start, end), []).append(iata)
+
+    chunks = []
+    for (start, end), iatas in sorted(by_range.items()):
+        n_days = (end - start).days + 1
+        for offset in range(0, n_days, max_days):
+            chunk_start = start + timedelta(days=offset)
+            chunk_end = min(end, chunk_start + timedelta(days=max_days - 1))
+            weight_per_location = request_weight(1, (chunk_end - chunk_start).days + 1, n_variables)
+            locations_per_request = max(1, math.floor(max_weight / weight_per_location))
+            for i in range(0, len(iatas), locations_per_request):
+                chunks.append(Chunk(iatas=iatas[i:i + locations_per_request], start=chunk_start, end=chunk_end))
+    return chunks
+
+
+class QuotaLedger:
+    """
+    Weight of the requests sent today, checkpointed to a JSON file so that an interrupted or repeated run
+    continues with the remaining daily quota
+    """
+
+    def __init__(self, checkpoint_file: str, daily_limit: float):
+        self.checkpoint_file = checkpoint_file
+        self.daily_limit = daily_limit
+        self.lock = threading.Lock()
+        self.day = datetime.now().strftime("%Y-%m-%d")
+        self.used = 0.0
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file) as f:
+                data = json.load(f)
+            if data.get("day") == self.day:
+                self.used = data["weight"]
+
+    def reserve(self, weight: float):
+        """
+        Books the weight of a request if it fits into today's remaining quota
+        """
+        with self.lock:
+            if self.used + weight > self.daily_limit:
+                return False
+            self.used += weight
+            self._save()
+            return True
+
+    def release(self, weight: float):
+        """
+        Gives back the weight of a reserved request which failed without an answer of the API
+        """
+        with self.lock:
+            self.used = max(0.0, self.used - weight)
+            self._save()
+
+    def _save(self):
+        with open(self.checkpoint_file, "w") as f:
+            json.dump({"day": self.day, "weight": self.used}, f)
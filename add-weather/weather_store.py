@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+HOUR = np.timedelta64(1, "h")
+# rows of the weather CSV which are read at once while building the store
+CHUNK_SIZE = 500_000
+INDEX_COLUMNS = ["date", "iata"]
+
+
+class WeatherStore:
+    """
+    Hourly weather per airport in a directory of memory-mapped .npy files, one per variable with shape
+    (airports, hours). Row i belongs to airports[i], column h to the hour base_hour + h (UTC), so looking up the
+    weather of a flight is a direct array access instead of a join.
+    """
+
+    def __init__(self, store_dir: str):
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.store_dir = store_dir
+        self.variables = meta["variables"]
+        self.airports = pd.Index(meta["airports"])
+        self.base_hour = np.datetime64(meta["base_hour"], "h")
+        self.n_hours = meta["n_hours"]
+        self.arrays = {v: np.load(os.path.join(store_dir, f"{v}.npy"), mmap_mode="r") for v in self.variables}
+
+    @staticmethod
+    def open(weather_csv: str, store_dir: str = None):
+        """
+        Opens the store of the weather CSV, it is (re)built if the CSV changed since the store was built
+        """
+        store_dir = store_dir or f"{weather_csv.removesuffix('.gz').removesuffix('.csv')}.store"
+        stat = os.stat(weather_csv)
+        fingerprint = f"{os.path.abspath(weather_csv)}:{stat.st_size}:{stat.st_mtime_ns}"
+        meta_file = os.path.join(store_dir, "meta.json")
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                if json.load(f).get("fingerprint") == fingerprint:
+                    return WeatherStore(store_dir)
+
+        WeatherStore.build(weather_csv, store_dir, fingerprint)
+        return WeatherStore(store_dir)
+
+    @staticmethod
+    def build(weather_csv: str, store_dir: str, fingerprint: str = ""):
+        """
+        Builds the store in two chunked passes over the CSV: the first one finds the airports and the time range,
+        the second one fills the preallocated memory-mapped arrays
+        """
+        print(f"Building weather store {store_dir} from {weather_csv}")
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.makedirs(store_dir)
+
+        variables = [c for c in pd.read_csv(weather_csv, nrows=0).columns if c not in INDEX_COLUMNS]
+        airports = set()
+        first_hour, last_hour = None, None
+        for chunk in pd.read_csv(weather_csv, usecols=INDEX_COLUMNS, chunksize=CHUNK_SIZE):
+            hours = _parse_hours(chunk["date"])
+            airports.update(chunk["iata"].unique())
+            first_hour = hours.min() if first_hour is None else min(first_hour, hours.min())
+            last_hour = hours.max() if last_hour is None else max(last_hour, hours.max())
+        airports = pd.Index(sorted(airports))
+        n_hours = int((last_hour - first_hour) / HOUR) + 1
+
+        arrays = {v: np.lib.format.open_memmap(os.path.join(store_dir, f"{v}.npy"), mode="w+", dtype=np.float64,
+                                               shape=(len(airports), n_hours)) for v in variables}
+        for array in arrays.values():
+            array[:] = np.nan
+        for chunk in pd.read_csv(weather_csv, chunksize=CHUNK_SIZE):
+            rows = airports.get_indexer(chunk["iata"])
+            hours = ((_parse_hours(chunk["date"]) - first_hour) / HOUR).astype(np.int64)
+            for v in variables:
+                arrays[v][rows, hours] = chunk[v].to_numpy(dtype=np.float64)
+        for array in arrays.values():
+            array.flush()
+
+        meta = {"fingerprint": fingerprint, "variables": variables, "airports": list(airports),
+                "base_hour": str(first_hour), "n_hours": n_hours}
+        with open(os.path.join(store_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def lookup(self, iata, times: pd.Series, method: str = "round"):
+        """
+        Returns the weather variables for each (airport, time) pair as DataFrame aligned with `times`,
+        NaN where the store has no weather.
+
+        :param method: "round": weather of the hour rounded like pd.Series.dt.round("h") (half to even),
+                       "nearest": weather of the nearest hour (half up),
+                       "linear": linear interpolation between the surrounding hours
+        """
+        rows = self.airports.get_indexer(pd.Series(iata, copy=False))
+        times = times.to_numpy(dtype="datetime64[ns]")
+        if method == "round":
+            hours = pd.Series(times).dt.round("h").to_numpy()
+        else:
+            hours = times + np.timedelta64(30, "m") if method == "nearest" else times
+        offsets = (hours - self.base_hour.astype("datetime64[ns]")) / HOUR
+
+        if method == "linear":
+            lower = np.floor(offsets)
+            weight = offsets - lower
+            lower_idx, lower_valid = self._positions(rows, lower)
+            upper_idx, upper_valid = self._positions(rows, lower + 1)
+            # exact hours need no upper neighbour
+            upper_valid |= lower_valid & (weight == 0)
+            upper_idx = np.where(weight == 0, lower_idx, upper_idx)
+            valid = lower_valid & upper_valid
+            return pd.DataFrame({v: np.where(valid, self._gather(v, rows, lower_idx, valid) * (1 - weight)
+                                             + self._gather(v, rows, upper_idx, valid) * weight, np.nan)
+                                 for v in self.variables})
+
+        idx, valid = self._positions(rows, np.floor(offsets))
+        return pd.DataFrame({v: self._gather(v, rows, idx, valid) for v in self.variables})
+
+    def _positions(self, rows, offsets):
+        valid = (rows >= 0) & (offsets >= 0) & (offsets < self.n_hours)
+        return np.where(valid, offsets, 0).astype(np.int64), valid
+
+    def _gather(self, variable, rows, hours, valid):
+        values = self.arrays[variable][np.where(valid, rows, 0), hours]
+        return np.where(valid, values, np.nan)
+
+
+def add_weather(flights: pd.DataFrame, store: WeatherStore, method: str = "round"):
+    """
+    Adds the weather variables at the arrival (arr_*) and departure (dep_*) airport of each flight
+    """
+    for prefix in ["arr", "dep"]:
+        weather = store.lookup(flights[f"{prefix}_iata"], flights[f"{prefix}_time_utc"], method)
+        for column, values in weather.items():
+            flights[f"{prefix}_{column}"] = values.to_numpy()
+    return flights
+
+
+def _parse_hours(dates: pd.Series):
+    return pd.to_datetime(dates, format="ISO8601").to_numpy(dtype="datetime64[ns]")
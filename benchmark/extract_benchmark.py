@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+from delay_history import DelayHistoryProcessor  # noqa: E402
+from raw_archive import ARCHIVE_FILE, RawArchive  # noqa: E402
+from raw_flights import RAW_TIME_FIELDS  # noqa: E402
+
+
+def extract_normalized(processor, names):
+    flights = processor.extract_flights_normalized(names)
+    # transform_flights parses the times afterwards, the projected extraction already returns typed times
+    for field in RAW_TIME_FIELDS:
+        flights[field] = pd.to_datetime(flights[field])
+    return flights
+
+
+def extract_projected(processor, names):
+    return processor.extract_flights(names)
+
+
+def measure(extract, archive_file, names):
+    """
+    Runs in a fresh process, so the peak RSS only belongs to this extraction
+    """
+    processor = DelayHistoryProcessor()
+    processor.archive = RawArchive(archive_file)
+    rss_before_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    flights = extract(processor, names)
+    seconds = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return len(flights), seconds, peak_rss_mb, peak_rss_mb - rss_before_mb
+
+
+def main():
+    arg_parser = ArgumentParser(description="Compares the projected extraction of raw flight responses with the "
+                                            "former pd.json_normalize extraction")
+    arg_parser.add_argument("ARCHIVE", nargs="?", default=ARCHIVE_FILE,
+                            help="Raw archive of Aviation Edge responses (see raw_archive.py)")
+    args = arg_parser.parse_args()
+
+    entries = RawArchive(args.ARCHIVE).entries()
+    names = [entry.name for entry in entries]
+    n_mb = sum(entry.size for entry in entries) / 1e6
+    print(f"{len(names)} raw responses, {n_mb:.1f} MB "
+          f"({sum(entry.stored_size for entry in entries) / 1e6:.1f} MB compressed)")
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, extract in [("json_normalize", extract_normalized), ("projected", extract_projected)]:
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(measure, (extract, args.ARCHIVE, names))
+
+    print()
+    for name, (n_rows, seconds, peak_rss_mb, extract_rss_mb) in results.items():
+        print(f"{name:>15}: {n_rows} rows in {seconds:.2f}s ({n_rows / seconds:,.0f} rows/s, "
+              f"{n_mb / seconds:.1f} MB/s), peak RSS {peak_rss_mb:.0f} MB (+{extract_rss_mb:.0f} MB for extraction)")
+    print(f"Speedup: {results['json_normalize'][1] / results['projected'][1]:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
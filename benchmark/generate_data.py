@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+from delay_history import DATE_PATTERN, DelayHistoryProcessor  # noqa: E402
+from raw_archive import RawArchive  # noqa: E402
+
+# destinations outside Vietnam, all of them are in data/airports.json
+FOREIGN_AIRPORTS = ["BKK", "ICN", "SIN", "NRT", "HKG", "TPE", "KUL", "CAN", "PVG", "DOH", "PNH", "REP", "VTE"]
+AIRLINES = ["vn", "vj", "qh", "bl", "vu", "tg", "ke", "sq", "cx", "ak"]
+CODESHARE_AIRLINES = ["af", "jl", "ke", "dl", "ek"]
+WEATHER_VARIABLES = ["temperature_2m", "relative_humidity_2m", "precipitation", "rain", "snowfall", "weather_code",
+                     "cloud_cover", "cloud_cover_low", "cloud_cover_mid", "cloud_cover_high", "wind_speed_10m",
+                     "wind_speed_100m", "wind_gusts_10m"]
+WEATHER_CODES = [0, 1, 2, 3, 45, 51, 53, 61, 63, 65, 80, 81, 95]
+# like the collection: one raw response per airport and range of days
+DAY_RANGE = 10
+TIME_PATTERN = "%Y-%m-%dt%H:%M:%S.000"
+
+
+def time_strings(minutes: np.ndarray, base: datetime):
+    """
+    Aviation Edge times with a lower case 't' for minutes after base
+    """
+    times = np.datetime64(base, "m") + minutes.astype("timedelta64[m]")
+    return pd.DatetimeIndex(times).strftime(TIME_PATTERN).to_numpy(dtype=object)
+
+
+def raw_records(rng: np.random.Generator, n: int, airport: str, airports: list, d_from: datetime,
+                codeshare_rate: float, null_rate: float, duplicate_rate: float):
+    """
+    Arrival records of an airport in the shape of the Aviation Edge flightsHistory API: a share of code-shared
+    records, of missing actual times and delays and of repeated flights with later actual times
+    """
+    origins = np.array([a for a in airports if a != airport])[rng.integers(0, len(airports) - 1, n)]
+    airlines = np.array(AIRLINES)[rng.integers(0, len(AIRLINES), n)]
+    numbers = rng.integers(100, 9999, n)
+    dep_minutes = rng.integers(0, DAY_RANGE * 24 * 60, n) // 5 * 5
+    duration = rng.integers(50, 360, n) // 5 * 5
+    dep_delay = np.maximum(rng.gamma(1.2, 18, n).astype(np.int64) - 10, 0)
+    arr_delay = np.maximum(dep_delay + rng.integers(-15, 15, n), 0)
+    dep_scheduled = time_strings(dep_minutes, d_from)
+    dep_actual = time_strings(dep_minutes + dep_delay, d_from)
+    arr_scheduled = time_strings(dep_minutes + duration, d_from)
+    arr_actual = time_strings(dep_minutes + duration + arr_delay, d_from)
+    no_actual = rng.random(n) < null_rate
+    no_delay = rng.random(n) < 0.5 + null_rate
+    codeshared = rng.random(n) < codeshare_rate
+
+    records = []
+    for i in range(n):
+        flight = f"{airlines[i]}{numbers[i]}"
+        record = {
+            "type": "arrival", "status": "landed",
+            "departure": {"iataCode": origins[i].lower(), "icaoCode": "", "delay": str(dep_delay[i]),
+                          "scheduledTime": dep_scheduled[i], "actualTime": dep_actual[i]},
+            "arrival": {"iataCode": airport.lower(), "icaoCode": "", "terminal": None, "gate": None,
+                        "scheduledTime": arr_scheduled[i]},
+            "airline": {"name": airlines[i].upper(), "iataCode": airlines[i].upper(), "icaoCode": ""},
+            "flight": {"number": str(numbers[i]), "iataNumber": flight, "icaoNumber": ""},
+        }
+        if not no_actual[i]:
+            record["arrival"]["actualTime"] = arr_actual[i]
+        if not no_delay[i]:
+            record["arrival"]["delay"] = str(arr_delay[i])
+        if codeshared[i]:
+            partner = CODESHARE_AIRLINES[i % len(CODESHARE_AIRLINES)]
+            record["codeshared"] = {"airline": {"name": partner.upper(), "iataCode": partner},
+                                    "flight": {"number": str(numbers[i]), "iataNumber": f"{partner}{numbers[i]}"}}
+        records.append(record)
+        if rng.random() < duplicate_rate:
+            # the API returns some flights twice, the later record has the more recent times
+            duplicate = json.loads(json.dumps(record))
+            duplicate["arrival"]["actualTime"] = arr_actual[i]
+            records.append(duplicate)
+    return records
+
+
+def generate_raw(archive_file: str, n_flights: int, date_from: datetime, days: int, seed: int = 0,
+                 codeshare_rate: float = 0.2, null_rate: float = 0.1, duplicate_rate: float = 0.03):
+    """
+    Writes about n_flights raw records into a raw archive like the collection. Only one response is held in
+    memory at a time, so the number of flights is only limited by the disk.
+    """
+    if os.path.exists(archive_file):
+        os.remove(archive_file)
+    archive = RawArchive(archive_file)
+    rng = np.random.default_rng(seed)
+    airports = DelayHistoryProcessor.AIRPORTS
+    ranges = [date_from + timedelta(days=d) for d in range(0, days, DAY_RANGE + 1)]
+    n_files = len(ranges) * len(airports)
+    n_written = 0
+    for r, d_from in enumerate(ranges):
+        d_to = d_from + timedelta(days=DAY_RANGE)
+        for a, airport in enumerate(airports):
+            file_index = r * len(airports) + a
+            n = (file_index + 1) * n_flights // n_files - file_index * n_flights // n_files
+            records = raw_records(rng, n, airport, airports + FOREIGN_AIRPORTS, d_from, codeshare_rate, null_rate,
+                                  duplicate_rate)
+            archive.put(airport, "arrival", d_from.strftime(DATE_PATTERN), d_to.strftime(DATE_PATTERN), data=records,
+                        commit=False)
+            n_written += len(records)
+    archive.commit()
+    archive.close()
+    return n_files, n_written
+
+
+def generate_weather(weather_csv: str, date_from: datetime, days: int, seed: int = 0, missing_rate: float = 0.01):
+    """
+    Writes hourly weather of all airports in the columns of get-weather.py, with a share of missing hours and
+    missing values
+    """
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range(date_from - timedelta(days=1), date_from + timedelta(days=days + 2), freq="h")
+    dates = hours.strftime("%Y-%m-%d %H:%M:%S.%f")
+    if os.path.exists(weather_csv):
+        os.remove(weather_csv)
+    n_rows = 0
+    for i, airport in enumerate(DelayHistoryProcessor.AIRPORTS + FOREIGN_AIRPORTS):
+        columns = {"iata": airport, "latitude": 10 + i * 0.5, "longitude": 105 + i * 0.25, "date": dates}
+        for variable in WEATHER_VARIABLES:
+            values = rng.normal(20, 8, len(hours)).round(1)
+            values[rng.random(len(hours)) < missing_rate] = np.nan
+            columns[variable] = values
+        columns["weather_code"] = np.array(WEATHER_CODES, dtype=np.float64)[rng.integers(0, len(WEATHER_CODES),
+                                                                                         len(hours))]
+        weather = pd.DataFrame(columns)
+        weather = weather[rng.random(len(weather)) >= missing_rate]
+        weather.to_csv(weather_csv, mode="a", header=n_rows == 0, index=False, compression="gzip")
+        n_rows += len(weather)
+    return n_rows
+
+
+def generate(work_dir: str, n_flights: int, days: int = 365, seed: int = 0):
+    """
+    Generates a raw archive and a weather CSV in work_dir, unless it already contains data of the same parameters.
+    Returns the raw archive file and the weather CSV.
+    """
+    archive_file = os.path.join(work_dir, "raw.sqlite")
+    weather_csv = os.path.join(work_dir, "weather.csv.gz")
+    meta_file = os.path.join(work_dir, "meta.json")
+    params = {"n_flights": n_flights, "days": days, "seed": seed}
+    if os.path.isfile(meta_file) and os.path.isfile(archive_file):
+        with open(meta_file) as f:
+            if json.load(f)["params"] == params:
+                return archive_file, weather_csv
+
+    date_from = datetime(2023, 1, 1)
+    print(f"Generating {n_flights} raw flights and weather of {days} days in {work_dir}")
+    os.makedirs(work_dir, exist_ok=True)
+    n_files, n_records = generate_raw(archive_file, n_flights, date_from, days, seed)
+    n_weather = generate_weather(weather_csv, date_from, days, seed)
+    with open(meta_file, "w") as f:
+        json.dump({"params": params, "raw_responses": n_files, "raw_records": n_records, "weather_rows": n_weather}, f,
+                  indent=2)
+    print(f"Wrote {n_records} records in {n_files} raw responses and {n_weather} weather rows")
+    return archive_file, weather_csv
+
+
+def main():
+    arg_parser = ArgumentParser(description="Generates synthetic raw Aviation Edge responses and a weather CSV")
+    arg_parser.add_argument("WORK_DIR", help="Directory for the raw archive (raw.sqlite) and the weather CSV")
+    arg_parser.add_argument("--flights", type=int, default=100_000, help="Number of flights (10k to 50M)")
+    arg_parser.add_argument("--days", type=int, default=365, help="Number of days the flights are spread over")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+    generate(args.WORK_DIR, args.flights, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "extract"))
+import storage  # noqa: E402
+from predict.features import feature_frame  # noqa: E402
+from predict.forest import BATCH_SIZE, COMPILED_DIR, CompiledForest  # noqa: E402
+from predict.model import MODELS_DIR, ModelArtifact  # noqa: E402
+
+
+def directory_mb(path: str):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1e6
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 1e6
+
+
+def main():
+    arg_parser = ArgumentParser(description="Compares the compiled inference engine of predict/forest.py with "
+                                            "pipeline.predict of the pickled model")
+    arg_parser.add_argument("flights", help="CSV file (or Parquet directory) of flights with holiday and weather "
+                                            "columns")
+    arg_parser.add_argument("--model", default="latest", help="Model version, e.g. v3 (default: latest)")
+    arg_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per batch of the compiled engine")
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    artifact = ModelArtifact.load(args.model)
+    joblib_s = time.perf_counter() - start
+    artifact.pipeline.set_params(model__n_jobs=None)
+    model_dir = os.path.join(MODELS_DIR, artifact.version)
+    if not os.path.isdir(os.path.join(model_dir, COMPILED_DIR)):
+        CompiledForest.export(artifact.pipeline, model_dir, artifact.meta)
+    start = time.perf_counter()
+    forest = CompiledForest.load(artifact.version)
+    compiled_s = time.perf_counter() - start
+
+    features = feature_frame(storage.read_flights(args.flights))
+    start = time.perf_counter()
+    expected = artifact.pipeline.predict(features)
+    sklearn_s = time.perf_counter() - start
+    start = time.perf_counter()
+    predictions = forest.predict_features(features, args.batch_size)
+    forest_s = time.perf_counter() - start
+
+    print(f"Model {artifact.version}: {forest.meta['n_trees']} trees, {forest.meta['n_nodes']} nodes, "
+          f"{len(features)} flights\n")
+    print(f"{'':>9} {'model MB':>9} {'load s':>8} {'predict s':>10} {'flights/s':>12}")
+    print(f"{'sklearn':>9} {directory_mb(os.path.join(model_dir, 'model.joblib')):9.1f} {joblib_s:8.3f} "
+          f"{sklearn_s:10.3f} {len(features) / sklearn_s:12,.0f}")
+    print(f"{'compiled':>9} {directory_mb(os.path.join(model_dir, COMPILED_DIR)):9.1f} {compiled_s:8.3f} "
+          f"{forest_s:10.3f} {len(features) / forest_s:12,.0f}")
+    print(f"\nSpeed-up: {joblib_s / compiled_s:.0f}x load, {sklearn_s / forest_s:.1f}x predict")
+    print(f"Max absolute difference of the predictions: {np.abs(predictions - expected).max():.2e} minutes")
+
+
+if __name__ == '__main__':
+    main()
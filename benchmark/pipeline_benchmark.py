@@ -0,0 +1,143 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+os.environ.setdefault("DATA_DIR", os.path.join(ROOT_DIR, "data"))
+for module_dir in ["extract", "add-holidays", "add-weather"]:
+    sys.path.append(os.path.join(ROOT_DIR, module_dir))
+from add_holidays import add_holidays  # noqa: E402
+from airport_index import AirportIndex  # noqa: E402
+from config import config  # noqa: E402
+from delay_history import DelayHistoryProcessor  # noqa: E402
+from generate_data import generate  # noqa: E402
+from metrics import PeakRss  # noqa: E402
+from raw_archive import RawArchive  # noqa: E402
+from weather_store import WeatherStore, add_weather  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmark", "results")
+WORK_DIR = f"{config.data_dir}/benchmark"
+
+
+def measure(results: dict, name: str, function, n_rows: int, *args):
+    """
+    Runs a stage, function(*args), and records its time, throughput and memory under results[name]. Returns the
+    stage's result. The arguments are passed instead of bound in a closure, so that the caller can delete them
+    afterwards to free their memory.
+    """
+    rss_before = PeakRss.current_mb()
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+    results[name] = {"rows": n_rows, "seconds": seconds, "rows_per_s": n_rows / seconds if seconds else None,
+                     "rss_before_mb": rss_before, "peak_rss_mb": rss.peak, "rss_delta_mb": rss.peak - rss_before}
+    print(f"{name:>19}: {n_rows:>10} rows in {seconds:8.3f}s ({results[name]['rows_per_s']:>12,.0f} rows/s), "
+          f"peak RSS {rss.peak:.0f} MB (+{rss.peak - rss_before:.0f} MB)")
+    return result
+
+
+def run_stages(archive_file: str, weather_csv: str, work_dir: str):
+    """
+    Runs the ETL and enrichment stages one after the other on the generated data and measures each of them.
+    add_country_codes is part of transform_flights and is measured again on its own.
+    """
+    stages = {}
+    processor = DelayHistoryProcessor()
+    processor.archive = RawArchive(archive_file)
+    processor.INVALID_CSV = os.path.join(work_dir, "invalid.csv")
+    entries = processor.archive.entries()
+    with open(os.path.join(work_dir, "meta.json")) as f:
+        meta = json.load(f)
+
+    raw = measure(stages, "extract_flights", processor.extract_flights, meta["raw_records"],
+                  [entry.name for entry in entries])
+    stages["extract_flights"]["raw_mb"] = sum(entry.size for entry in entries) / 1e6
+    stages["extract_flights"]["stored_mb"] = sum(entry.stored_size for entry in entries) / 1e6
+    transformed = measure(stages, "transform_flights", processor.transform_flights, len(raw), raw)
+    del raw
+    uncoded = transformed.drop(columns=["dep_country_code", "arr_country_code"])
+    measure(stages, "add_country_codes", processor.add_country_codes, len(uncoded), uncoded)
+    del uncoded
+    flights = measure(stages, "clean_flights", processor.clean_flights, len(transformed), transformed)
+    del transformed
+
+    airport_index = AirportIndex.load()
+    flights = measure(stages, "add_holidays", add_holidays, len(flights), flights, airport_index)
+    store_dir = os.path.join(work_dir, "weather.store")
+    measure(stages, "weather_store_build", WeatherStore.build, meta["weather_rows"], weather_csv, store_dir)
+    store = WeatherStore(store_dir)
+    measure(stages, "add_weather", add_weather, len(flights), flights, store)
+    return stages
+
+
+def best_of(runs: list):
+    """
+    Per stage the measurement of the fastest run, with the times of all runs
+    """
+    best = {}
+    for name in runs[0]:
+        best[name] = dict(min((run[name] for run in runs), key=lambda stage: stage["seconds"]))
+        best[name]["all_seconds"] = [run[name]["seconds"] for run in runs]
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline_file: str):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline_file} (commit {baseline['commit']}, {baseline['flights']} flights):")
+    for name, stage in results["stages"].items():
+        if name in baseline["stages"]:
+            before = baseline["stages"][name]
+            print(f"{name:>19}: {before['seconds'] / stage['seconds']:5.2f}x speed, "
+                  f"memory of the stage {stage['rss_delta_mb'] - before['rss_delta_mb']:+.0f} MB")
+
+
+def main():
+    arg_parser = ArgumentParser(description="Measures the ETL and enrichment stages on synthetic data and saves the "
+                                            "results as JSON")
+    arg_parser.add_argument("--flights", type=int, default=100_000, help="Number of generated flights (10k to 50M)")
+    arg_parser.add_argument("--days", type=int, default=365, help="Number of days the flights are spread over")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=1,
+                            help="Run all stages this many times and keep the fastest run of each stage")
+    arg_parser.add_argument("--work-dir", help=f"Directory of the generated data (default: {WORK_DIR}/<flights>)")
+    arg_parser.add_argument("--output", help=f"Result JSON file (default: {RESULTS_DIR}/<flights>-<commit>.json)")
+    arg_parser.add_argument("--compare", help="Result JSON file of an earlier run to compare with")
+    args = arg_parser.parse_args()
+
+    work_dir = args.work_dir or os.path.join(WORK_DIR, str(args.flights))
+    archive_file, weather_csv = generate(work_dir, args.flights, args.days, args.seed)
+    commit = git_commit()
+    print(f"Benchmark of commit {commit} on {work_dir}\n")
+    results = {"commit": commit, "created": datetime.now().isoformat(timespec="seconds"), "flights": args.flights,
+               "days": args.days, "seed": args.seed, "python": platform.python_version(), "pandas": pd.__version__,
+               "cpus": os.cpu_count(),
+               "stages": best_of([run_stages(archive_file, weather_csv, work_dir) for _ in range(args.repeat)])}
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{args.flights}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
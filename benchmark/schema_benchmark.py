@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract"))
+import storage  # noqa: E402
+from schema import FLIGHT_DTYPES  # noqa: E402
+
+
+def main():
+    arg_parser = ArgumentParser(description="Compares the memory of flights read with inferred dtypes and with the "
+                                            "dtypes of the schema")
+    arg_parser.add_argument("FLIGHTS_CSV", help="CSV file of flights, e.g. data/history/flightsHistory.csv")
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    header = pd.read_csv(args.FLIGHTS_CSV, nrows=0).columns
+    inferred = pd.read_csv(args.FLIGHTS_CSV, parse_dates=[c for c in storage.DATE_COLUMNS if c in header],
+                           float_precision=storage.FLOAT_PRECISION)
+    inferred_s = time.perf_counter() - start
+    start = time.perf_counter()
+    typed = storage.read_flights(args.FLIGHTS_CSV)
+    typed_s = time.perf_counter() - start
+
+    columns = [c for c in typed.columns if c in FLIGHT_DTYPES]
+    before = inferred.memory_usage(deep=True, index=False)
+    after = typed.memory_usage(deep=True, index=False)
+    print(f"{len(typed)} flights\n")
+    print(f"{'column':>18} {'inferred':>16} {'MB':>8} {'schema':>16} {'MB':>8}")
+    for column in columns:
+        print(f"{column:>18} {str(inferred[column].dtype):>16} {before[column] / 1e6:8.2f} "
+              f"{str(typed[column].dtype):>16} {after[column] / 1e6:8.2f}")
+    print(f"\nSchema columns: {before[columns].sum() / 1e6:.1f} MB inferred, {after[columns].sum() / 1e6:.1f} MB "
+          f"with the schema ({1 - after[columns].sum() / before[columns].sum():.0%} less)")
+    print(f"All columns: {before.sum() / 1e6:.1f} MB inferred, {after.sum() / 1e6:.1f} MB with the schema")
+    print(f"Read: {inferred_s:.2f}s inferred, {typed_s:.2f}s with the schema")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,7 @@
 #!/usr/bin/env bash
 
-# fetch new flight data from the API and save to data/flightsHistory.csv
-#cd extract && python delay_history.py -m update && cd ..
-
-# add holiday information and save to data/history/flightsHistory-holiday.csv
-#python add-holidays/add_holidays.py data/history/flightsHistory.csv
-
-# add weather information from all_weathers.csv and save to flightsHistory-weather.csv
-python add-weather/add-weather-from-existing.py data/weather.csv.gz data/history/flightsHistory-holidays.csv data/history/flightsHistory-weather.csv
\ No newline at end of file
+# ETL of the raw flight data (data/history/flightsHistory.csv), holiday, weather, congestion and inbound leg enrichment
+# in one process, the result is saved to data/history/flightsHistory-weather.csv. Unchanged stages are read from
+# data/pipeline-cache. Add --update to fetch new flight data from the API first,
+# --stages holidays to skip the other enrichments, see python pipeline.py --help.
+python pipeline.py "$@"
@@ -0,0 +1,128 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from config import config
+
+AIRPORTS_JSON = f"{config.data_dir}/airports.json"
+
+# None of the airport sources contain time zones, so they are derived from the country. Only countries with a single
+# time zone are listed, airports of all other countries get an unknown (empty) time zone.
+COUNTRY_TIMEZONES = {
+    "AE": "Asia/Dubai", "AM": "Asia/Yerevan", "AZ": "Asia/Baku", "BD": "Asia/Dhaka", "BE": "Europe/Brussels",
+    "BH": "Asia/Bahrain", "BN": "Asia/Brunei", "BT": "Asia/Thimphu", "CH": "Europe/Zurich", "CN": "Asia/Shanghai",
+    "DE": "Europe/Berlin", "FR": "Europe/Paris", "GB": "Europe/London", "HK": "Asia/Hong_Kong", "HR": "Europe/Zagreb",
+    "IN": "Asia/Kolkata", "IT": "Europe/Rome", "JO": "Asia/Amman", "JP": "Asia/Tokyo", "KH": "Asia/Phnom_Penh",
+    "KR": "Asia/Seoul", "KW": "Asia/Kuwait", "LA": "Asia/Vientiane", "LK": "Asia/Colombo", "MM": "Asia/Yangon",
+    "MO": "Asia/Macau", "MV": "Indian/Maldives", "MY": "Asia/Kuala_Lumpur", "NL": "Europe/Amsterdam",
+    "NP": "Asia/Kathmandu", "OM": "Asia/Muscat", "PH": "Asia/Manila", "PK": "Asia/Karachi", "QA": "Asia/Qatar",
+    "SA": "Asia/Riyadh", "SG": "Asia/Singapore", "TH": "Asia/Bangkok", "TR": "Europe/Istanbul", "TW": "Asia/Taipei",
+    "VN": "Asia/Ho_Chi_Minh",
+}
+
+
+@dataclass
+class AirportIndex:
+    """
+    Compact IATA reference index: sorted IATA codes with array-backed attributes.
+    Country codes and time zones are stored as category codes into small category arrays.
+    """
+    iata: np.ndarray
+    country_codes: np.ndarray
+    countries: np.ndarray
+    latitudes: np.ndarray
+    longitudes: np.ndarray
+    timezone_codes: np.ndarray
+    timezones: np.ndarray
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def load(source: str = AIRPORTS_JSON):
+        """
+        Loads the index of the source file from its cache file and rebuilds the cache if the source changed
+        """
+        cache_file = f"{os.path.splitext(source)[0]}-index.npz"
+        fingerprint = AirportIndex._fingerprint(source)
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as data:
+                if str(data["fingerprint"]) == fingerprint:
+                    return AirportIndex(**{k: data[k] for k in data.files if k != "fingerprint"})
+
+        print(f"Building airport index of {source}")
+        index = AirportIndex.build(source)
+        np.savez(cache_file, fingerprint=np.array(fingerprint), **vars(index))
+        return index
+
+    @staticmethod
+    def build(source: str):
+        """
+        Builds the index from an airports.json (iata_code, lat, lng, country_code) or an ip2location CSV
+        (iata, latitude, longitude, country_code) file
+        """
+        if source.endswith(".json"):
+            airports = pd.read_json(source)
+            airports = airports.rename(columns={"iata_code": "iata", "lat": "latitude", "lng": "longitude"})
+        else:
+            airports = pd.read_csv(source, keep_default_na=False, na_values=[""])
+        airports = airports[airports["iata"].notnull()]
+        # keep the last entry of duplicate IATA codes
+        airports = airports.drop_duplicates(subset="iata", keep="last").sort_values(by="iata")
+
+        country_codes, countries = pd.factorize(airports["country_code"])
+        if "timezone" in airports:
+            timezone_names = airports["timezone"]
+        else:
+            timezone_names = airports["country_code"].map(COUNTRY_TIMEZONES)
+        timezone_codes, timezones = pd.factorize(timezone_names)
+        return AirportIndex(iata=airports["iata"].to_numpy(dtype="U3"),
+                            country_codes=country_codes.astype(np.int16),
+                            countries=np.asarray(countries, dtype="U2"),
+                            latitudes=airports["latitude"].to_numpy(dtype=np.float32),
+                            longitudes=airports["longitude"].to_numpy(dtype=np.float32),
+                            timezone_codes=timezone_codes.astype(np.int16),
+                            timezones=np.asarray(timezones, dtype=str))
+
+    def positions(self, iata_codes):
+        """
+        Returns the index position of each IATA code, -1 for unknown codes.
+        Only the distinct codes are searched, the result is gathered with their factorized codes.
+        """
+        codes, uniques = pd.factorize(pd.Series(iata_codes, copy=False))
+        uniques = np.asarray(uniques, dtype=str)
+        if len(uniques) == 0 or len(self.iata) == 0:
+            return np.full(len(codes), -1)
+        unique_positions = np.minimum(np.searchsorted(self.iata, uniques), len(self.iata) - 1)
+        found = self.iata[unique_positions] == uniques
+        unique_positions = np.where(found, unique_positions, -1)
+        return np.where(codes >= 0, unique_positions[codes], -1)
+
+    def airports_of_country(self, country: str):
+        """
+        IATA codes of the airports in a country
+        """
+        return list(self.iata[np.isin(self.country_codes, np.flatnonzero(self.countries == country))])
+
+    def country_code(self, positions):
+        return self._categorical(self.country_codes, self.countries, positions)
+
+    def timezone(self, positions):
+        return self._categorical(self.timezone_codes, self.timezones, positions)
+
+    def latitude(self, positions):
+        return np.where(positions >= 0, self.latitudes[positions], np.nan)
+
+    def longitude(self, positions):
+        return np.where(positions >= 0, self.longitudes[positions], np.nan)
+
+    @staticmethod
+    def _categorical(category_codes, categories, positions):
+        codes = np.where(positions >= 0, category_codes[positions], -1)
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    @staticmethod
+    def _fingerprint(source):
+        stat = os.stat(source)
+        return f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
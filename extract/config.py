@@ -8,13 +8,20 @@ import dotenv
 class Config:
     api_key: str
     aviation_edge_key: str
+    airlabs_url: str
     country: str
     data_dir: str
+    delay_file: str
 
 
 dotenv.load_dotenv()
+data_dir = os.getenv("DATA_DIR", "../data")
 config = Config(
     api_key=os.getenv("API_KEY", "no_key"),
     aviation_edge_key=os.getenv("AVIATION_EDGE_KEY", "no_key"),
-    data_dir=os.getenv("DATA_DIR", "../data"),
-    country="VN")
+    # can point to a local mock server for testing
+    airlabs_url=os.getenv("AIRLABS_URL", "https://airlabs.co/api/v9"),
+    data_dir=data_dir,
+    delay_file=os.getenv("DELAY_FILE", f"{data_dir}/current/flightsCurrent.csv"),
+    # country of get_airports_in_country.py and the default shard of shard_coordinator.py
+    country=os.getenv("COUNTRY", "VN"))
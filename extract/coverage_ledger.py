@@ -0,0 +1,250 @@
+import argparse
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from config import config
+
+COVERAGE_FILE = f"{config.data_dir}/history/coverage.sqlite"
+# the last day of a request is at most this many days after the first one, like the former fixed time ranges
+WINDOW_DAYS = 10
+# days whose requests failed are planned again until they failed this many times
+MAX_ATTEMPTS = 3
+COLLECTED = "collected"
+# the request raised, e.g. a timeout or an invalid response
+FAILED = "failed"
+# the API answered with an error, e.g. "No Record Found" for a range without flights
+ERROR = "error"
+# days without any request, only used in reports
+MISSING = "missing"
+
+
+@dataclass
+class Window:
+    """
+    A planned request: the days from start to end of an airport and type, n_days of them are not collected yet
+    """
+    airport: str
+    type: str
+    start: date
+    end: date
+    n_days: int
+
+
+@dataclass
+class Hole:
+    """
+    Consecutive days of an airport and type with the same status which are not collected
+    """
+    airport: str
+    type: str
+    start: date
+    end: date
+    status: str
+    attempts: int
+    message: str
+
+
+def day_range(start: date, end: date):
+    return np.arange(np.datetime64(start, "D"), np.datetime64(end, "D") + 1)
+
+
+def plan_windows(airport: str, t: str, todo: np.ndarray, window_days: int = WINDOW_DAYS):
+    """
+    Covers the sorted days `todo` with as few windows of at most window_days + 1 days as possible: every window
+    starts at the first uncovered day and ends at the last day to do within its reach, so adjacent gaps and gaps
+    separated by a few collected days share one request
+    """
+    windows = []
+    i = 0
+    while i < len(todo):
+        j = int(np.searchsorted(todo, todo[i] + np.timedelta64(window_days, "D"), side="right"))
+        windows.append(Window(airport=airport, type=t, start=todo[i].item(), end=todo[j - 1].item(), n_days=j - i))
+        i = j
+    return windows
+
+
+class CoverageLedger:
+    """
+    Fetch status of the flight history per (airport, type, day) in a SQLite file: collected, or the status and
+    message of the last failed request with the number of attempts. Collection plans its requests from the days
+    which are not collected, instead of only moving forward from the latest collected date.
+    The ledger can be shared by threads like the raw archive.
+    """
+
+    def __init__(self, path: str = COVERAGE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS coverage (
+                    airport TEXT NOT NULL, type TEXT NOT NULL, day TEXT NOT NULL, status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL, updated TEXT NOT NULL, message TEXT,
+                    PRIMARY KEY (airport, type, day)) WITHOUT ROWID
+            """)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def record(self, airport: str, t: str, start: date, end: date, status: str, message: str = None,
+               commit: bool = True):
+        """
+        Records the result of a request for the days from start to end. A failure never overrides days which are
+        already collected, e.g. by an overlapping request.
+        """
+        updated = datetime.now().isoformat(timespec="seconds")
+        rows = [(airport, t, str(day), status, updated, message) for day in day_range(start, end)]
+        overwrite = "" if status == COLLECTED else f"WHERE coverage.status != '{COLLECTED}'"
+        with self.lock:
+            self.connection.executemany(f"""
+                INSERT INTO coverage (airport, type, day, status, attempts, updated, message)
+                VALUES (?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (airport, type, day) DO UPDATE SET status = excluded.status,
+                    attempts = coverage.attempts + 1, updated = excluded.updated, message = excluded.message
+                {overwrite}
+            """, rows)
+            if commit:
+                self.connection.commit()
+
+    def add_archived(self, entries):
+        """
+        Marks the days of archived responses as collected, e.g. of responses collected before the ledger existed.
+        Days which are already collected are left as they are.
+        """
+        rows = []
+        for entry in entries:
+            try:
+                start = datetime.strptime(entry.date_from, "%Y-%m-%d").date()
+                end = datetime.strptime(entry.date_to, "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            rows += [(entry.airport, entry.type, str(day), COLLECTED, 1, entry.collected)
+                     for day in day_range(start, end)]
+        with self.lock:
+            self.connection.executemany(f"""
+                INSERT INTO coverage (airport, type, day, status, attempts, updated) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (airport, type, day) DO UPDATE SET status = excluded.status, message = NULL
+                WHERE coverage.status != '{COLLECTED}'
+            """, rows)
+            self.connection.commit()
+
+    def days(self, airport: str, t: str, start: date, end: date):
+        """
+        Returns the recorded days from start to end (datetime64[D]) with their status, attempts and message
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT day, status, attempts, message FROM coverage "
+                                           "WHERE airport = ? AND type = ? AND day BETWEEN ? AND ? ORDER BY day",
+                                           (airport, t, str(start), str(end))).fetchall()
+        return (np.array([row[0] for row in rows], dtype="datetime64[D]"), [row[1] for row in rows],
+                np.array([row[2] for row in rows], dtype=np.int64), [row[3] for row in rows])
+
+    def plan(self, airports, types, start: date, end: date, max_attempts: int = MAX_ATTEMPTS,
+             window_days: int = WINDOW_DAYS):
+        """
+        Returns the windows which cover all days from start to end which are not collected and failed less than
+        max_attempts times, with as few requests per airport and type as possible
+        """
+        windows = []
+        for airport in airports:
+            for t in types:
+                days, statuses, attempts, _ = self.days(airport, t, start, end)
+                done = days[(np.array(statuses) == COLLECTED) | (attempts >= max_attempts)] if len(days) else days
+                all_days = day_range(start, end)
+                windows += plan_windows(airport, t, all_days[~np.isin(all_days, done)], window_days)
+        return windows
+
+    def holes(self, airports, types, start: date, end: date):
+        """
+        Returns the runs of consecutive days from start to end which are not collected, split where the status
+        changes. Days without any request have the status MISSING.
+        """
+        holes = []
+        for airport in airports:
+            for t in types:
+                days, statuses, attempts, messages = self.days(airport, t, start, end)
+                known = {day: (status, n, message)
+                         for day, status, n, message in zip(days.tolist(), statuses, attempts.tolist(), messages)}
+                current = None
+                for day in day_range(start, end).tolist():
+                    status, n, message = known.get(day, (MISSING, 0, None))
+                    if status == COLLECTED:
+                        current = None
+                        continue
+                    if current is not None and current.status == status and current.end == day - timedelta(days=1):
+                        current.end = day
+                        current.attempts = max(current.attempts, n)
+                        continue
+                    current = Hole(airport=airport, type=t, start=day, end=day, status=status, attempts=n,
+                                   message=message)
+                    holes.append(current)
+        return holes
+
+    def extent(self):
+        """
+        Airports, types and first and last day of the ledger, None for an empty ledger
+        """
+        with self.lock:
+            first, last = self.connection.execute("SELECT MIN(day), MAX(day) FROM coverage").fetchone()
+            airports = [row[0] for row in self.connection.execute("SELECT DISTINCT airport FROM coverage")]
+            types = [row[0] for row in self.connection.execute("SELECT DISTINCT type FROM coverage")]
+        if first is None:
+            return None
+        return sorted(airports), sorted(types), date.fromisoformat(first), date.fromisoformat(last)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Reports the days of the flight history which are not collected "
+                                                     "and the requests which collection would send for them")
+    arg_parser.add_argument("--coverage", default=COVERAGE_FILE, help="SQLite file of the coverage ledger")
+    arg_parser.add_argument("--date-from", type=date.fromisoformat, help="First day, YYYY-MM-DD (default: first day "
+                                                                         "of the ledger)")
+    arg_parser.add_argument("--date-to", type=date.fromisoformat, help="Last day, YYYY-MM-DD (default: last day of "
+                                                                       "the ledger)")
+    arg_parser.add_argument("--airports", nargs="+", help="Only these airports (default: all of the ledger)")
+    arg_parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS,
+                            help="Days which failed this many times are not planned again")
+    args = arg_parser.parse_args()
+
+    ledger = CoverageLedger(args.coverage)
+    extent = ledger.extent()
+    if extent is None:
+        print(f"{args.coverage} is empty, run delay_history.py --mode collect first")
+        return
+    airports, types, first, last = extent
+    airports = args.airports or airports
+    start, end = args.date_from or first, args.date_to or last
+    n_days = len(day_range(start, end)) * len(airports) * len(types)
+
+    holes = ledger.holes(airports, types, start, end)
+    for hole in holes:
+        print(f"{hole.airport} {hole.type:>9} {hole.start} - {hole.end} ({(hole.end - hole.start).days + 1:>3} days) "
+              f"{hole.status:>7}" + (f", {hole.attempts} attempts: {hole.message}" if hole.attempts else ""))
+    n_missing = {}
+    for hole in holes:
+        n_missing[hole.status] = n_missing.get(hole.status, 0) + (hole.end - hole.start).days + 1
+    n_collected = n_days - sum(n_missing.values())
+    windows = ledger.plan(airports, types, start, end, args.max_attempts)
+    print(f"\n{start} to {end}, {len(airports)} airports: {n_collected} of {n_days} days collected "
+          f"({n_collected / n_days:.1%}), {len(holes)} holes: "
+          + (", ".join(f"{n} days {status}" for status, n in sorted(n_missing.items())) or "none"))
+    print(f"Collection would send {len(windows)} requests for {sum(w.n_days for w in windows)} days "
+          f"(days which failed {args.max_attempts} times are skipped)")
+    ledger.close()
+
+
+if __name__ == '__main__':
+    main()
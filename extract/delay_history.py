@@ -1,136 +1,363 @@
 import argparse
 import json
 import os.path
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 
-import math
+import numpy as np
 import pandas as pd
 import requests
 import tenacity
 from dateutil.relativedelta import relativedelta
 from pandas import DataFrame
+from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt
 
+import storage
+from airport_index import AirportIndex
 from config import config
 from constants import constants
-
-STATE_FILE = f"{config.data_dir}/history/history-state.json"
+from coverage_ledger import COLLECTED, COVERAGE_FILE, ERROR, FAILED, MAX_ATTEMPTS, CoverageLedger
+from metrics import Metrics, add_metrics_arguments, path_size
+from raw_archive import ARCHIVE_FILE, RAW_DATA_DIR, RawArchive
+from raw_flights import concat_flights, parse_raw_responses
+from schema import apply_schema, delay_minutes
+from shards import KNOWN_AIRPORTS, Shard
+
+MANIFEST_FILE = f"{config.data_dir}/history/etl-manifest.json"
 DATE_PATTERN = "%Y-%m-%d"
+# flights with the same number and departure time are the same flight
+FLIGHT_KEY = ["flight_iata", "dep_time_utc"]
+# column of transform_flights which marks delays of the API that are no valid minutes, removed by clean_flights
+INVALID_DELAY = "invalid_delay"
 
 
 @dataclass
-class State:
-    latest_date: datetime
+class Manifest:
+    """
+    Raw responses which are already included in the ETL result: size and SHA-256 keyed by the name of the archive
+    entry (the name of the former raw file)
+    """
+    files: dict
 
-    def save_to_file(self):
-        with open(STATE_FILE, 'w') as f:
-            data = {'latest_date': self.latest_date.strftime(DATE_PATTERN)}
-            json.dump(data, f)
+    def save_to_file(self, manifest_file: str = MANIFEST_FILE):
+        with open(manifest_file, 'w') as f:
+            json.dump({'files': self.files}, f, indent=2)
 
     @staticmethod
-    def load_from_file():
-        if not os.path.isfile(STATE_FILE):
-            raise RuntimeError(f"{STATE_FILE} doesn't exist! Consider running --collect first.")
+    def load_from_file(manifest_file: str = MANIFEST_FILE):
+        if not os.path.isfile(manifest_file):
+            return Manifest(files={})
 
-        with open(STATE_FILE, 'r') as f:
+        with open(manifest_file, 'r') as f:
             data = json.load(f)
+        return Manifest(files=data['files'])
+
+
+def changed_entries(entries: list, manifest: Manifest):
+    """
+    The archive entries which are not in the manifest or whose response changed since it was processed
+    """
+    return [entry for entry in entries if manifest.files.get(entry.name, {}).get('sha256') != entry.sha256]
+
 
-        latest_date = datetime.strptime(data['latest_date'], DATE_PATTERN)
-        return State(latest_date=latest_date)
+class RateLimiter:
+    """
+    Thread-safe limiter which spaces requests evenly to stay within a requests-per-second budget
+    """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
 
 
 class DelayHistoryProcessor:
     RESULT_CSV = f"{config.data_dir}/history/flightsHistory.csv"
-    RAW_DATA_DIR = f"{config.data_dir}/history/flightsHistory_raw"
+    RESULT_PARQUET = f"{config.data_dir}/history/flightsHistory.parquet"
+    RAW_ARCHIVE = ARCHIVE_FILE
+    # former raw files, one per request, which are moved into the archive with `raw_archive.py -m migrate`
+    RAW_DATA_DIR = RAW_DATA_DIR
+    COVERAGE_FILE = COVERAGE_FILE
     INVALID_CSV = f"{config.data_dir}/history/flightsHistory_invalid.csv"
     ETL_STATS_JSON = f"{config.data_dir}/history/etl-stats.json"
-
-    # all civil airports in Vietnam:
-    AIRPORTS = ["HAN", "SGN", "BMV", "CXR", "VCA", "HPH", "VCL", "VCS", "DAD", "DIN", "VDH", "TBB", "DLI",
-                "HUI", "UIH", "PQC", "PXU", "THD", "VII"]
-    etl_stats = {}
+    MANIFEST_FILE = MANIFEST_FILE
+    # files of the history which every shard has in its own directory
+    SHARD_FILES = ["RESULT_CSV", "RESULT_PARQUET", "RAW_ARCHIVE", "RAW_DATA_DIR", "COVERAGE_FILE", "INVALID_CSV",
+                   "ETL_STATS_JSON", "MANIFEST_FILE"]
+
+    AIRPORTS = KNOWN_AIRPORTS["VN"]
+    TYPES = ["arrival"]
+
+    def __init__(self, workers: int = 1, requests_per_second: float = 5, output_format: str = "csv",
+                 metrics: Metrics = None, max_attempts: int = MAX_ATTEMPTS, shard: Shard = None):
+        self.shard = shard
+        if shard is not None:
+            os.makedirs(shard.directory, exist_ok=True)
+            self.AIRPORTS = shard.airports
+            for attribute in self.SHARD_FILES:
+                setattr(self, attribute, shard.path(os.path.basename(getattr(self, attribute))))
+        self.etl_stats = {}
+        self.result_path = self.RESULT_PARQUET if output_format == "parquet" else self.RESULT_CSV
+        self.workers = workers
+        self.metrics = metrics or Metrics("delay_history")
+        self.http = self.metrics.http_stats("aviation_edge")
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.archive = RawArchive(self.RAW_ARCHIVE)
+        self.coverage = CoverageLedger(self.COVERAGE_FILE)
+        self.max_attempts = max_attempts
+        # one pooled session shared by all worker threads to reuse connections to the API
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def collect_flights(self, date_from: datetime):
         """
-        Collects historical flights from Aviation Edge API and save results to separate JSON files
-        """
-        day_range = 10
-        max_date = self.get_max_date()
-        while True:
-            date_to = min(date_from + timedelta(days=day_range), max_date)
-            print(f"Collecting time range: {date_from} to {date_to}:")
-            for t in ["arrival"]:
-                for airport in self.AIRPORTS:
-                    d_from = date_from.strftime(DATE_PATTERN)
-                    d_to = date_to.strftime(DATE_PATTERN)
-                    raw_result_file = f"{self.RAW_DATA_DIR}/{d_from}_{d_to}_{airport}_{t}.json"
-                    if os.path.isfile(raw_result_file):
-                        print(f"{raw_result_file} already exists.")
-                        continue
-
-                    url = (f"https://aviation-edge.com/v2/public/flightsHistory?code={airport}&type={t}&"
-                           f"date_from={d_from}&date_to={d_to}&key={config.aviation_edge_key}")
-                    try:
-                        data = self.do_request(url)
-                    except Exception as e:
-                        print(f"Request to {url} failed: {e}")
-                        continue
-
-                    if "error" in data:
-                        print(f"Skipping {airport} ({data['error']})")
-                        continue
-
-                    with open(raw_result_file, "w") as file:
-                        json.dump(data, file)
-
-            if date_to == max_date:
-                state = State(latest_date=date_to)
-                state.save_to_file()
-                print(f"Finished flight collection and saved state {state} to {STATE_FILE}.")
-                break
-            date_from = date_to + timedelta(days=1)
+        Collects historical flights from Aviation Edge API and saves the responses to the raw archive. Only days from
+        date_from on which are not collected yet, including days of failed requests, are requested.
+        Requests are executed by a pool of `workers` threads within the configured requests-per-second budget.
+        Returns the number of planned requests.
+        """
+        requests_todo = self.plan_requests(date_from, self.get_max_date())
+        if not requests_todo:
+            print(f"Nothing to collect, all days are collected or failed {self.max_attempts} times.")
+            return 0
+        print(f"Collecting {len(requests_todo)} time ranges with {self.workers} worker(s)")
+        with self.metrics.stage("collect", rows_in=len(requests_todo)) as stage:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                written = list(executor.map(lambda r: self.collect_one(*r), requests_todo))
+            stage.rows_out = sum(1 for n in written if n)
+            stage.bytes_written = sum(written)
+
+        print(f"Finished flight collection, {sum(1 for n in written if n)} of {len(requests_todo)} requests "
+              f"succeeded. See coverage_ledger.py for the days which are still missing.")
+        return len(requests_todo)
+
+    def plan_requests(self, date_from: datetime, max_date: datetime):
+        """
+        Returns (airport, type, date_from, date_to) of as few requests as possible which cover all days from
+        date_from to max_date which are not collected according to the coverage ledger. Days which failed
+        max_attempts times are not requested again.
+        """
+        # responses archived before the ledger existed count as collected
+        self.coverage.add_archived(self.archive.entries())
+        windows = self.coverage.plan(self.AIRPORTS, self.TYPES, date_from.date(), max_date.date(), self.max_attempts)
+        print(f"Planned {len(windows)} requests for {sum(w.n_days for w in windows)} days which are not collected")
+        return [(w.airport, w.type, w.start.strftime(DATE_PATTERN), w.end.strftime(DATE_PATTERN)) for w in windows]
+
+    def collect_one(self, airport: str, t: str, d_from: str, d_to: str):
+        """
+        Requests one time range and adds it to the raw archive, returns the number of written (compressed) bytes.
+        The result is recorded in the coverage ledger.
+        """
+        url = (f"https://aviation-edge.com/v2/public/flightsHistory?code={airport}&type={t}&"
+               f"date_from={d_from}&date_to={d_to}&key={config.aviation_edge_key}")
+        start = datetime.strptime(d_from, DATE_PATTERN).date()
+        end = datetime.strptime(d_to, DATE_PATTERN).date()
+        try:
+            data = self.do_request(url)
+        except Exception as e:
+            print(f"Request to {url} failed: {e}")
+            self.coverage.record(airport, t, start, end, FAILED, str(e))
+            return 0
+
+        if "error" in data:
+            print(f"Skipping {airport} {d_from} to {d_to} ({data['error']})")
+            self.coverage.record(airport, t, start, end, ERROR, str(data["error"]))
+            return 0
+
+        # the response is committed in one transaction, an interrupted run never leaves a partial response
+        n_bytes = self.archive.put(airport, t, d_from, d_to, data=data).stored_size
+        self.coverage.record(airport, t, start, end, COLLECTED)
+        return n_bytes
+
+    @staticmethod
+    def get_min_date():
+        """
+        First day of the history which the API provides
+        """
+        return (datetime.now() - relativedelta(years=1) + timedelta(days=1)).replace(hour=0, minute=0, second=0,
+                                                                                      microsecond=0)
 
     @staticmethod
     def get_max_date():
         return (datetime.now() - timedelta(days=4)).replace(hour=0, minute=0, second=0, microsecond=0)
 
-    def etl_flights(self):
+    def unprocessed_entries(self):
+        """
+        Archive entries which are not in the ETL result yet: the new or changed ones according to the manifest, all
+        of them if there is no result
+        """
+        manifest = Manifest.load_from_file(self.MANIFEST_FILE)
+        entries = self.archive.entries()
+        if not os.path.exists(self.result_path) or not manifest.files:
+            return entries
+        return changed_entries(entries, manifest)
+
+    def etl_flights(self, incremental: bool = False):
+        """
+        Runs the ETL over the raw archive. In incremental mode only responses which are new or changed since the
+        last run (according to the manifest) are processed and upserted into the existing result.
+        Returns the written flights, None if the result is already up to date.
+        """
         start = time.time()
+        manifest = Manifest.load_from_file(self.MANIFEST_FILE)
+        unmigrated = self.unmigrated_raw_files()
+        if unmigrated:
+            print(f"WARNING: {len(unmigrated)} raw files in {self.RAW_DATA_DIR} are not in the raw archive, "
+                  f"move them with `python raw_archive.py -m migrate`")
+        # the archive index has the hashes of the responses, they don't need to be read for the comparison
+        entries = self.archive.entries()
+        if not entries:
+            raise RuntimeError(f"No raw responses in {self.archive.path}")
+        fingerprints = {entry.name: {'size': entry.size, 'sha256': entry.sha256} for entry in entries}
+        incremental = incremental and os.path.exists(self.result_path) and len(manifest.files) > 0
+        if incremental:
+            entries = changed_entries(entries, manifest)
+            print(f"Incremental ETL: {len(entries)} new or changed raw responses")
+            if not entries:
+                print("Nothing to do, the ETL result is up to date.")
+                return None
+
         # ETL: extract-transform-load
-        flights = self.extract_flights()
-        flights = self.transform_flights(flights)
-        flights = self.clean_flights(flights)
+        names = [entry.name for entry in entries]
+        raw_bytes = sum(entry.stored_size for entry in entries)
+        if self.workers > 1:
+            with self.metrics.stage("extract_transform", bytes_read=raw_bytes) as stage:
+                flights = self.extract_transform_parallel(names)
+                stage.rows_in, stage.rows_out = self.etl_stats["raw"], len(flights)
+        else:
+            with self.metrics.stage("extract", bytes_read=raw_bytes) as stage:
+                flights = self.extract_flights(names)
+                stage.rows_in, stage.rows_out = self.etl_stats["raw"], len(flights)
+            with self.metrics.stage("transform", rows_in=len(flights)) as stage:
+                flights = self.transform_flights(flights)
+                stage.rows_out = len(flights)
+        with self.metrics.stage("clean", rows_in=len(flights)) as stage:
+            flights = self.clean_flights(flights, incremental)
+            stage.rows_out = len(flights)
+        if incremental:
+            with self.metrics.stage("upsert", rows_in=len(flights)) as stage:
+                flights = self.upsert_flights(flights)
+                stage.rows_out = len(flights)
         print("Historical flights after ETL:")
         print(flights)
-        flights.sort_values(by="dep_time_utc", ascending=True, inplace=True, ignore_index=True)
-        flights.index.name = "Row"
-        flights.to_csv(self.RESULT_CSV)
-
+        with self.metrics.stage("load", rows_in=len(flights)) as stage:
+            flights.sort_values(by="dep_time_utc", ascending=True, inplace=True, ignore_index=True)
+            flights.index.name = "Row"
+            # an incremental run on partitioned storage only rewrites the partitions touched by the new flights
+            storage.write_flights(flights, self.result_path, overwrite_all=not incremental)
+            stage.bytes_written = path_size(self.result_path)
+        Manifest(files=fingerprints).save_to_file(self.MANIFEST_FILE)
+
+        self.etl_stats["incremental"] = incremental
+        self.etl_stats["raw_responses"] = len(names)
         self.etl_stats["date_from"] = str(flights.iloc[0]["dep_time_utc"])
         self.etl_stats["date_to"] = str(flights.iloc[-1]["dep_time_utc"])
         self.etl_stats["etl_time_s"] = time.time() - start
         with open(self.ETL_STATS_JSON, "w") as f:
             json.dump(self.etl_stats, f, indent=2)
+        return flights
+
+    def unmigrated_raw_files(self):
+        """
+        Names of the former raw files which are not in the raw archive
+        """
+        if not os.path.isdir(self.RAW_DATA_DIR):
+            return []
+        return [f for f in sorted(os.listdir(self.RAW_DATA_DIR)) if f.endswith(".json") and f not in self.archive]
 
-    def extract_flights(self):
+    def upsert_flights(self, flights: DataFrame):
+        """
+        Merges new flights into the existing result. Rows with the same flight number and departure time are
+        replaced by the new ones, like the "keep last" duplicate removal in clean_flights.
+        For partitioned storage only the (month, departure airport) partitions of the new flights are loaded
+        and returned, otherwise the complete result.
+        """
+        print("\nCurrent stage: UPSERT\n")
+        if storage.is_partitioned(self.result_path):
+            first_month = flights["dep_time_utc"].min().replace(day=1).normalize()
+            next_month = flights["dep_time_utc"].max().replace(day=1).normalize() + relativedelta(months=1)
+            existing = storage.read_flights(self.result_path, date_from=first_month, date_to=next_month,
+                                            airports=list(flights["dep_iata"].unique()))
+        else:
+            existing = storage.read_flights(self.result_path).drop(columns="Row", errors="ignore")
+        n_existing = len(existing)
+        merged = pd.concat([existing, flights], ignore_index=True)
+        merged.drop_duplicates(subset=FLIGHT_KEY, ignore_index=True, keep='last', inplace=True)
+        n_updated = n_existing + len(flights) - len(merged)
+        print(f"Inserted {len(flights) - n_updated} and updated {n_updated} flights")
+        self.etl_stats["upsert_inserted"] = len(flights) - n_updated
+        self.etl_stats["upsert_updated"] = n_updated
+        return merged
+
+    def extract_flights(self, names=None):
+        """
+        Extracts only the fields needed by transform_flights from the archived responses of the given entry names
+        (all if None), code-shared flights are skipped while parsing
+        """
+        print("\nCurrent stage: EXTRACT\n")
+        if names is None:
+            names = [entry.name for entry in self.archive.entries()]
+        all_flights, n_total, n_codeshared = parse_raw_responses(self.archive.load(name) for name in names)
+        print(f"Removed {n_codeshared} code-shared flights")
+        n_flights = len(all_flights)
+        print(f"Keep {n_flights} out of {n_total} flights ({round(100 * n_flights / n_total)}%)")
+        print(all_flights.head(3))
+        self.etl_stats["raw"] = n_total
+        self.etl_stats["codeshared"] = n_codeshared
+        return all_flights
+
+    def extract_transform_parallel(self, names):
+        """
+        Extracts and transforms contiguous batches of archived responses in a pool of worker processes. The chunks
+        are concatenated in name order, so cleaning and statistics are the same as for a serial run.
+        """
+        print(f"\nCurrent stage: EXTRACT + TRANSFORM with {self.workers} processes\n")
+        n_batches = max(1, min(len(names), self.workers * 4))
+        batches = [names[i * len(names) // n_batches:(i + 1) * len(names) // n_batches] for i in range(n_batches)]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(_extract_transform_batch, [self.archive] * n_batches, batches))
+
+        flights = concat_flights([chunk for chunk, _, _ in results])
+        n_total = sum(n for _, n, _ in results)
+        n_codeshared = sum(n for _, _, n in results)
+        print(f"Removed {n_codeshared} code-shared flights")
+        print(f"Keep {len(flights)} out of {n_total} flights after transformation")
+        self.etl_stats["raw"] = n_total
+        self.etl_stats["codeshared"] = n_codeshared
+        return flights
+
+    def extract_flights_normalized(self, names=None):
+        """
+        Former extraction with pd.json_normalize over all fields, kept as reference for the extract benchmark
+        """
         print("\nCurrent stage: EXTRACT\n")
+        if names is None:
+            names = [entry.name for entry in self.archive.entries()]
         n_codeshared = 0
         n_total = 0
         dataframes = []
-        for f in os.listdir(self.RAW_DATA_DIR):
-            raw_file = os.path.join(self.RAW_DATA_DIR, f)
-            if os.path.isfile(raw_file):
-                with open(raw_file) as rf:
-                    data = json.load(rf)
-                df = pd.json_normalize(data)
-                n_before = len(df)
-                n_total += n_before
-                if "codeshared.flight.number" in df:
-                    df = df[df["codeshared.flight.number"].isnull()]
-                n_codeshared += n_before - len(df)
-                dataframes.append(df)
+        for name in names:
+            df = pd.json_normalize(self.archive.load(name))
+            n_before = len(df)
+            n_total += n_before
+            if "codeshared.flight.number" in df:
+                df = df[df["codeshared.flight.number"].isnull()]
+            n_codeshared += n_before - len(df)
+            dataframes.append(df)
 
         all_flights = pd.concat(dataframes, ignore_index=True)
         print(f"Removed {n_codeshared} code-shared flights")
@@ -141,13 +368,17 @@ class DelayHistoryProcessor:
         self.etl_stats["codeshared"] = n_codeshared
         return all_flights
 
-    @retry(stop=stop_after_attempt(3), wait=tenacity.wait_fixed(wait=1))
+    @retry(stop=stop_after_attempt(5), wait=tenacity.wait_exponential(multiplier=1, max=30),
+           before_sleep=lambda retry_state: retry_state.args[0].http.retry())
     def do_request(self, url):
+        self.rate_limiter.acquire()
         print(f"Requesting {url}")
-        response = requests.get(url, timeout=10)
-        return response.json()
+        with self.http.timed():
+            response = self.session.get(url, timeout=10)
+            return response.json()
 
-    def transform_flights(self, flights: DataFrame):
+    @staticmethod
+    def transform_flights(flights: DataFrame):
         print("\nCurrent stage: TRANSFORM\n")
         transformed = pd.DataFrame(columns=constants.target_csv_columns)
         transformed["flight_iata"] = flights["flight.iataNumber"]
@@ -157,60 +388,75 @@ class DelayHistoryProcessor:
         transformed["arr_time_utc"] = pd.to_datetime(flights["arrival.scheduledTime"])
         transformed["arr_actual_utc"] = pd.to_datetime(flights["arrival.actualTime"])
 
-        transformed["delayed"] = flights["arrival.delay"]
+        # one bad record must not stop the ETL: invalid delays become missing and their flights invalid
+        transformed["delayed"] = delay_minutes(flights["arrival.delay"], errors="coerce")
+        transformed[INVALID_DELAY] = flights["arrival.delay"].notnull() & transformed["delayed"].isna()
 
         transformed["arr_iata"] = flights["arrival.iataCode"].str.upper()
         transformed["dep_iata"] = flights["departure.iataCode"].str.upper()
-        transformed = self.add_country_codes(transformed)
+        transformed = DelayHistoryProcessor.add_country_codes(transformed)
 
         transformed["domestic"] = transformed["arr_country_code"] == transformed["dep_country_code"]
         transformed["international"] = ~transformed["domestic"]
 
-        transformed = transformed[constants.target_csv_columns]
-        return transformed
+        transformed = transformed[constants.target_csv_columns + [INVALID_DELAY]]
+        return apply_schema(transformed)
 
     @staticmethod
     def add_country_codes(flights):
-        airports = pd.read_json(f"{config.data_dir}/airports.json")
-        airports = airports[airports["iata_code"].notnull()]
-
-        flights = pd.merge(flights, airports[["iata_code", "country_code"]], left_on="dep_iata", right_on="iata_code")
-        flights = flights.rename(columns={'country_code': 'dep_country_code_x'})
+        airports = AirportIndex.load()
+        dep_positions = airports.positions(flights["dep_iata"])
+        arr_positions = airports.positions(flights["arr_iata"])
 
-        flights = pd.merge(flights, airports[["iata_code", "country_code"]], left_on="arr_iata", right_on="iata_code")
-        flights = flights.rename(columns={'country_code': 'arr_country_code_x'})
+        # flights from or to airports without a known country are dropped
+        known = (dep_positions >= 0) & (arr_positions >= 0)
+        if not known.all():
+            flights = flights[known].reset_index(drop=True)
+            dep_positions = dep_positions[known]
+            arr_positions = arr_positions[known]
 
-        flights["dep_country_code"] = flights["dep_country_code_x"]
-        flights["arr_country_code"] = flights["arr_country_code_x"]
+        flights["dep_country_code"] = airports.country_code(dep_positions)
+        flights["arr_country_code"] = airports.country_code(arr_positions)
 
         return flights
 
-    def clean_flights(self, flights: DataFrame):
+    def clean_flights(self, flights: DataFrame, incremental: bool = False):
+        """
+        Removes flights with unknown or invalid delay, which are written to INVALID_CSV, and duplicates. An
+        incremental run adds its invalid flights to those of the earlier runs in INVALID_CSV. Like all counts in
+        ETL_STATS_JSON, the counts of the removed flights are those of this run's flights.
+        """
         print("\nCurrent stage: CLEAN\n")
 
-        # remove rows where we don't know if there is any delay:
-        valid_flights = flights[(flights["arr_time_utc"].notnull() & flights["arr_actual_utc"].notnull())
-                                | flights["delayed"].notnull()]
-        n_all_flights = len(flights)
-        print(f"Deleted {n_all_flights - len(valid_flights)} of {n_all_flights} rows with unknown delay:")
-        invalid_flights = flights[~flights.index.isin(valid_flights.index)]
+        invalid_delay = (flights[INVALID_DELAY].to_numpy(dtype=bool) if INVALID_DELAY in flights
+                         else np.zeros(len(flights), dtype=bool))
+        flights = flights.drop(columns=INVALID_DELAY, errors="ignore")
+        # calculate the delay in minutes where it's missing, truncated like int()
+        calculated = np.trunc((flights['arr_actual_utc'] - flights['arr_time_utc']).dt.total_seconds() / 60)
+        delays = pd.to_numeric(flights['delayed']).astype("Float64").fillna(calculated)
+        delays = delay_minutes(delays, errors="coerce")
+        # calculated delays out of range, e.g. of wrong actual times, are invalid too
+        invalid_delay = invalid_delay | (delays.isna() & calculated.notnull()).to_numpy()
+
+        # remove rows where we don't know if there is any delay or whose delay is invalid:
+        valid = delays.notnull().to_numpy() & ~invalid_delay
+        n_invalid_delay = int(invalid_delay.sum())
+        n_unknown_delay = len(flights) - int(valid.sum()) - n_invalid_delay
+        print(f"Deleted {n_unknown_delay} rows with unknown delay and {n_invalid_delay} rows with invalid delay of "
+              f"{len(flights)} rows:")
+        invalid_flights = flights[~valid]
         print(invalid_flights)
+        if incremental and os.path.isfile(self.INVALID_CSV):
+            invalid_flights = self.merge_invalid_flights(invalid_flights, flights[valid])
         invalid_flights.to_csv(self.INVALID_CSV, index=False)
-        self.etl_stats["missing_information"] = len(invalid_flights)
+        self.etl_stats["missing_information"] = n_unknown_delay
+        self.etl_stats["invalid_delay"] = n_invalid_delay
 
-        valid_flights.reset_index(drop=True, inplace=True)
-        flights = valid_flights.copy()
-
-        def calc_delay(row):
-            if math.isnan(float(row['delayed'])):
-                return int((row['arr_actual_utc'] - row['arr_time_utc']).total_seconds() / 60)
-            return row['delayed']
-        # calculate the delay in minutes and assign it to 'delayed' where it's missing
-        flights['delayed'] = flights.apply(calc_delay, axis=1)
+        flights = flights.assign(delayed=delays)[valid].reset_index(drop=True)
 
         print("Removing duplicates, keep the last duplicate which probably contains the most recent times")
         n_flights = len(flights)
-        flights.drop_duplicates(subset=["flight_iata", "dep_time_utc"],
+        flights.drop_duplicates(subset=FLIGHT_KEY,
                                 ignore_index=True, keep='last', inplace=True)
         n_duplicates = n_flights - len(flights)
         print(f"Removed {n_duplicates} duplicates")
@@ -218,6 +464,28 @@ class DelayHistoryProcessor:
 
         return flights
 
+    def merge_invalid_flights(self, invalid_flights: DataFrame, valid_flights: DataFrame):
+        """
+        The invalid flights of the earlier runs and of this run, once per flight number and departure time.
+        Flights which are valid now are removed.
+        """
+        header = pd.read_csv(self.INVALID_CSV, nrows=0).columns
+        existing = pd.read_csv(self.INVALID_CSV, parse_dates=[c for c in storage.DATE_COLUMNS if c in header])
+        merged = pd.concat([existing, invalid_flights], ignore_index=True)
+        merged.drop_duplicates(subset=FLIGHT_KEY, keep="last", ignore_index=True, inplace=True)
+        valid_keys = pd.MultiIndex.from_frame(valid_flights[FLIGHT_KEY])
+        return merged[~pd.MultiIndex.from_frame(merged[FLIGHT_KEY]).isin(valid_keys)]
+
+
+def _extract_transform_batch(archive: RawArchive, names):
+    """
+    Task of the ETL process pool: returns the transformed flights of the archived responses, the number of raw
+    records and the number of code-shared records
+    """
+    flights, n_total, n_codeshared = parse_raw_responses(archive.load(name) for name in names)
+    flights = DelayHistoryProcessor.transform_flights(flights)
+    return flights, n_total, n_codeshared
+
 
 def main():
     pd.set_option('display.max_columns', None)
@@ -226,27 +494,52 @@ def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("-m", "--mode", choices=["collect", "etl", "update"], required=True,
                             help="Execution mode"
-                                 "collect: request API for largest possible history and save to JSON files."
-                                 "etl: do ETL based on the JSON files."
-                                 "update: do 'collect' + 'etl' for the most recent unseen history.")
+                                 "collect: request API for largest possible history and save to the raw archive."
+                                 "etl: do ETL based on the raw archive."
+                                 "update: do 'collect' + 'etl' for the most recent unseen history and for days "
+                                 "which are missing from earlier collections.")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="Only process raw responses which are new or changed since the last ETL "
+                                 "(etl/update)")
+    arg_parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                            help="Storage of the ETL result: a single CSV file or a Parquet dataset partitioned by "
+                                 "departure month and airport")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="Number of concurrent API requests during collection and of worker processes "
+                                 "for extraction and transformation during ETL")
+    arg_parser.add_argument("--rps", type=float, default=5,
+                            help="Maximum number of API requests per second during collection")
+    arg_parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS,
+                            help="Days whose requests failed this many times are not requested again "
+                                 "(collect/update)")
+    add_metrics_arguments(arg_parser)
     args = arg_parser.parse_args()
     print(f"program arguments: {args}")
-    processor = DelayHistoryProcessor()
+    metrics = Metrics.from_args("delay_history", args)
+    processor = DelayHistoryProcessor(workers=args.workers, requests_per_second=args.rps,
+                                      output_format=args.format, metrics=metrics, max_attempts=args.max_attempts)
+    success = False
+    try:
+        run(processor, args)
+        success = True
+    finally:
+        metrics.write(success)
+
+
+def run(processor: DelayHistoryProcessor, args):
     if args.mode == "collect":
         # collect the maximum possible history
-        date_from = datetime.now() - relativedelta(years=1) + timedelta(days=1)
-        processor.collect_flights(date_from=date_from)
+        processor.collect_flights(date_from=processor.get_min_date())
     elif args.mode == "etl":
-        processor.etl_flights()
+        processor.etl_flights(incremental=args.incremental)
     elif args.mode == "update":
-        state = State.load_from_file()
-        if state.latest_date >= processor.get_max_date():
-            print(f"Already up to date (latest data from {state.latest_date})")
+        # new days and the gaps of earlier collections, and responses which an earlier run collected but didn't process,
+        # e.g. because its ETL failed
+        n_requests = processor.collect_flights(date_from=processor.get_min_date())
+        if n_requests == 0 and not processor.unprocessed_entries():
+            print("Already up to date")
             return
-
-        date_from = state.latest_date + relativedelta(days=1)
-        processor.collect_flights(date_from=date_from)
-        processor.etl_flights()
+        processor.etl_flights(incremental=args.incremental)
     else:
         print("NOTHING TO DO! Run with --help for information about this program.")
 
@@ -2,18 +2,30 @@ from argparse import ArgumentParser
 
 import pandas as pd
 
+import storage
 from config import config
 
 
 def main():
     arg_parser = ArgumentParser()
-    arg_parser.add_argument("FLIGHTS_CSV", help="Provide the CSV file containing the flight history")
+    arg_parser.add_argument("FLIGHTS_CSV", help="Provide the CSV file (or Parquet directory) containing the flight "
+                                                "history")
+    storage.add_filter_arguments(arg_parser)
+    storage.add_chunk_argument(arg_parser)
     args = arg_parser.parse_args()
     print(f"Program arguments: {args}")
-    flights = pd.read_csv(args.FLIGHTS_CSV)
-    airports_dep = flights["dep_iata"].drop_duplicates(ignore_index=True)
-    airports_arr = flights["arr_iata"].drop_duplicates(ignore_index=True)
-    airports = pd.concat([airports_dep, airports_arr], ignore_index=True).drop_duplicates(ignore_index=True)
+    columns = ["dep_iata", "arr_iata"]
+    if args.chunk_size:
+        chunks = storage.iter_flights(args.FLIGHTS_CSV, args.chunk_size, columns=columns,
+                                      **storage.filters_from_args(args))
+    else:
+        chunks = [storage.read_flights(args.FLIGHTS_CSV, columns=columns, **storage.filters_from_args(args))]
+    # airports in the order of their first departure, then the others in the order of their first arrival
+    airports_dep, airports_arr = {}, {}
+    for chunk in chunks:
+        airports_dep.update(dict.fromkeys(chunk["dep_iata"].drop_duplicates()))
+        airports_arr.update(dict.fromkeys(chunk["arr_iata"].drop_duplicates()))
+    airports = pd.Series(list(dict.fromkeys([*airports_dep, *airports_arr])), dtype=object)
     print(airports)
     airports.to_csv(f"{config.data_dir}/affected-airports.csv", index=False, header=False)
 
@@ -0,0 +1,276 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import requests
+import tenacity
+from requests.adapters import HTTPAdapter
+from tenacity import retry, stop_after_attempt
+
+import storage
+from config import config
+from constants import constants
+from delay_history import DelayHistoryProcessor, RateLimiter
+from metrics import Metrics, add_metrics_arguments
+from schema import apply_schema
+
+ENDPOINTS = ["schedules", "delays"]
+# fields of the airlabs schedule and delay records used for the target columns
+RECORD_FIELDS = ["flight_iata", "airline_iata", "cs_flight_iata", "dep_iata", "arr_iata", "dep_time_utc",
+                 "dep_actual_utc", "arr_time_utc", "arr_actual_utc", "arr_delayed", "delayed"]
+TIME_FIELDS = ["dep_time_utc", "dep_actual_utc", "arr_time_utc", "arr_actual_utc"]
+TEXT_FIELDS = ["flight_iata", "airline_iata", "cs_flight_iata", "dep_iata", "arr_iata"]
+# records per request, airlabs returns the further records of a request with the offset parameter
+PAGE_SIZE = 1000
+# stops the paging of a request which never returns a short page
+MAX_PAGES = 50
+# flights are identified like in the ETL's duplicate removal
+KEY_COLUMNS = ["flight_iata", "dep_time_utc"]
+
+
+class SeenIndex:
+    """
+    In-memory index of the flights already written, keyed by flight number and departure time, with a hash of
+    their values to detect changes. Memory is bounded: flights departing before the retention period are
+    forgotten, and the flights departing first are dropped when there are more than max_size entries.
+    """
+
+    def __init__(self, retention: pd.Timedelta, max_size: int):
+        self.retention = retention
+        self.max_size = max_size
+        # (flight_iata, departure in ns) -> row hash
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def new_or_changed(self, flights: pd.DataFrame):
+        """
+        Returns the flights which are not in the index or whose values changed, and records them
+        """
+        keys = list(zip(flights["flight_iata"].astype(str), flights["dep_time_utc"].to_numpy(dtype="datetime64[ns]")
+                        .astype(np.int64)))
+        hashes = row_hashes(flights)
+        selected = np.zeros(len(flights), dtype=bool)
+        for i, (key, value) in enumerate(zip(keys, hashes)):
+            if self.entries.get(key) != value:
+                self.entries[key] = value
+                selected[i] = True
+        return flights[selected]
+
+    def prune(self, now: pd.Timestamp):
+        cutoff = (now - self.retention).value
+        self.entries = {key: value for key, value in self.entries.items() if key[1] >= cutoff}
+        if len(self.entries) > self.max_size:
+            latest = sorted(self.entries, key=lambda key: key[1])[-self.max_size:]
+            self.entries = {key: self.entries[key] for key in latest}
+
+
+def row_hashes(flights: pd.DataFrame):
+    """
+    Hash of the target columns of every flight, independent of the dtypes they were parsed with, so that flights
+    read back from the delay file match the same flights from the API
+    """
+    normalized = pd.DataFrame({
+        column: (flights[column].to_numpy(dtype="datetime64[ns]").astype(np.int64) if column in TIME_FIELDS
+                 else pd.to_numeric(flights[column]).astype(np.float64) if column == "delayed"
+                 else flights[column].astype(str))
+        for column in constants.target_csv_columns
+    })
+    return pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+
+
+def is_transient(error: BaseException):
+    """
+    Whether a failed request is worth retrying: connection problems, rate limiting (429) and server errors (5xx)
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code == 429 or error.response.status_code >= 500)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def transform_records(records: list):
+    """
+    Converts airlabs schedule or delay records into the target columns of the flight history. Code-shared flights
+    and flights with an unknown delay are skipped, like in the ETL of the historical flights.
+    """
+    flights = pd.DataFrame.from_records(records, columns=RECORD_FIELDS)
+    # a field which is missing from all records is parsed as a float NaN column, which has no .str accessor
+    flights[TEXT_FIELDS] = flights[TEXT_FIELDS].astype(object)
+    flights = flights[flights["cs_flight_iata"].isnull() & flights["flight_iata"].notnull()]
+    for column in TIME_FIELDS:
+        flights[column] = pd.to_datetime(flights[column], format="ISO8601", errors="coerce")
+    delays = pd.to_numeric(flights["arr_delayed"].fillna(flights["delayed"]), errors="coerce")
+    # calculated like in the ETL's clean_flights
+    calculated = np.trunc((flights["arr_actual_utc"] - flights["arr_time_utc"]).dt.total_seconds() / 60)
+    flights["delayed"] = delays.fillna(calculated)
+    flights = flights[flights["delayed"].notnull() & flights["dep_time_utc"].notnull()]
+
+    transformed = pd.DataFrame({column: flights[column] for column in constants.target_csv_columns
+                                if column in flights}).reset_index(drop=True)
+    transformed["arr_iata"] = transformed["arr_iata"].str.upper()
+    transformed["dep_iata"] = transformed["dep_iata"].str.upper()
+    transformed = DelayHistoryProcessor.add_country_codes(transformed)
+    transformed["domestic"] = transformed["arr_country_code"] == transformed["dep_country_code"]
+    transformed["international"] = ~transformed["domestic"]
+    transformed = apply_schema(transformed[constants.target_csv_columns])
+    # the same flight is returned for its departure and its arrival airport and by both endpoints
+    transformed = transformed.drop_duplicates(subset=KEY_COLUMNS, keep="last")
+    return transformed.sort_values(by="dep_time_utc", kind="stable", ignore_index=True)
+
+
+class DelayPoller:
+    """
+    Polls the airlabs schedules and delays of all airports concurrently every interval and appends the new or
+    changed flights to the delay file
+    """
+
+    def __init__(self, airports: list, output: str, endpoints: list = ENDPOINTS, min_delay: int = 15,
+                 workers: int = 4, requests_per_second: float = 5, retention_hours: float = 48,
+                 max_index_size: int = 200_000, page_size: int = PAGE_SIZE, metrics: Metrics = None):
+        self.airports = airports
+        self.output = output
+        self.endpoints = endpoints
+        self.min_delay = min_delay
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.index = SeenIndex(pd.Timedelta(hours=retention_hours), max_index_size)
+        self.page_size = page_size
+        self.metrics = metrics or Metrics("get_delays")
+        self.http = self.metrics.http_stats("airlabs")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def load_index(self):
+        """
+        Fills the index with the flights of the retention period which are already in the delay file, so that a
+        restarted poller doesn't append them again
+        """
+        if not os.path.exists(self.output):
+            return
+        date_from = pd.Timestamp.now(tz="UTC").tz_localize(None) - self.index.retention
+        flights = storage.read_flights(self.output, columns=constants.target_csv_columns, date_from=date_from)
+        self.index.new_or_changed(flights.drop_duplicates(subset=KEY_COLUMNS, keep="last"))
+        print(f"Loaded {len(self.index)} known flights from {self.output}")
+
+    def request_urls(self):
+        """
+        Yields the URL of every request of a polling cycle: each endpoint for departures and arrivals per airport
+        """
+        for airport in self.airports:
+            for endpoint in self.endpoints:
+                for direction, field in [("departures", "dep_iata"), ("arrivals", "arr_iata")]:
+                    params = f"delay={self.min_delay}&type={direction}&" if endpoint == "delays" else ""
+                    yield f"{config.airlabs_url}/{endpoint}?{params}{field}={airport}&api_key={config.api_key}"
+
+    @retry(stop=stop_after_attempt(3), wait=tenacity.wait_exponential(multiplier=1, max=10),
+           retry=tenacity.retry_if_exception(is_transient),
+           before_sleep=lambda retry_state: retry_state.args[0].http.retry())
+    def do_request(self, url: str):
+        self.rate_limiter.acquire()
+        with self.http.timed():
+            response = self.session.get(url, timeout=10)
+            response.raise_for_status()
+            return response.json()
+
+    def fetch(self, url: str):
+        """
+        Returns the records of all pages of a request. A failed page ends the request with the records of the
+        pages before it.
+        """
+        records = []
+        for page in range(MAX_PAGES):
+            try:
+                data = self.do_request(f"{url}&limit={self.page_size}&offset={page * self.page_size}")
+            except Exception as e:
+                # the message of an HTTP error contains the URL with the key
+                print(f"Request to {url} failed: {e}".replace(config.api_key, "***"))
+                break
+            if "error" in data:
+                print(f"Request to {url.replace(config.api_key, '***')} failed: {data['error']}")
+                break
+            page_records = data.get("response") or []
+            records += page_records
+            if len(page_records) < self.page_size:
+                break
+        return records
+
+    def poll(self):
+        """
+        Runs one polling cycle and returns the number of fetched records and of appended flights
+        """
+        with self.metrics.stage("poll") as stage:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                responses = list(executor.map(self.fetch, self.request_urls()))
+            records = [record for response in responses for record in response]
+            flights = transform_records(records)
+            changed = self.index.new_or_changed(flights)
+            storage.append_flights(changed, self.output)
+            self.index.prune(pd.Timestamp.now(tz="UTC").tz_localize(None))
+            stage.rows_in, stage.rows_out = len(records), len(changed)
+            stage.extra["index_size"] = len(self.index)
+        return len(records), len(changed)
+
+    def run(self, interval: float, cycles: int = None):
+        """
+        Polls every interval seconds, measured from the start of each cycle, until cycles are done (forever if
+        None)
+        """
+        self.load_index()
+        cycle = 0
+        next_start = time.monotonic()
+        while cycles is None or cycle < cycles:
+            start = time.monotonic()
+            n_records, n_appended = self.poll()
+            # the metrics files always show the latest cycle, the HTTP counters grow over all cycles
+            self.metrics.write()
+            self.metrics.stages.clear()
+            cycle += 1
+            print(f"{datetime.now():%Y-%m-%d %H:%M:%S} cycle {cycle}: {n_records} records, appended {n_appended} "
+                  f"new or changed flights to {self.output}, {len(self.index)} flights in the index "
+                  f"({time.monotonic() - start:.1f}s)")
+            next_start += interval
+            if cycles is None or cycle < cycles:
+                time.sleep(max(0.0, next_start - time.monotonic()))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Polls current flight delays from the airlabs API and appends "
+                                                     "new or changed flights to the delay file")
+    arg_parser.add_argument("--output", default=config.delay_file,
+                            help="CSV file (or Parquet directory) the flights are appended to")
+    arg_parser.add_argument("--airports", default=",".join(DelayHistoryProcessor.AIRPORTS),
+                            help="Comma-separated IATA codes of the polled airports")
+    arg_parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    arg_parser.add_argument("--interval", type=float, default=900, help="Seconds between the polling cycles")
+    arg_parser.add_argument("--cycles", type=int, help="Stop after this number of cycles (default: run forever)")
+    arg_parser.add_argument("--min-delay", type=int, default=15,
+                            help="Minimum delay in minutes of the flights returned by the delays endpoint")
+    arg_parser.add_argument("--workers", type=int, default=4, help="Number of concurrent API requests")
+    arg_parser.add_argument("--page-size", type=int, default=PAGE_SIZE,
+                            help="Records per request, further records are requested page by page")
+    arg_parser.add_argument("--rps", type=float, default=5, help="Maximum number of API requests per second")
+    arg_parser.add_argument("--retention-hours", type=float, default=48,
+                            help="Flights departing longer ago are removed from the in-memory index")
+    arg_parser.add_argument("--max-index-size", type=int, default=200_000,
+                            help="Maximum number of flights in the in-memory index")
+    add_metrics_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    print(f"program arguments: {args}")
+    poller = DelayPoller(args.airports.split(","), args.output, args.endpoints, args.min_delay, args.workers,
+                         args.rps, args.retention_hours, args.max_index_size, args.page_size,
+                         Metrics.from_args("get_delays", args))
+    try:
+        poller.run(args.interval, args.cycles)
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+if __name__ == '__main__':
+    main()
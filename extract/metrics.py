@@ -0,0 +1,289 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+
+import numpy as np
+
+from config import config
+
+METRICS_DIR = f"{config.data_dir}/metrics"
+LATENCY_QUANTILES = [0.5, 0.9, 0.99]
+
+
+def path_size(path: str):
+    """
+    Size in bytes of a file or of all files of a directory (e.g. a Parquet dataset), 0 if it doesn't exist
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+class PeakRss:
+    """
+    Samples the resident set size of the process in a background thread, as the peak RSS reported by the OS
+    (ru_maxrss) only grows and can't be attributed to a stage
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def current_mb():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def __enter__(self):
+        self.peak = self.current_mb()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.current_mb())
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current_mb())
+            time.sleep(self.interval)
+
+
+@dataclass
+class StageMetrics:
+    """
+    Measurements of one stage. rows_* and bytes_* are set by the stage itself where they are known.
+    cpu_s is the CPU time of the whole process, including worker threads.
+    """
+    name: str
+    rows_in: int = None
+    rows_out: int = None
+    bytes_read: int = None
+    bytes_written: int = None
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_mb: float = 0.0
+    rss_delta_mb: float = 0.0
+    error: str = None
+    extra: dict = field(default_factory=dict)
+
+
+class HttpStats:
+    """
+    Thread-safe counters and latencies of the requests of a client. Only the latest max_samples latencies are kept
+    for the quantiles, so a long-running collector has bounded memory.
+    """
+
+    def __init__(self, max_samples: int = 10_000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=max_samples)
+
+    def observe(self, seconds: float, ok: bool = True):
+        with self.lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.latency_sum += seconds
+            self.latencies.append(seconds)
+
+    def retry(self, n: int = 1):
+        with self.lock:
+            self.retries += n
+
+    @contextmanager
+    def timed(self):
+        """
+        Measures the request in the block, it counts as an error if the block raises
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.observe(time.perf_counter() - start, ok)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            return {"requests": self.requests, "errors": self.errors, "retries": self.retries,
+                    "latency_sum_s": self.latency_sum,
+                    "latency_quantiles_s": {str(q): float(np.quantile(latencies, q)) if len(latencies) else None
+                                            for q in LATENCY_QUANTILES}}
+
+
+class Metrics:
+    """
+    Collects the stage measurements and HTTP statistics of a job (a script run) and writes them to
+    <metrics_dir>/<job>.json, <metrics_dir>/<job>-runs.jsonl (one line per run) and to a Prometheus textfile
+    <metrics_dir>/<job>.prom. The stage named by `profile` is run under cProfile ("cpu") or tracemalloc ("memory").
+    """
+
+    def __init__(self, job: str, metrics_dir: str = METRICS_DIR, profile: str = None, profiler: str = "cpu"):
+        self.job = job
+        self.metrics_dir = metrics_dir
+        self.profile = profile
+        self.profiler = profiler
+        self.started = time.time()
+        self.stages = []
+        self.http = {}
+
+    @staticmethod
+    def from_args(job: str, args):
+        return Metrics(job, args.metrics_dir, args.profile, args.profiler)
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None, bytes_read: int = None):
+        """
+        Measures the block as a stage. The yielded StageMetrics can be completed with rows_out, bytes_written etc.
+        """
+        stage = StageMetrics(name=name, rows_in=rows_in, bytes_read=bytes_read)
+        rss_before = PeakRss.current_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            with PeakRss() as rss, self._profiled(name):
+                yield stage
+        except BaseException as e:
+            stage.error = repr(e)
+            raise
+        finally:
+            stage.wall_s = time.perf_counter() - wall_start
+            stage.cpu_s = time.process_time() - cpu_start
+            stage.peak_rss_mb = rss.peak
+            stage.rss_delta_mb = rss.peak - rss_before
+            self.stages.append(stage)
+            print(f"[metrics] {self.job}/{name}: {stage.wall_s:.2f}s wall, {stage.cpu_s:.2f}s CPU, "
+                  f"peak RSS {stage.peak_rss_mb:.0f} MB (+{stage.rss_delta_mb:.0f} MB)"
+                  + (f", {stage.rows_in} rows in" if stage.rows_in is not None else "")
+                  + (f", {stage.rows_out} rows out" if stage.rows_out is not None else ""))
+
+    def http_stats(self, client: str):
+        return self.http.setdefault(client, HttpStats())
+
+    def to_dict(self, success: bool = True):
+        return {"job": self.job, "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                "duration_s": time.time() - self.started, "success": success,
+                "stages": [asdict(stage) for stage in self.stages],
+                "http": {client: stats.summary() for client, stats in self.http.items()}}
+
+    def write(self, success: bool = True):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        data = self.to_dict(success)
+        json_file = os.path.join(self.metrics_dir, f"{self.job}.json")
+        _write_atomic(json_file, json.dumps(data, indent=2, default=str))
+        with open(os.path.join(self.metrics_dir, f"{self.job}-runs.jsonl"), "a") as f:
+            f.write(json.dumps(data, default=str) + "\n")
+        # the node exporter's textfile collector must never see a partially written file
+        _write_atomic(os.path.join(self.metrics_dir, f"{self.job}.prom"), self.prometheus(data))
+        print(f"Wrote metrics to {json_file}")
+
+    def prometheus(self, data: dict):
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list):
+            # samples are (name suffix, labels, value), e.g. ("_sum", {...}, 1.5) of a summary
+            samples = [(suffix, labels, value) for suffix, labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{key}="{v}"' for key, v in {"job": self.job, **labels}.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {float(value)!r}")
+
+        metric("pipeline_run_success", "gauge", "1 if the last run succeeded", [("", {}, int(data["success"]))])
+        metric("pipeline_run_timestamp_seconds", "gauge", "Start of the last run", [("", {}, self.started)])
+        metric("pipeline_run_duration_seconds", "gauge", "Duration of the last run", [("", {}, data["duration_s"])])
+        for name, key, help_text in [
+            ("wall_seconds", "wall_s", "Wall time of the stage"),
+            ("cpu_seconds", "cpu_s", "CPU time of the process during the stage"),
+            ("peak_rss_megabytes", "peak_rss_mb", "Peak resident memory during the stage"),
+            ("rows_in", "rows_in", "Rows read by the stage"),
+            ("rows_out", "rows_out", "Rows produced by the stage"),
+            ("read_bytes", "bytes_read", "Bytes read by the stage"),
+            ("written_bytes", "bytes_written", "Bytes written by the stage"),
+        ]:
+            metric(f"pipeline_stage_{name}", "gauge", help_text,
+                   [("", {"stage": stage["name"]}, stage[key]) for stage in data["stages"]])
+        http = data["http"].items()
+        metric("pipeline_http_requests_total", "counter", "HTTP requests",
+               [("", {"client": c}, s["requests"]) for c, s in http])
+        metric("pipeline_http_errors_total", "counter", "Failed HTTP requests",
+               [("", {"client": c}, s["errors"]) for c, s in http])
+        metric("pipeline_http_retries_total", "counter", "Retried HTTP requests",
+               [("", {"client": c}, s["retries"]) for c, s in http])
+        metric("pipeline_http_request_duration_seconds", "summary", "Latency of the HTTP requests",
+               [("", {"client": c, "quantile": q}, v) for c, s in http for q, v in s["latency_quantiles_s"].items()]
+               + [("_sum", {"client": c}, s["latency_sum_s"]) for c, s in http]
+               + [("_count", {"client": c}, s["requests"]) for c, s in http])
+        return "\n".join(lines) + "\n"
+
+    @contextmanager
+    def _profiled(self, name: str):
+        if name != self.profile:
+            yield
+            return
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        base = os.path.join(self.metrics_dir, f"{self.job}-{name}")
+        if self.profiler == "memory":
+            tracemalloc.start(25)
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                with open(f"{base}-tracemalloc.txt", "w") as f:
+                    f.write(f"current {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB\n")
+                    for statistic in snapshot.statistics("traceback")[:30]:
+                        f.write(f"\n{statistic}\n" + "\n".join(statistic.traceback.format()) + "\n")
+                print(f"Wrote memory profile of {name} to {base}-tracemalloc.txt")
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{base}.prof")
+            with open(f"{base}-profile.txt", "w") as f:
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+            print(f"Wrote CPU profile of {name} to {base}.prof")
+
+
+def add_metrics_arguments(arg_parser: ArgumentParser):
+    arg_parser.add_argument("--metrics-dir", default=METRICS_DIR,
+                            help="Directory of the metrics JSON and Prometheus textfile")
+    arg_parser.add_argument("--profile", metavar="STAGE", help="Profile this stage")
+    arg_parser.add_argument("--profiler", choices=["cpu", "memory"], default="cpu",
+                            help="cpu: cProfile dump (.prof and a text summary), memory: tracemalloc top allocations")
+
+
+def _write_atomic(path: str, text: str):
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(text)
+    os.replace(tmp_file, path)
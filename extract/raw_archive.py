@@ -0,0 +1,231 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+
+from config import config
+
+ARCHIVE_FILE = f"{config.data_dir}/history/flightsHistory_raw.sqlite"
+# directory of the former raw files, one JSON file per request
+RAW_DATA_DIR = f"{config.data_dir}/history/flightsHistory_raw"
+# zlib level 6 compresses the JSON responses about 12x, decompression is much faster than parsing the JSON
+COMPRESSION_LEVEL = 6
+ENTRY_COLUMNS = "name, airport, type, date_from, date_to, collected, size, stored_size, sha256"
+
+
+@dataclass
+class RawEntry:
+    """
+    Index entry of an archived response. The name is the one of the former raw file, so that ETL manifests
+    written before the migration stay valid.
+    """
+    name: str
+    airport: str
+    type: str
+    date_from: str
+    date_to: str
+    collected: str
+    size: int
+    stored_size: int
+    sha256: str
+
+
+def entry_name(airport: str, t: str, d_from: str, d_to: str):
+    return f"{d_from}_{d_to}_{airport}_{t}.json"
+
+
+def parse_entry_name(name: str):
+    """
+    Returns (airport, type, date_from, date_to) of a raw file name, None if the name doesn't have this form
+    """
+    if not name.endswith(".json"):
+        return None
+    parts = name[:-len(".json")].split("_")
+    if len(parts) != 4:
+        return None
+    d_from, d_to, airport, t = parts
+    return airport, t, d_from, d_to
+
+
+class RawArchive:
+    """
+    Archive of the raw Aviation Edge responses in a single SQLite file. Responses are only added, a response which
+    is collected again replaces the former one as a whole. Every response is stored zlib-compressed with an index
+    entry of its airport, type and date range, so existence checks and the selection of responses are index lookups
+    which don't read the compressed bodies.
+    The archive can be shared by threads; worker processes open their own archive of the same path.
+    """
+
+    def __init__(self, path: str = ARCHIVE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            # the body is the last column, so reading index entries never touches its overflow pages
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    name TEXT PRIMARY KEY, airport TEXT NOT NULL, type TEXT NOT NULL, date_from TEXT NOT NULL,
+                    date_to TEXT NOT NULL, collected TEXT NOT NULL, size INTEGER NOT NULL,
+                    stored_size INTEGER NOT NULL, sha256 TEXT NOT NULL, body BLOB NOT NULL);
+                CREATE INDEX IF NOT EXISTS responses_range ON responses (airport, type, date_from, date_to);
+            """)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __contains__(self, name: str):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM responses WHERE name = ?", (name,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def put(self, airport: str, t: str, d_from: str, d_to: str, data=None, raw: bytes = None,
+            collected: str = None, commit: bool = True):
+        """
+        Stores a response, given as parsed JSON `data` or as the `raw` bytes of a former raw file. A response of
+        the same airport, type and date range replaces the stored one. Returns its RawEntry.
+        """
+        if raw is None:
+            raw = json.dumps(data).encode()
+        body = zlib.compress(raw, COMPRESSION_LEVEL)
+        entry = RawEntry(name=entry_name(airport, t, d_from, d_to), airport=airport, type=t, date_from=d_from,
+                         date_to=d_to, collected=collected or datetime.now().isoformat(timespec="seconds"),
+                         size=len(raw), stored_size=len(body), sha256=hashlib.sha256(raw).hexdigest())
+        with self.lock:
+            self.connection.execute(f"INSERT OR REPLACE INTO responses ({ENTRY_COLUMNS}, body) "
+                                    f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (*entry.__dict__.values(), body))
+            if commit:
+                self.connection.commit()
+        return entry
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def entries(self, airports=None, types=None, date_from: str = None, date_to: str = None):
+        """
+        Index entries ordered by name (like the sorted raw files), optionally only of the given airports and types
+        and of date ranges which overlap [date_from, date_to] (dates as YYYY-MM-DD)
+        """
+        conditions, params = [], []
+        for column, values in [("airport", airports), ("type", types)]:
+            if values is not None:
+                values = list(values)
+                conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params += values
+        if date_from is not None:
+            conditions.append("date_to >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append("date_from <= ?")
+            params.append(date_to)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {ENTRY_COLUMNS} FROM responses{where} ORDER BY name",
+                                           params).fetchall()
+        return [RawEntry(*row) for row in rows]
+
+    def load_bytes(self, name: str):
+        with self.lock:
+            row = self.connection.execute("SELECT body FROM responses WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(f"{name} is not in {self.path}")
+        return zlib.decompress(row[0])
+
+    def load(self, name: str):
+        """
+        Returns the parsed JSON response of an entry
+        """
+        return json.loads(self.load_bytes(name))
+
+
+def migrate(raw_dir: str, archive: RawArchive, delete: bool = False, batch_size: int = 100):
+    """
+    Moves the raw JSON files of raw_dir into the archive. Files which are already archived with the same content
+    are skipped, files whose name has not the form <from>_<to>_<airport>_<type>.json are left in place.
+    With `delete` the files are removed after their batch is committed. Returns the number of archived files.
+    """
+    names = sorted(f for f in os.listdir(raw_dir) if f.endswith(".json"))
+    known = {entry.name: entry.sha256 for entry in archive.entries()}
+    n_archived, n_bytes, n_stored = 0, 0, 0
+    migrated = []
+    for name in names:
+        key = parse_entry_name(name)
+        if key is None:
+            print(f"Skipping {name}, the name doesn't have the form <from>_<to>_<airport>_<type>.json")
+            continue
+        raw_file = os.path.join(raw_dir, name)
+        with open(raw_file, "rb") as f:
+            raw = f.read()
+        if known.get(name) != hashlib.sha256(raw).hexdigest():
+            collected = datetime.fromtimestamp(os.path.getmtime(raw_file)).isoformat(timespec="seconds")
+            entry = archive.put(*key, raw=raw, collected=collected, commit=False)
+            n_archived += 1
+            n_bytes += entry.size
+            n_stored += entry.stored_size
+        migrated.append(raw_file)
+        if len(migrated) >= batch_size:
+            _finish_batch(archive, migrated, delete)
+    _finish_batch(archive, migrated, delete)
+    print(f"Archived {n_archived} of {len(names)} raw files ({n_bytes / 1e6:.1f} MB, "
+          f"{n_stored / 1e6:.1f} MB compressed) in {archive.path}")
+    return n_archived
+
+
+def _finish_batch(archive: RawArchive, raw_files: list, delete: bool):
+    archive.commit()
+    if delete:
+        for raw_file in raw_files:
+            os.remove(raw_file)
+    raw_files.clear()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Archive of the raw flight history responses")
+    arg_parser.add_argument("-m", "--mode", choices=["migrate", "list"], required=True,
+                            help="migrate: move the JSON files of a raw directory into the archive. "
+                                 "list: show the archived responses.")
+    arg_parser.add_argument("--archive", default=ARCHIVE_FILE, help="SQLite file of the archive")
+    arg_parser.add_argument("--raw-dir", default=RAW_DATA_DIR, help="Directory of the raw JSON files (migrate)")
+    arg_parser.add_argument("--delete", action="store_true", help="Delete the raw files after archiving (migrate)")
+    arg_parser.add_argument("--airports", nargs="+", help="Only responses of these airports (list)")
+    arg_parser.add_argument("--date-from", help="Only responses ending on or after this date, YYYY-MM-DD (list)")
+    arg_parser.add_argument("--date-to", help="Only responses starting on or before this date, YYYY-MM-DD (list)")
+    args = arg_parser.parse_args()
+
+    archive = RawArchive(args.archive)
+    if args.mode == "migrate":
+        migrate(args.raw_dir, archive, args.delete)
+    else:
+        entries = archive.entries(airports=args.airports, date_from=args.date_from, date_to=args.date_to)
+        for entry in entries:
+            print(f"{entry.name}  {entry.size / 1e3:10.1f} kB  {entry.stored_size / 1e3:8.1f} kB  {entry.collected}")
+        print(f"{len(entries)} responses, {sum(e.size for e in entries) / 1e6:.1f} MB, "
+              f"{sum(e.stored_size for e in entries) / 1e6:.1f} MB compressed")
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
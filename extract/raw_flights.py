@@ -0,0 +1,130 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# fields of the raw Aviation Edge records used by the ETL, named like the columns of pd.json_normalize
+RAW_FIELDS = ["flight.iataNumber", "airline.iataCode",
+              "departure.iataCode", "departure.scheduledTime", "departure.actualTime",
+              "arrival.iataCode", "arrival.scheduledTime", "arrival.actualTime", "arrival.delay"]
+RAW_TIME_FIELDS = ["departure.scheduledTime", "departure.actualTime", "arrival.scheduledTime", "arrival.actualTime"]
+# number of buffered time strings which are parsed at once
+TIME_CHUNK_SIZE = 100_000
+
+
+class CategoryColumn:
+    """
+    Dictionary-encodes values while parsing: every distinct value is stored once, rows only keep an int32 code
+    """
+
+    def __init__(self):
+        self.categories = {}
+        self.codes = array('i')
+
+    def append(self, value):
+        self.codes.append(-1 if value is None else self.categories.setdefault(value, len(self.categories)))
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        codes = np.frombuffer(self.codes, dtype=np.int32) if len(self.codes) else np.empty(0, dtype=np.int32)
+        return pd.Categorical.from_codes(codes, categories=list(self.categories))
+
+
+class TimeColumn:
+    """
+    Buffers time strings and parses them in chunks into datetime64 arrays
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.chunks = []
+
+    def append(self, value):
+        self.buffer.append(value)
+
+    def flush(self):
+        if len(self.buffer) >= TIME_CHUNK_SIZE:
+            self._parse_buffer()
+
+    def finish(self):
+        self._parse_buffer()
+        return pd.DatetimeIndex(np.concatenate(self.chunks)) if self.chunks else pd.DatetimeIndex([])
+
+    def _parse_buffer(self):
+        if self.buffer:
+            self.chunks.append(to_datetime(self.buffer).to_numpy())
+            self.buffer = []
+
+
+def parse_raw_records(records, columns: dict):
+    """
+    Appends the RAW_FIELDS of all records of a raw response to the column builders and skips code-shared flights.
+    Returns the number of records and the number of skipped code-shared records.
+    """
+    if isinstance(records, dict):
+        records = [records]
+
+    paths = [(columns[field], *field.split(".")) for field in RAW_FIELDS]
+    n_codeshared = 0
+    for record in records:
+        codeshared = record.get("codeshared")
+        if isinstance(codeshared, dict) and (codeshared.get("flight") or {}).get("number") is not None:
+            n_codeshared += 1
+            continue
+        for column, group, name in paths:
+            section = record.get(group)
+            column.append(section.get(name) if isinstance(section, dict) else None)
+    for column in columns.values():
+        column.flush()
+    return len(records), n_codeshared
+
+
+def parse_raw_responses(responses):
+    """
+    Parses raw responses (parsed JSON, e.g. loaded one by one from the raw archive) into a DataFrame with the
+    RAW_FIELDS columns: times as datetime64, all other fields as categoricals. Memory is bounded by these compact
+    columns plus one response.
+    Returns the DataFrame, the number of records and the number of skipped code-shared records.
+    """
+    columns = {field: TimeColumn() if field in RAW_TIME_FIELDS else CategoryColumn() for field in RAW_FIELDS}
+    n_total = 0
+    n_codeshared = 0
+    for records in responses:
+        n_response, n_response_codeshared = parse_raw_records(records, columns)
+        n_total += n_response
+        n_codeshared += n_response_codeshared
+
+    flights = pd.DataFrame({field: column.finish() for field, column in columns.items()})
+    return flights, n_total, n_codeshared
+
+
+def concat_flights(chunks):
+    """
+    Concatenates flight chunks in order. Categorical columns are merged with union_categoricals, so they stay
+    categoricals although each chunk has its own categories.
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = {}
+    for column in chunks[0].columns:
+        parts = [chunk[column] for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[column] = union_categoricals([part.array for part in parts])
+        else:
+            columns[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def to_datetime(values):
+    """
+    Aviation Edge times look like '2023-10-05t06:00:00.000'. With an upper case 'T' they can be parsed by the
+    fast ISO 8601 parser, other formats fall back to the inferring parser.
+    """
+    values = pd.Series(values, dtype=object)
+    try:
+        return pd.to_datetime(values.str.upper(), format="ISO8601")
+    except ValueError:
+        return pd.to_datetime(values)
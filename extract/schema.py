@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_datetime64_dtype, is_integer_dtype
+
+# times are UTC without time zone, like the *_utc names say
+TIME_DTYPE = "datetime64[ns]"
+# delay in minutes, nullable: -32768 to 32767 minutes cover more than 3 weeks
+DELAY_DTYPE = "Int16"
+# dtypes of the flight history columns in the order of constants.target_csv_columns, codes are categoricals
+FLIGHT_DTYPES = {
+    "flight_iata": "category",
+    "airline_iata": "category",
+    "dep_time_utc": TIME_DTYPE,
+    "dep_actual_utc": TIME_DTYPE,
+    "arr_time_utc": TIME_DTYPE,
+    "arr_actual_utc": TIME_DTYPE,
+    "dep_iata": "category",
+    "arr_iata": "category",
+    "dep_country_code": "category",
+    "arr_country_code": "category",
+    "domestic": "bool",
+    "international": "bool",
+    "delayed": DELAY_DTYPE,
+}
+TIME_COLUMNS = [c for c, dtype in FLIGHT_DTYPES.items() if dtype == TIME_DTYPE]
+
+
+def csv_dtypes(columns):
+    """
+    dtype argument of pd.read_csv for the schema columns among `columns`. Times are parsed with parse_dates, and
+    delays are converted afterwards, as older files store them as floats.
+    """
+    return {c: FLIGHT_DTYPES[c] for c in columns if c in FLIGHT_DTYPES and FLIGHT_DTYPES[c] == "category"}
+
+
+def delay_minutes(values, errors: str = "raise"):
+    """
+    Converts delays (numbers or the API's numeric strings) to DELAY_DTYPE. Values which are not numbers, not whole
+    minutes or out of range raise a ValueError, or with errors="coerce" become missing, like the API's records are
+    read at the ingest boundary.
+    """
+    values = pd.to_numeric(pd.Series(values, copy=False), errors=errors)
+    numbers = values.astype("Int64") if is_integer_dtype(values.dtype) else values.astype("Float64")
+    info = np.iinfo(np.int16)
+    fractional = (numbers % 1 != 0).fillna(False)
+    out_of_range = ((numbers < info.min) | (numbers > info.max)).fillna(False)
+    if errors == "coerce":
+        numbers = numbers.mask(fractional | out_of_range)
+    elif fractional.any():
+        raise ValueError("delays must be whole minutes")
+    elif out_of_range.any():
+        raise ValueError(f"delays must be between {info.min} and {info.max} minutes")
+    return numbers.astype(DELAY_DTYPE)
+
+
+def apply_schema(flights: pd.DataFrame):
+    """
+    Returns the flights with the FLIGHT_DTYPES of the schema columns it has; other columns are kept as they are.
+    Columns which already have their dtype are not converted again.
+    """
+    converted = {}
+    for column, dtype in FLIGHT_DTYPES.items():
+        if column not in flights or _has_dtype(flights[column], dtype):
+            continue
+        values = flights[column]
+        if dtype == DELAY_DTYPE:
+            converted[column] = delay_minutes(values)
+        elif dtype == TIME_DTYPE:
+            # parsed times only change their unit, pd.to_datetime would inspect them again
+            times = values if is_datetime64_dtype(values.dtype) else pd.to_datetime(values)
+            converted[column] = times.astype(TIME_DTYPE)
+        elif dtype == "bool":
+            if values.isnull().any():
+                raise ValueError(f"{column} must not be missing")
+            converted[column] = values.astype(bool)
+        else:
+            converted[column] = values.astype(dtype)
+    return flights.assign(**converted) if converted else flights
+
+
+def validate(flights: pd.DataFrame, required: bool = False):
+    """
+    Checks the dtypes of the schema columns, and with `required` that all of them are present. Only the dtypes
+    are compared, so the check is independent of the number of flights.
+    """
+    errors = [f"{column}: {flights[column].dtype} instead of {dtype}" for column, dtype in FLIGHT_DTYPES.items()
+              if column in flights and not _has_dtype(flights[column], dtype)]
+    if required:
+        errors += [f"{column}: missing" for column in FLIGHT_DTYPES if column not in flights]
+    if errors:
+        raise ValueError(f"Flights don't match the schema: {', '.join(errors)}")
+    return flights
+
+
+def _has_dtype(values: pd.Series, dtype: str):
+    if dtype == "category":
+        return isinstance(values.dtype, pd.CategoricalDtype)
+    if dtype == "bool":
+        return is_bool_dtype(values.dtype) and not isinstance(values.dtype, pd.BooleanDtype)
+    return values.dtype == dtype
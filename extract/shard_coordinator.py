@@ -0,0 +1,122 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import storage
+from config import config
+from coverage_ledger import MAX_ATTEMPTS
+from delay_history import FLIGHT_KEY, DelayHistoryProcessor, run
+from metrics import Metrics, add_metrics_arguments, path_size
+from shards import Shard, parse_shards
+
+
+def run_shard(shard: Shard, args):
+    """
+    Task of the coordinator's process pool: collects and/or transforms the history of one shard like
+    delay_history.py does for the unsharded history. Returns the path of the shard's result and whether the ETL
+    wrote it in this run.
+    """
+    metrics = Metrics(f"delay_history-{shard.name}", args.metrics_dir, args.profile, args.profiler)
+    processor = DelayHistoryProcessor(workers=args.workers, requests_per_second=args.shard_rps,
+                                      output_format=args.format, metrics=metrics, max_attempts=args.max_attempts,
+                                      shard=shard)
+    # every ETL run which writes the result also writes its statistics
+    modified = _modified(processor.ETL_STATS_JSON)
+    success = False
+    try:
+        print(f"[{shard.name}] {args.mode} of {len(shard.airports)} airports in {shard.directory}")
+        run(processor, args)
+        success = True
+    finally:
+        metrics.write(success)
+    return processor.result_path, _modified(processor.ETL_STATS_JSON) != modified
+
+
+def merge_shards(result_paths: list, output_path: str, metrics: Metrics):
+    """
+    Concatenates the results of the shards in shard order and writes them sorted by departure time like the
+    result of the unsharded ETL. A flight between airports of two shards is in the results of both shards if both
+    collected it; it is only kept once, in the version of the later shard.
+    Returns the merged flights.
+    """
+    with metrics.stage("merge", bytes_read=sum(path_size(p) for p in result_paths)) as stage:
+        shard_flights = [storage.read_flights(path).drop(columns="Row", errors="ignore") for path in result_paths]
+        flights = pd.concat(shard_flights, ignore_index=True)
+        stage.rows_in = len(flights)
+        flights.drop_duplicates(subset=FLIGHT_KEY, keep="last", ignore_index=True, inplace=True)
+        print(f"Merged {len(result_paths)} shards: {stage.rows_in} flights, removed {stage.rows_in - len(flights)} "
+              f"flights which were collected by more than one shard")
+        flights.sort_values(by="dep_time_utc", ascending=True, kind="stable", inplace=True, ignore_index=True)
+        flights.index.name = "Row"
+        storage.write_flights(flights, output_path)
+        stage.rows_out = len(flights)
+        stage.bytes_written = path_size(output_path)
+    return flights
+
+
+def _modified(path: str):
+    if not os.path.exists(path):
+        return None
+    return os.path.getmtime(path)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Collects and transforms the flight history of several shards "
+                                                     "(countries or sets of airports) in parallel worker processes "
+                                                     "and merges their results")
+    arg_parser.add_argument("-m", "--mode", choices=["collect", "etl", "update"], required=True,
+                            help="Mode of delay_history.py which is run for every shard. The results are merged "
+                                 "after etl and after an update which collected new flights.")
+    arg_parser.add_argument("--shards", nargs="+", default=[config.country],
+                            help="Country codes (e.g. VN TH KH) or named sets of airports (e.g. north=HAN,HPH)")
+    arg_parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                            help="Number of shards which are processed in parallel")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="Only process raw responses which are new or changed since the last ETL of the "
+                                 "shard (etl/update)")
+    arg_parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                            help="Storage of the shard results and of the merged result")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="Concurrent API requests and ETL processes per shard")
+    arg_parser.add_argument("--rps", type=float, default=5,
+                            help="Maximum number of API requests per second of all shards together")
+    arg_parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS,
+                            help="Days whose requests failed this many times are not requested again "
+                                 "(collect/update)")
+    add_metrics_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    print(f"program arguments: {args}")
+
+    shards = parse_shards(args.shards)
+    jobs = max(1, min(args.jobs, len(shards)))
+    # the request budget is shared by the shards which run at the same time
+    args.shard_rps = args.rps / jobs
+    if args.format == "parquet":
+        output_path = DelayHistoryProcessor.RESULT_PARQUET
+    else:
+        output_path = DelayHistoryProcessor.RESULT_CSV
+    metrics = Metrics.from_args("shard_coordinator", args)
+    success = False
+    try:
+        start = time.time()
+        with metrics.stage("shards", rows_in=len(shards)) as stage:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(run_shard, shards, [args] * len(shards)))
+            stage.rows_out = sum(1 for _, written in results if written)
+        print(f"Finished {args.mode} of {len(shards)} shards with {jobs} processes in {time.time() - start:.1f}s")
+
+        result_paths = [path for path, _ in results if os.path.exists(path)]
+        if args.mode != "collect" and result_paths and (any(written for _, written in results)
+                                                         or not os.path.exists(output_path)):
+            merge_shards(result_paths, output_path, metrics)
+            print(f"Wrote the merged result to {output_path}")
+        success = True
+    finally:
+        metrics.write(success)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+from dataclasses import dataclass
+
+from airport_index import AirportIndex
+from config import config
+
+SHARDS_DIR = f"{config.data_dir}/history/shards"
+# airports with an available history per country, shards of other countries get all airports of the airport index
+KNOWN_AIRPORTS = {
+    # all civil airports in Vietnam:
+    "VN": ["HAN", "SGN", "BMV", "CXR", "VCA", "HPH", "VCL", "VCS", "DAD", "DIN", "VDH", "TBB", "DLI", "HUI", "UIH",
+           "PQC", "PXU", "THD", "VII"],
+}
+
+
+@dataclass
+class Shard:
+    """
+    A country or a set of airports whose history is collected and transformed independently of the other shards:
+    it has its own raw archive, coverage ledger, ETL manifest and result in <SHARDS_DIR>/<name>, with the file
+    names of the unsharded history
+    """
+    name: str
+    airports: list
+
+    @property
+    def directory(self):
+        return os.path.join(SHARDS_DIR, self.name)
+
+    def path(self, file_name: str):
+        return os.path.join(self.directory, file_name)
+
+
+def country_shard(country: str, airport_index: AirportIndex = None):
+    airports = KNOWN_AIRPORTS.get(country)
+    if airports is None:
+        airports = (airport_index or AirportIndex.load()).airports_of_country(country)
+    if not airports:
+        raise ValueError(f"No airports of the country {country} in the airport index")
+    return Shard(name=country, airports=list(airports))
+
+
+def parse_shards(specs, airport_index: AirportIndex = None):
+    """
+    Shards of specifications like "VN" (a country code) or "north=HAN,HPH,VDO" (a named set of airports)
+    """
+    shards = []
+    for spec in specs:
+        if "=" in spec:
+            name, airports = spec.split("=", 1)
+            shards.append(Shard(name=name, airports=[a.strip().upper() for a in airports.split(",") if a.strip()]))
+        else:
+            shards.append(country_shard(spec.upper(), airport_index))
+    names = [shard.name for shard in shards]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Shard names must be unique: {', '.join(duplicates)}")
+    return shards
@@ -0,0 +1,290 @@
+import os
+import shutil
+import time
+from argparse import ArgumentParser
+
+import pandas as pd
+from pandas import DataFrame
+
+from schema import TIME_COLUMNS, apply_schema, csv_dtypes, validate
+
+DATE_COLUMNS = TIME_COLUMNS
+# directory levels of the partitioned storage: <path>/month=2023-01/airport=HAN/part-0.parquet
+PARTITION_COLUMNS = ["month", "airport"]
+# floats are parsed exactly, so that reading and writing a CSV again doesn't change them in the last digit
+FLOAT_PRECISION = "round_trip"
+# rows per chunk when flights are read in chunks
+CHUNK_SIZE = 100_000
+# format of the times in CSV files. pandas would otherwise choose it per column from the values (dates only if all
+# times are at midnight), so a file written in chunks could differ from the same flights written at once.
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def is_partitioned(path: str):
+    """
+    CSV files are read and written as before, every other path is a Parquet dataset directory
+    """
+    return not path.endswith(".csv") and not path.endswith(".csv.gz")
+
+
+def read_flights(path: str, columns=None, date_from=None, date_to=None, airports=None):
+    """
+    Reads flights from a CSV file or a partitioned Parquet dataset, with the dtypes of the schema.
+
+    :param columns: only load these columns (all if None)
+    :param date_from: only flights with dep_time_utc >= date_from
+    :param date_to: only flights with dep_time_utc < date_to
+    :param airports: only flights departing from one of these IATA codes
+    """
+    if is_partitioned(path):
+        return apply_schema(_read_parquet(path, columns, date_from, date_to, airports))
+
+    usecols = None
+    if columns is not None:
+        usecols = list(dict.fromkeys(list(columns)
+                                     + (["dep_time_utc"] if date_from or date_to else [])
+                                     + (["dep_iata"] if airports is not None else [])))
+    header = pd.read_csv(path, nrows=0).columns
+    parse_dates = [c for c in DATE_COLUMNS if c in header and (usecols is None or c in usecols)]
+    flights = pd.read_csv(path, usecols=usecols, parse_dates=parse_dates, dtype=csv_dtypes(header),
+                          float_precision=FLOAT_PRECISION)
+    flights = flights[_row_filter(flights, date_from, date_to, airports)]
+    if columns is not None:
+        flights = flights[list(columns)]
+    return apply_schema(flights.reset_index(drop=True))
+
+
+def iter_flights(path: str, chunk_size: int = CHUNK_SIZE, columns=None, date_from=None, date_to=None,
+                 airports=None):
+    """
+    Reads flights from a CSV file or a partitioned Parquet dataset in chunks of at most chunk_size rows, in the
+    order of read_flights and with its filters, so that the chunks concatenated are the flights of read_flights.
+    Memory is bounded by one chunk, for a Parquet dataset by one month, as its flights are sorted by the
+    departure time month by month. At least one (possibly empty) chunk is returned.
+    """
+    if is_partitioned(path):
+        n_chunks = 0
+        for month in _months(path, date_from, date_to):
+            flights = apply_schema(_read_parquet(path, columns, date_from, date_to, airports, month))
+            for start in range(0, len(flights), chunk_size):
+                n_chunks += 1
+                yield flights.iloc[start:start + chunk_size].reset_index(drop=True)
+        if not n_chunks:
+            yield read_flights(path, columns, date_from, date_to, airports)
+        return
+
+    usecols = None
+    if columns is not None:
+        usecols = list(dict.fromkeys(list(columns)
+                                     + (["dep_time_utc"] if date_from or date_to else [])
+                                     + (["dep_iata"] if airports is not None else [])))
+    header = pd.read_csv(path, nrows=0).columns
+    parse_dates = [c for c in DATE_COLUMNS if c in header and (usecols is None or c in usecols)]
+    n_chunks, empty = 0, None
+    for chunk in pd.read_csv(path, usecols=usecols, parse_dates=parse_dates, dtype=csv_dtypes(header),
+                             chunksize=chunk_size, float_precision=FLOAT_PRECISION):
+        chunk = chunk[_row_filter(chunk, date_from, date_to, airports)]
+        if columns is not None:
+            chunk = chunk[list(columns)]
+        if len(chunk):
+            n_chunks += 1
+            yield apply_schema(chunk.reset_index(drop=True))
+        else:
+            empty = chunk
+    if not n_chunks:
+        # the columns of a file without (matching) flights
+        yield apply_schema(empty.reset_index(drop=True)) if empty is not None else read_flights(path, columns)
+
+
+def write_flights(flights: DataFrame, path: str, overwrite_all: bool = True):
+    """
+    Writes flights to a CSV file or a Parquet dataset partitioned by departure month and departure airport, with
+    the dtypes of the schema. A CSV file gets an index column only if the index is named (like the "Row" column
+    of the ETL result).
+
+    :param overwrite_all: if False, only the partitions contained in flights are replaced and all other
+                          partitions of the dataset are kept
+    """
+    flights = validate(apply_schema(flights))
+    if not is_partitioned(path):
+        flights.to_csv(path, index=flights.index.name is not None, date_format=DATE_FORMAT)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if overwrite_all and os.path.isdir(path):
+        shutil.rmtree(path)
+    flights = flights.reset_index(drop=True)
+    months, airports = _partition_keys(flights)
+    for (month, airport), partition in flights.groupby([months, airports], sort=False):
+        partition_dir = os.path.join(path, f"month={month}", f"airport={airport}")
+        # a replaced partition also loses the parts appended by append_flights
+        if os.path.isdir(partition_dir):
+            shutil.rmtree(partition_dir)
+        os.makedirs(partition_dir)
+        table = pa.Table.from_pandas(partition, preserve_index=False)
+        pq.write_table(table, os.path.join(partition_dir, "part-0.parquet"))
+
+
+def append_flights(flights: DataFrame, path: str):
+    """
+    Appends flights to a CSV file (with a header if it is new) or adds them as new part files to the partitions
+    of a Parquet dataset, without reading the existing flights
+    """
+    if len(flights) == 0:
+        return
+    flights = validate(apply_schema(flights))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if not is_partitioned(path):
+        flights.to_csv(path, mode="a", header=not os.path.exists(path), index=False, date_format=DATE_FORMAT)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    flights = flights.reset_index(drop=True)
+    months, airports = _partition_keys(flights)
+    part = f"part-{time.time_ns()}.parquet"
+    for (month, airport), partition in flights.groupby([months, airports], sort=False):
+        partition_dir = os.path.join(path, f"month={month}", f"airport={airport}")
+        os.makedirs(partition_dir, exist_ok=True)
+        pq.write_table(pa.Table.from_pandas(partition, preserve_index=False), os.path.join(partition_dir, part))
+
+
+def write_flight_chunks(chunks, path: str):
+    """
+    Writes chunks of flights, e.g. of iter_flights, to a CSV file or a partitioned Parquet dataset while they are
+    produced, so that memory is bounded by one chunk. A CSV file is byte-identical to write_flights of the
+    concatenated chunks and only replaces an existing file when all chunks are written. A Parquet dataset gets
+    one part file per chunk and partition instead of one per partition. Returns the number of written flights.
+    """
+    n_flights = 0
+    if not is_partitioned(path):
+        tmp_file = f"{path}.tmp"
+        for i, chunk in enumerate(chunks):
+            chunk = validate(apply_schema(chunk))
+            chunk.to_csv(tmp_file, mode="w" if i == 0 else "a", header=i == 0,
+                         index=chunk.index.name is not None, date_format=DATE_FORMAT)
+            n_flights += len(chunk)
+        os.replace(tmp_file, path)
+        return n_flights
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    for i, chunk in enumerate(chunks):
+        chunk = validate(apply_schema(chunk)).reset_index(drop=True)
+        months, airports = _partition_keys(chunk)
+        for (month, airport), partition in chunk.groupby([months, airports], sort=False):
+            partition_dir = os.path.join(path, f"month={month}", f"airport={airport}")
+            os.makedirs(partition_dir, exist_ok=True)
+            table = pa.Table.from_pandas(partition, preserve_index=False)
+            pq.write_table(table, os.path.join(partition_dir, f"part-{i}.parquet"))
+        n_flights += len(chunk)
+    return n_flights
+
+
+def with_suffix(path: str, suffix: str):
+    """
+    Appends a suffix to the file name, e.g. flightsHistory.csv -> flightsHistory-holidays.csv
+    """
+    for ext in [".csv.gz", ".csv", ".parquet"]:
+        if path.endswith(ext):
+            return f"{path[:-len(ext)]}{suffix}{ext}"
+    return f"{path}{suffix}"
+
+
+def add_filter_arguments(arg_parser: ArgumentParser):
+    arg_parser.add_argument("--date-from", help="Only process flights departing at or after this date (yyyy-mm-dd)")
+    arg_parser.add_argument("--date-to", help="Only process flights departing before this date (yyyy-mm-dd)")
+    arg_parser.add_argument("--airports", help="Only process flights departing from these airports (e.g. HAN,SGN)")
+
+
+def add_chunk_argument(arg_parser: ArgumentParser):
+    arg_parser.add_argument("--chunk-size", type=int,
+                            help=f"Stream the flights in chunks of this many rows (e.g. {CHUNK_SIZE}), so that "
+                                 f"memory doesn't grow with the number of flights. The result is the same.")
+
+
+def filters_from_args(args):
+    return {
+        "date_from": args.date_from,
+        "date_to": args.date_to,
+        "airports": args.airports.split(",") if args.airports else None,
+    }
+
+
+def _dataset(path):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([("month", pa.string()), ("airport", pa.string())]), flavor="hive")
+    return ds.dataset(path, format="parquet", partitioning=partitioning)
+
+
+def _months(path, date_from, date_to):
+    """
+    Months of the partitions of a Parquet dataset which may contain flights between date_from and date_to
+    """
+    months = sorted(d.split("=", 1)[1] for d in os.listdir(path) if d.startswith("month="))
+    if date_from:
+        months = [m for m in months if m >= pd.Timestamp(date_from).strftime("%Y-%m")]
+    if date_to:
+        months = [m for m in months if m <= pd.Timestamp(date_to).strftime("%Y-%m")]
+    return months
+
+
+def _read_parquet(path, columns, date_from, date_to, airports, month=None):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = _dataset(path)
+    file_columns = [c for c in dataset.schema.names if c not in PARTITION_COLUMNS]
+
+    # partition keys prune whole directories, the dep_time_utc bounds prune row groups by their statistics
+    expression = None
+    time_type = dataset.schema.field("dep_time_utc").type
+    if date_from:
+        date_from = pd.Timestamp(date_from)
+        expression = _and(expression, ds.field("month") >= date_from.strftime("%Y-%m"))
+        expression = _and(expression, ds.field("dep_time_utc") >= pa.scalar(date_from.to_pydatetime(), time_type))
+    if date_to:
+        date_to = pd.Timestamp(date_to)
+        expression = _and(expression, ds.field("month") <= date_to.strftime("%Y-%m"))
+        expression = _and(expression, ds.field("dep_time_utc") < pa.scalar(date_to.to_pydatetime(), time_type))
+    if airports is not None:
+        expression = _and(expression, ds.field("airport").isin(list(airports)))
+    if month is not None:
+        expression = _and(expression, ds.field("month") == month)
+
+    table = dataset.to_table(columns=list(columns) if columns is not None else file_columns, filter=expression)
+    flights = table.to_pandas()
+    if "dep_time_utc" in flights:
+        flights.sort_values(by="dep_time_utc", kind="stable", inplace=True, ignore_index=True)
+    return flights
+
+
+def _row_filter(flights, date_from, date_to, airports):
+    mask = pd.Series(True, index=flights.index)
+    if date_from:
+        mask &= flights["dep_time_utc"] >= pd.Timestamp(date_from)
+    if date_to:
+        mask &= flights["dep_time_utc"] < pd.Timestamp(date_to)
+    if airports is not None:
+        mask &= flights["dep_iata"].isin(list(airports))
+    return mask
+
+
+def _and(expression, other):
+    return other if expression is None else expression & other
+
+
+def _partition_keys(flights):
+    months = flights["dep_time_utc"].dt.strftime("%Y-%m").fillna("unknown")
+    airports = flights["dep_iata"].astype(object).fillna("unknown")
+    return months, airports
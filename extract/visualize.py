@@ -1,21 +1,71 @@
+import os
+import sys
+from argparse import ArgumentParser
+
 import matplotlib.pyplot as plt
-import pandas as pd
 
-if __name__ == '__main__':
-    df = pd.read_csv("data/history/flightsHistory_2022-10-18_to_2023-10-15.csv")
-    df = df.groupby(['airline_iata']).size().sort_values(ascending=True).reset_index(name='counts')
-    df.set_index('airline_iata', inplace=True)
+from config import config
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rollup"))
+from delay_cube import DelayCube  # noqa: E402
+
+PLOTS = ["airlines", "airports", "hours", "months", "holidays"]
 
-# Calculate the percentage for each category
+
+def plot_airlines(cube: DelayCube, where: dict):
+    df = cube.query(["airline"], where, quantiles=[])[["flights"]].rename(columns={"flights": "counts"})
+    df = df.sort_values("counts")
+
+    # Calculate the percentage for each category
     df['percentage'] = df['counts'] / df['counts'].sum() * 100
 
-    # Create a new DataFrame with only the categories above 1% and "others"
+    # Create a new DataFrame with only the categories above the threshold and "others"
     threshold = 3
     df_filtered = df[df['percentage'] >= threshold].copy()
     df_filtered.loc['others'] = df[df['percentage'] < threshold].sum()
 
-    df_filtered.info()
     print(df_filtered)
-    ax = df_filtered.plot(kind='pie', y='counts', autopct='%1.1f%%', startangle=90, legend='', ylabel='')
+    df_filtered.plot(kind='pie', y='counts', autopct='%1.1f%%', startangle=90, legend='', ylabel='')
     plt.title("Split of airlines in the dataset")
+
+
+def plot_delays(cube: DelayCube, by: str, where: dict, title: str, top: int = None):
+    df = cube.query([by], where)
+    if top:
+        df = df.nlargest(top, "flights").sort_index()
+    print(df)
+    if by in ["hour", "month"]:
+        ax = df[["mean", "p50", "p90"]].plot(kind="line", marker="o")
+    else:
+        ax = df[["mean", "p50", "p90"]].plot(kind="bar")
+    ax.set_ylabel("delay (min)")
+    plt.title(title)
+
+
+def main():
+    arg_parser = ArgumentParser(description="Plots the flights and delays of the flight history from its delay cube")
+    arg_parser.add_argument("FLIGHTS_CSV", nargs="?", default=f"{config.data_dir}/history/flightsHistory.csv",
+                            help="CSV file (or Parquet directory) of the flights")
+    arg_parser.add_argument("--plots", nargs="+", choices=PLOTS, default=PLOTS, help="Plots to show")
+    arg_parser.add_argument("--date-from", help="Only flights departing at or after this date (yyyy-mm-dd)")
+    arg_parser.add_argument("--date-to", help="Only flights departing before this date (yyyy-mm-dd)")
+    args = arg_parser.parse_args()
+
+    cube = DelayCube.open(args.FLIGHTS_CSV)
+    where = {"day": (args.date_from, args.date_to)} if args.date_from or args.date_to else {}
+    for plot in args.plots:
+        if plot == "airlines":
+            plot_airlines(cube, where)
+        elif plot == "airports":
+            plot_delays(cube, "dep", where, "Delay by departure airport (20 busiest)", top=20)
+        elif plot == "hours":
+            plot_delays(cube, "hour", where, "Delay by departure hour (UTC)")
+        elif plot == "months":
+            plot_delays(cube, "month", where, "Delay by month")
+        else:
+            plot_delays(cube, "holiday", where, "Delay on and outside of holidays")
     plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+import ast
+import hashlib
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+# the stage scripts resolve their files relative to the data directory, which is ../data from extract/
+os.environ.setdefault("DATA_DIR", os.path.join(ROOT_DIR, "data"))
+MODULE_DIRS = ["extract", "add-holidays", "add-weather", "add-congestion"]
+for module_dir in MODULE_DIRS:
+    sys.path.append(os.path.join(ROOT_DIR, module_dir))
+import storage  # noqa: E402
+from add_holidays import add_holidays  # noqa: E402
+from airport_index import AIRPORTS_JSON, AirportIndex  # noqa: E402
+from config import config  # noqa: E402
+from delay_history import DelayHistoryProcessor  # noqa: E402
+from holiday_calendar import HOLIDAYS_DIR  # noqa: E402
+from inbound_legs import INPUT_COLUMNS as INBOUND_INPUT_COLUMNS, compute_features as inbound_features  # noqa: E402
+from rolling_features import INPUT_COLUMNS as CONGESTION_INPUT_COLUMNS, compute_features  # noqa: E402
+from weather_store import WeatherStore, add_weather  # noqa: E402
+
+CACHE_DIR = f"{config.data_dir}/pipeline-cache"
+WEATHER_CSV = f"{config.data_dir}/weather.csv.gz"
+OUTPUT_CSV = f"{config.data_dir}/history/flightsHistory-weather.csv"
+HOLIDAY_INPUT_COLUMNS = ["arr_time_utc", "arr_iata", "dep_time_utc", "dep_iata"]
+WEATHER_INPUT_COLUMNS = HOLIDAY_INPUT_COLUMNS
+
+
+@dataclass
+class Stage:
+    """
+    A step of the pipeline. `run` is called with the DataFrames of the stages in `depends_on` and returns a
+    DataFrame. The stage is skipped and its result read from the cache if its fingerprint is unchanged: the
+    fingerprint covers the contents of `inputs` (files or directories), the source files in `code`, `params`
+    and the fingerprints of the upstream stages.
+    """
+    name: str
+    run: Callable
+    depends_on: list = field(default_factory=list)
+    inputs: list = field(default_factory=list)
+    code: list = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    # files written by the stage, it is run again if one of them is missing
+    outputs: list = field(default_factory=list)
+
+
+class FileHashes:
+    """
+    SHA-256 of input files, remembered with their size and modification time so that unchanged files are not
+    hashed again on the next run
+    """
+
+    def __init__(self, hashes_file: str):
+        self.hashes_file = hashes_file
+        self.hashes = {}
+        if os.path.isfile(hashes_file):
+            with open(hashes_file) as f:
+                self.hashes = json.load(f)
+
+    def file_hash(self, path: str):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            return known["sha256"]
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        self.hashes[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+        return sha256.hexdigest()
+
+    def path_hash(self, path: str):
+        """
+        Hash of a file, or of the names and hashes of all files below a directory. Missing paths hash to "missing".
+        """
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return "missing"
+        sha256 = hashlib.sha256()
+        for directory, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                file = os.path.join(directory, name)
+                sha256.update(f"{os.path.relpath(file, path)}:{self.file_hash(file)}\n".encode())
+        return sha256.hexdigest()
+
+    def save(self):
+        with open(self.hashes_file, "w") as f:
+            json.dump(self.hashes, f)
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order and passes their DataFrames in memory. Stages whose dependencies are
+    complete run concurrently in threads. Results are cached as pickles in `cache_dir`, which keep the dtypes.
+    """
+
+    def __init__(self, stages: list, cache_dir: str = CACHE_DIR, force: bool = False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.force = force
+        os.makedirs(cache_dir, exist_ok=True)
+        self.file_hashes = FileHashes(os.path.join(cache_dir, "file-hashes.json"))
+
+    def levels(self):
+        """
+        Groups the stages into levels, each stage only depends on stages of earlier levels
+        """
+        done = set()
+        levels = []
+        while len(done) < len(self.stages):
+            level = [name for name, stage in self.stages.items()
+                     if name not in done and all(d in done for d in stage.depends_on)]
+            if not level:
+                raise RuntimeError(f"Stages with missing or cyclic dependencies: {set(self.stages) - done}")
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    def fingerprint(self, stage: Stage, upstream: dict):
+        sha256 = hashlib.sha256(stage.name.encode())
+        for path in stage.code:
+            sha256.update(f"code:{os.path.basename(path)}:{self.file_hashes.file_hash(path)}\n".encode())
+        for path in stage.inputs:
+            sha256.update(f"input:{os.path.abspath(path)}:{self.file_hashes.path_hash(path)}\n".encode())
+        sha256.update(f"params:{json.dumps(stage.params, sort_keys=True, default=str)}\n".encode())
+        for name in stage.depends_on:
+            sha256.update(f"upstream:{name}:{upstream[name]}\n".encode())
+        return sha256.hexdigest()[:16]
+
+    def cache_file(self, name: str, fingerprint: str):
+        return os.path.join(self.cache_dir, f"{name}-{fingerprint}.pkl")
+
+    def run(self, target: str):
+        """
+        Runs all stages which the target depends on and returns the target's DataFrame
+        """
+        levels = self.levels()
+        fingerprints = {}
+        cached = {}
+        for level in levels:
+            for name in level:
+                stage = self.stages[name]
+                fingerprints[name] = self.fingerprint(stage, fingerprints)
+                cached[name] = (not self.force and os.path.isfile(self.cache_file(name, fingerprints[name]))
+                                and all(os.path.exists(output) for output in stage.outputs))
+        self.file_hashes.save()
+
+        # walk back from the target: cached stages are read from the cache, their dependencies are not needed
+        needed = {target}
+        for level in reversed(levels):
+            for name in level:
+                if name in needed and not cached[name]:
+                    needed.update(self.stages[name].depends_on)
+
+        results = {}
+        finished = set()
+        for level in levels:
+            level = [name for name in level if name in needed]
+            with ThreadPoolExecutor(max_workers=max(1, len(level))) as executor:
+                futures = {name: executor.submit(self._run_stage, self.stages[name], fingerprints[name],
+                                                 cached[name], results) for name in level}
+                for name, future in futures.items():
+                    results[name] = future.result()
+            finished.update(level)
+            # free results which no remaining stage needs
+            for name in list(results):
+                if name != target and not any(name in self.stages[n].depends_on
+                                              for n in needed - finished):
+                    del results[name]
+        return results[target]
+
+    def _run_stage(self, stage: Stage, fingerprint: str, cached: bool, results: dict):
+        cache_file = self.cache_file(stage.name, fingerprint)
+        start = time.time()
+        if cached:
+            result = pd.read_pickle(cache_file)
+            print(f"[{stage.name}] unchanged, read {len(result)} rows from the cache ({time.time() - start:.1f}s)")
+            return result
+
+        print(f"[{stage.name}] running")
+        result = stage.run(*[results[name] for name in stage.depends_on])
+        for old_file in os.listdir(self.cache_dir):
+            if old_file.startswith(f"{stage.name}-") and old_file.endswith(".pkl"):
+                os.remove(os.path.join(self.cache_dir, old_file))
+        tmp_file = f"{cache_file}.tmp"
+        result.to_pickle(tmp_file)
+        os.replace(tmp_file, cache_file)
+        print(f"[{stage.name}] done, {len(result)} rows ({time.time() - start:.1f}s)")
+        return result
+
+
+def source_file(module_dir: str, name: str):
+    return os.path.join(ROOT_DIR, module_dir, name)
+
+
+def module_files(*paths: str):
+    """
+    The source files and the files of all modules of MODULE_DIRS which they import, directly or through other
+    modules, so that a stage runs again when any code it uses changes
+    """
+    files = set()
+    pending = list(paths)
+    while pending:
+        path = pending.pop()
+        if path in files:
+            continue
+        files.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                candidates = [source_file(d, f"{name.split('.')[0]}.py") for d in MODULE_DIRS]
+                pending += [file for file in candidates if os.path.isfile(file)]
+    return sorted(files)
+
+
+def build_stages(args):
+    processor = DelayHistoryProcessor(workers=args.workers, output_format=args.format)
+
+    def etl():
+        flights = processor.etl_flights()
+        if flights is None:
+            raise RuntimeError(f"No flights in {processor.archive.path}")
+        return flights
+
+    def holidays(flights):
+        features = add_holidays(flights[HOLIDAY_INPUT_COLUMNS].copy(), AirportIndex.load())
+        return features.drop(columns=HOLIDAY_INPUT_COLUMNS)
+
+    def weather(flights):
+        features = add_weather(flights[WEATHER_INPUT_COLUMNS].copy(), WeatherStore.open(args.weather),
+                               args.interpolation)
+        return features.drop(columns=WEATHER_INPUT_COLUMNS)
+
+    def congestion(flights):
+        return compute_features(flights[CONGESTION_INPUT_COLUMNS], pd.Timedelta(hours=args.window_hours))
+
+    def inbound(flights):
+        return inbound_features(flights[INBOUND_INPUT_COLUMNS], pd.Timedelta(hours=args.turnaround_hours))
+
+    def merge(flights, *features):
+        flights = pd.concat([flights, *features], axis=1)
+        storage.write_flights(flights, args.output)
+        print(f"Wrote result to {args.output}")
+        return flights
+
+    stages = [Stage(name="etl", run=etl, inputs=[processor.archive.path, AIRPORTS_JSON],
+                    code=module_files(source_file("extract", "delay_history.py")), outputs=[processor.result_path])]
+    if "holidays" in args.stages:
+        stages.append(Stage(name="holidays", run=holidays, depends_on=["etl"],
+                            # the files the holiday calendar and the airport index actually read
+                            inputs=[HOLIDAYS_DIR, AIRPORTS_JSON],
+                            code=module_files(source_file("add-holidays", "add_holidays.py"))))
+    if "weather" in args.stages:
+        stages.append(Stage(name="weather", run=weather, depends_on=["etl"], inputs=[args.weather],
+                            code=module_files(source_file("add-weather", "weather_store.py")),
+                            params={"interpolation": args.interpolation}))
+    if "congestion" in args.stages:
+        stages.append(Stage(name="congestion", run=congestion, depends_on=["etl"],
+                            code=module_files(source_file("add-congestion", "rolling_features.py")),
+                            params={"window_hours": args.window_hours}))
+    if "inbound" in args.stages:
+        stages.append(Stage(name="inbound", run=inbound, depends_on=["etl"],
+                            code=module_files(source_file("add-congestion", "inbound_legs.py")),
+                            params={"turnaround_hours": args.turnaround_hours}))
+    stages.append(Stage(name="merge", run=merge, depends_on=["etl"] + list(args.stages),
+                        code=module_files(source_file("extract", "storage.py")), params={"output": args.output},
+                        outputs=[args.output]))
+    return processor, stages
+
+
+def main():
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.width', None)
+    pd.set_option('display.max_rows', 20)
+    arg_parser = ArgumentParser(description="Runs ETL, holiday, weather, congestion and inbound leg enrichment in one "
+                                            "process. "
+                                            "Stages whose inputs and code are unchanged are read from the cache.")
+    arg_parser.add_argument("--update", action="store_true",
+                            help="Collect the most recent unseen history and missing days from the API before the ETL")
+    arg_parser.add_argument("--stages", nargs="*", choices=["holidays", "weather", "congestion", "inbound"],
+                            default=["holidays", "weather", "congestion", "inbound"],
+                            help="Enrichment stages whose columns are merged into the result")
+    arg_parser.add_argument("--weather", default=WEATHER_CSV, help="CSV file of weather reports")
+    arg_parser.add_argument("--interpolation", choices=["round", "nearest", "linear"], default="round",
+                            help="How flight times are matched to the hourly weather, see add-weather-from-existing.py")
+    arg_parser.add_argument("--window-hours", type=int, default=3,
+                            help="Window of recent delays of the congestion features, see add_congestion.py")
+    arg_parser.add_argument("--turnaround-hours", type=int, default=6,
+                            help="Longest time between the inbound leg and the departure, see add_inbound.py")
+    arg_parser.add_argument("--output", default=OUTPUT_CSV, help="Output CSV file (or Parquet directory)")
+    arg_parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                            help="Storage of the ETL result, see delay_history.py")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="Number of worker processes for the ETL and concurrent API requests for --update")
+    arg_parser.add_argument("--force", action="store_true", help="Run all stages, ignoring the cache")
+    args = arg_parser.parse_args()
+    if "weather" in args.stages and not os.path.isfile(args.weather):
+        arg_parser.error(f"the weather file {args.weather} does not exist: collect it with add-weather/get-weather.py, "
+                         f"pass another file with --weather or leave the weather stage out of --stages")
+    print(f"program arguments: {args}")
+
+    processor, stages = build_stages(args)
+    if args.update:
+        processor.collect_flights(date_from=processor.get_min_date())
+
+    start = time.time()
+    flights = Pipeline(stages, force=args.force).run("merge")
+    print(flights)
+    print(f"Pipeline finished in {time.time() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# the modules of extract/, add-holidays/ and add-weather/ resolve their files relative to the data directory,
+# which is ../data from extract/
+os.environ.setdefault("DATA_DIR", os.path.join(ROOT_DIR, "data"))
+# the package is imported before any of its modules, so they import the modules of these directories directly
+for module_dir in ["extract", "add-holidays", "add-weather"]:
+    sys.path.append(os.path.join(ROOT_DIR, module_dir))
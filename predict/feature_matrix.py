@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.compose import ColumnTransformer
+
+from predict.features import FEATURE_VERSION, available_columns, feature_frame, make_preprocessing, target
+from predict.model import MODELS_DIR
+
+# one directory per dataset fingerprint
+FEATURES_DIR = f"{MODELS_DIR}/features"
+
+
+def dataset_fingerprint(path: str, **options):
+    """
+    Hash of the contents of a flights file (or all files of a Parquet directory), the feature version and the
+    options which select and split the flights
+    """
+    sha256 = hashlib.sha256(f"{FEATURE_VERSION}:{json.dumps(options, sort_keys=True, default=str)}".encode())
+    files = [path] if os.path.isfile(path) else sorted(os.path.join(directory, name)
+                                                       for directory, _, names in os.walk(path) for name in names)
+    for file in files:
+        sha256.update(f"{os.path.relpath(file, path)}\n".encode())
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+    return sha256.hexdigest()[:16]
+
+
+@dataclass
+class FeatureMatrix:
+    """
+    Encoded features of flights with a known delay, sorted by departure time. The first n_train rows are used for
+    training and cross-validation, the rest is held out. The preprocessing is fitted on the training rows once;
+    the cross-validation folds share it, which is harmless for the tree models (imputed medians and the one-hot
+    vocabulary) and avoids encoding the flights per fold and configuration.
+    """
+    X: object
+    y: np.ndarray
+    times: np.ndarray
+    n_train: int
+    columns: list
+    preprocessing: ColumnTransformer
+    fingerprint: str
+
+    @staticmethod
+    def build(flights: pd.DataFrame, holdout: float, fingerprint: str):
+        flights = flights[target(flights).notnull()]
+        flights = flights.sort_values(by="dep_time_utc", kind="stable", ignore_index=True)
+        n_train = int(len(flights) * (1 - holdout))
+        features = feature_frame(flights)
+        columns = available_columns(features.iloc[:n_train])
+        preprocessing = make_preprocessing(columns).fit(features.iloc[:n_train])
+        # the forest works on float32, so the matrix is stored as float32 as well
+        X = preprocessing.transform(features).astype(np.float32)
+        return FeatureMatrix(X=scipy.sparse.csr_matrix(X) if scipy.sparse.issparse(X) else X,
+                             y=target(flights).to_numpy(dtype=np.float64),
+                             times=flights["dep_time_utc"].to_numpy(dtype="datetime64[ns]"),
+                             n_train=n_train, columns=columns, preprocessing=preprocessing, fingerprint=fingerprint)
+
+    def save(self, features_dir: str = FEATURES_DIR):
+        matrix_dir = os.path.join(features_dir, self.fingerprint)
+        tmp_dir = f"{matrix_dir}.tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        if scipy.sparse.issparse(self.X):
+            scipy.sparse.save_npz(os.path.join(tmp_dir, "X.npz"), self.X, compressed=False)
+        else:
+            np.save(os.path.join(tmp_dir, "X.npy"), self.X)
+        np.save(os.path.join(tmp_dir, "y.npy"), self.y)
+        np.save(os.path.join(tmp_dir, "times.npy"), self.times)
+        joblib.dump(self.preprocessing, os.path.join(tmp_dir, "preprocessing.joblib"))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"n_train": self.n_train, "columns": self.columns}, f, indent=2)
+        if os.path.isdir(matrix_dir):
+            shutil.rmtree(matrix_dir)
+        os.replace(tmp_dir, matrix_dir)
+
+    @staticmethod
+    def load(fingerprint: str, features_dir: str = FEATURES_DIR):
+        """
+        Returns the cached matrix of the fingerprint, None if there is none
+        """
+        matrix_dir = os.path.join(features_dir, fingerprint)
+        if not os.path.isfile(os.path.join(matrix_dir, "meta.json")):
+            return None
+        with open(os.path.join(matrix_dir, "meta.json")) as f:
+            meta = json.load(f)
+        sparse_file = os.path.join(matrix_dir, "X.npz")
+        X = (scipy.sparse.load_npz(sparse_file) if os.path.isfile(sparse_file)
+             else np.load(os.path.join(matrix_dir, "X.npy"), mmap_mode="r"))
+        return FeatureMatrix(X=X, y=np.load(os.path.join(matrix_dir, "y.npy")),
+                             times=np.load(os.path.join(matrix_dir, "times.npy")), n_train=meta["n_train"],
+                             columns=meta["columns"],
+                             preprocessing=joblib.load(os.path.join(matrix_dir, "preprocessing.joblib")),
+                             fingerprint=fingerprint)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+# increase when the feature columns or their derivation change, models with another version can't be loaded
+FEATURE_VERSION = 1
+TARGET = "delayed"
+# columns a flight needs to be scored, all other features are derived or added by the enrichment
+FLIGHT_COLUMNS = ["airline_iata", "dep_iata", "arr_iata", "dep_time_utc", "arr_time_utc"]
+
+WEATHER_NUM_VARIABLES = ["latitude", "longitude", "temperature_2m", "relative_humidity_2m", "precipitation", "rain",
+                         "snowfall", "cloud_cover", "cloud_cover_low", "cloud_cover_mid", "cloud_cover_high",
+                         "wind_speed_10m", "wind_speed_100m", "wind_gusts_10m"]
+TIME_COLUMNS = ["dep_hour", "dep_weekday", "dep_month", "duration_min"]
+NUMERICAL_COLUMNS = (TIME_COLUMNS
+                     + [f"{p}_{c}" for p in ["arr", "dep"] for c in ["days_to_holiday", "days_since_holiday"]]
+                     + [f"{p}_{v}" for p in ["arr", "dep"] for v in WEATHER_NUM_VARIABLES])
+CATEGORICAL_COLUMNS = ["airline_iata", "dep_iata", "arr_iata", "holiday", "dep_holiday",
+                       "arr_weather_code", "dep_weather_code"]
+BOOLEAN_COLUMNS = ["domestic", "international", "arr_holiday_period", "dep_holiday_period"]
+
+# RandomForestRegressor of predict/weather_features.ipynb
+DEFAULT_PARAMS = {"n_estimators": 30, "max_depth": 12}
+
+
+def feature_frame(flights: pd.DataFrame):
+    """
+    Derives the model inputs from flights with holiday and weather columns (flightsHistory-weather.csv).
+    Columns which the flights don't have, e.g. without weather enrichment, are NaN.
+    """
+    dep_time = pd.to_datetime(flights["dep_time_utc"])
+    arr_time = pd.to_datetime(flights["arr_time_utc"])
+    # the columns are collected in a dict and the frame built at once, which is much faster for single flights
+    features = {
+        "dep_hour": dep_time.dt.hour,
+        "dep_weekday": dep_time.dt.weekday,
+        "dep_month": dep_time.dt.month,
+        "duration_min": (arr_time - dep_time).dt.total_seconds() / 60,
+    }
+    for column in NUMERICAL_COLUMNS:
+        if column not in TIME_COLUMNS:
+            features[column] = pd.to_numeric(flights[column]).to_numpy() if column in flights else np.nan
+    for column in CATEGORICAL_COLUMNS + BOOLEAN_COLUMNS:
+        if column not in flights:
+            features[column] = np.nan
+            continue
+        # object arrays with NaN for missing values, which the imputers and the one-hot encoder expect
+        values = flights[column].to_numpy(dtype=object, copy=True)
+        values[pd.isnull(values)] = np.nan
+        features[column] = values
+    return pd.DataFrame(features, index=flights.index)
+
+
+def available_columns(features: pd.DataFrame):
+    """
+    Feature columns with at least one value, a model is only trained on these
+    """
+    return [c for c in features.columns if features[c].notnull().any()]
+
+
+def make_preprocessing(columns):
+    """
+    The preprocessing of the notebooks: median imputation and scaling of numerical columns, one-hot encoding of
+    categorical and boolean columns
+    """
+    num_pipeline = Pipeline([
+        ('medi_imputer', SimpleImputer(strategy='median')),
+        ('std_scaler', StandardScaler())
+    ])
+    cat_pipeline = Pipeline([
+        ('freq_imputer', SimpleImputer(strategy='most_frequent')),
+        ('one_hot_encoder', OneHotEncoder(handle_unknown='ignore'))
+    ])
+    return ColumnTransformer([
+        ('num', num_pipeline, [c for c in NUMERICAL_COLUMNS if c in columns]),
+        ('cat', cat_pipeline, [c for c in CATEGORICAL_COLUMNS + BOOLEAN_COLUMNS if c in columns]),
+    ])
+
+
+def make_model(**params):
+    return RandomForestRegressor(**{**DEFAULT_PARAMS, **params})
+
+
+def make_pipeline(columns, **params):
+    return Pipeline([
+        ('preprocessing', make_preprocessing(columns)),
+        ('model', make_model(**params)),
+    ])
+
+
+def target(flights: pd.DataFrame):
+    # nullable whole minutes in the stored flights, floats with NaN for the model
+    return pd.to_numeric(flights[TARGET]).astype(np.float64)
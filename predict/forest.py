@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from predict.features import FEATURE_VERSION, feature_frame
+from predict.model import MODELS_DIR, ModelArtifact, list_versions
+
+# directory of the compiled model in the directory of its version
+COMPILED_DIR = "compiled"
+# rows per batch, the traversal state of a batch (n_trees x batch_size nodes) should fit into the CPU cache
+BATCH_SIZE = 1024
+
+
+class CompiledForest:
+    """
+    A fitted pipeline of make_pipeline as flat arrays: the nodes of all trees with their input column, split
+    threshold, first child and leaf value, and the medians, means and scales of the numerical columns. The one-hot
+    encoder is folded into category codes: a categorical column is encoded to the codes of its categories, and
+    only the categories which the trees split on become input columns (1 for the category, 0 otherwise).
+
+    All trees are evaluated together over a batch of rows, one tree level per step. The nodes are numbered so that
+    the right child follows the left one, so a step is a few vectorized operations on n_trees x batch_size nodes:
+    node = child[node] + (input > threshold[node]). Leaves are their own child with an infinite threshold.
+    The arrays are memory-mapped when the model is loaded.
+    """
+
+    def __init__(self, arrays: dict, meta: dict):
+        self.arrays = arrays
+        self.meta = meta
+        self.categories = [pd.Index(categories, dtype=object) for categories in meta["categories"]]
+
+    @property
+    def version(self):
+        return self.meta.get("version")
+
+    @staticmethod
+    def export(pipeline: Pipeline, model_dir: str, meta: dict = None):
+        """
+        Writes the compiled pipeline to <model_dir>/compiled, the directory is renamed into place when it is
+        complete. Raises ValueError for pipelines which are not built like make_pipeline.
+        """
+        arrays, compiled_meta = compile_pipeline(pipeline)
+        compiled_meta.update({k: v for k, v in (meta or {}).items() if k in ["version", "feature_version"]})
+        compiled_dir = os.path.join(model_dir, COMPILED_DIR)
+        tmp_dir = f"{compiled_dir}.tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), values)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(compiled_meta, f, indent=2)
+        if os.path.isdir(compiled_dir):
+            shutil.rmtree(compiled_dir)
+        os.replace(tmp_dir, compiled_dir)
+        return compiled_dir
+
+    @staticmethod
+    def load(version: str = "latest", models_dir: str = MODELS_DIR):
+        if version == "latest":
+            versions = list_versions(models_dir)
+            if not versions:
+                raise RuntimeError(f"No model in {models_dir}! Consider running python -m predict.train first.")
+            version = versions[-1]
+        compiled_dir = os.path.join(models_dir, version, COMPILED_DIR)
+        if not os.path.isdir(compiled_dir):
+            raise RuntimeError(f"Model {version} is not compiled, run python -m predict.forest --model {version}")
+        with open(os.path.join(compiled_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["feature_version"] != FEATURE_VERSION:
+            raise RuntimeError(f"Model {version} was trained on features of version {meta['feature_version']}, "
+                               f"the current version is {FEATURE_VERSION}. Train a new model.")
+        arrays = {name[:-len(".npy")]: np.load(os.path.join(compiled_dir, name), mmap_mode="r")
+                  for name in os.listdir(compiled_dir) if name.endswith(".npy")}
+        return CompiledForest(arrays, meta)
+
+    def predict(self, flights: pd.DataFrame, batch_size: int = BATCH_SIZE):
+        return self.predict_features(feature_frame(flights), batch_size)
+
+    def predict_features(self, features: pd.DataFrame, batch_size: int = BATCH_SIZE):
+        """
+        Predictions for a frame of feature_frame, equal to pipeline.predict up to the summation order of the trees
+        """
+        inputs = self.encode(features)
+        predictions = np.empty(len(inputs), dtype=np.float64)
+        for start in range(0, len(inputs), batch_size):
+            predictions[start:start + batch_size] = self._predict_batch(inputs[start:start + batch_size])
+        return predictions
+
+    def encode(self, features: pd.DataFrame):
+        """
+        The input matrix of the trees: the imputed and scaled numerical columns as float32 like the forest sees
+        them, followed by the indicators of the categories the trees split on
+        """
+        numerical, categorical = self.meta["numerical_columns"], self.meta["categorical_columns"]
+        indicator_columns, indicator_categories = self.arrays["indicator_column"], self.arrays["indicator_category"]
+        inputs = np.empty((len(features), len(numerical) + len(indicator_columns)), dtype=np.float32)
+        if numerical:
+            values = features[numerical].to_numpy(dtype=np.float64)
+            values = np.where(np.isnan(values), self.arrays["medians"], values)
+            inputs[:, :len(numerical)] = (values - self.arrays["means"]) / self.arrays["scales"]
+        codes = np.full((len(features), len(categorical)), -1, dtype=np.int32)
+        for i in np.unique(indicator_columns):
+            # the distinct values are looked up instead of every row, the last code is the one of missing values
+            value_codes, values = pd.factorize(features[categorical[i]], use_na_sentinel=True)
+            lookup = self.categories[i].get_indexer(pd.Index(values, dtype=object).append(
+                pd.Index([self.meta["fill_values"][i]], dtype=object)))
+            # -1 for unknown categories, whose one-hot columns are all 0
+            codes[:, i] = lookup[value_codes]
+        inputs[:, len(numerical):] = codes[:, indicator_columns] == indicator_categories
+        return inputs
+
+    def _predict_batch(self, inputs: np.ndarray):
+        roots = self.arrays["roots"]
+        n_rows, n_columns = inputs.shape
+        flat_inputs = np.ascontiguousarray(inputs).ravel()
+        index_dtype = np.int32 if n_rows * n_columns < np.iinfo(np.int32).max else np.int64
+        # plain arrays instead of memory maps, whose slices are slower to create
+        feature = np.asarray(self.arrays["feature"]).astype(index_dtype, copy=False)
+        threshold, child = np.asarray(self.arrays["threshold"]), np.asarray(self.arrays["child"])
+        # node of every (tree, row) pair, all rows start at the root of their tree
+        nodes = np.repeat(roots, n_rows)
+        row_offsets = np.tile(np.arange(n_rows, dtype=index_dtype) * n_columns, len(roots))
+        # buffers of the steps, which are reused for every level
+        indices = np.empty(len(nodes), dtype=index_dtype)
+        values = np.empty(len(nodes), dtype=np.float32)
+        thresholds = np.empty(len(nodes), dtype=np.float32)
+        go_right = np.empty(len(nodes), dtype=bool)
+        for _ in range(int(self.meta["max_depth"])):
+            np.take(feature, nodes, out=indices)
+            indices += row_offsets
+            np.take(flat_inputs, indices, out=values)
+            np.take(threshold, nodes, out=thresholds)
+            np.greater(values, thresholds, out=go_right)
+            np.take(child, nodes, out=nodes)
+            nodes += go_right
+        leaf_values = self.arrays["value"][nodes].reshape(len(roots), n_rows)
+        # summed tree by tree like the forest, so that the result is the same up to float rounding
+        total = np.zeros(n_rows, dtype=np.float64)
+        for tree_values in leaf_values:
+            total += tree_values
+        return total / len(roots)
+
+
+def compile_pipeline(pipeline: Pipeline):
+    """
+    Returns the arrays and the metadata of the compiled pipeline
+    """
+    preprocessing, model = pipeline.named_steps["preprocessing"], pipeline.named_steps["model"]
+    if not isinstance(preprocessing, ColumnTransformer) or not hasattr(model, "estimators_"):
+        raise ValueError("Only pipelines of a ColumnTransformer and a forest can be compiled")
+    transformers = {name: (transformer, columns) for name, transformer, columns in preprocessing.transformers_
+                    if transformer != "drop"}
+    if set(transformers) - {"num", "cat"}:
+        raise ValueError(f"Unsupported transformers {sorted(set(transformers) - {'num', 'cat'})}")
+
+    numerical_columns, medians, means, scales = [], np.zeros(0), np.zeros(0), np.zeros(0)
+    if "num" in transformers:
+        num_pipeline, numerical_columns = transformers["num"]
+        imputer, scaler = _steps(num_pipeline, [SimpleImputer, StandardScaler])
+        medians = imputer.statistics_.astype(np.float64)
+        if np.isnan(medians).any():
+            raise ValueError("Numerical columns without any value are not supported")
+        means = scaler.mean_ if scaler.mean_ is not None else np.zeros(len(medians))
+        scales = scaler.scale_ if scaler.scale_ is not None else np.ones(len(medians))
+
+    categorical_columns, categories, fill_values = [], [], []
+    if "cat" in transformers:
+        cat_pipeline, categorical_columns = transformers["cat"]
+        imputer, encoder = _steps(cat_pipeline, [SimpleImputer, OneHotEncoder])
+        if encoder.drop_idx_ is not None or getattr(encoder, "_infrequent_enabled", False):
+            raise ValueError("One-hot encoders with dropped or infrequent categories are not supported")
+        categories = [[_python_value(v) for v in column_categories] for column_categories in encoder.categories_]
+        fill_values = [_python_value(v) for v in imputer.statistics_]
+
+    # categorical column and category of every one-hot column of the transformed matrix
+    n_numerical = len(numerical_columns)
+    one_hot_column = np.concatenate([np.full(len(c), i) for i, c in enumerate(categories)] + [np.zeros(0)])
+    one_hot_category = np.concatenate([np.arange(len(c)) for c in categories] + [np.zeros(0)])
+    if n_numerical + len(one_hot_column) != model.n_features_in_:
+        raise ValueError(f"The preprocessing has {n_numerical + len(one_hot_column)} output columns, the model "
+                         f"{model.n_features_in_} input columns")
+    # only the one-hot columns which the trees split on become indicator inputs
+    split_features = np.unique(np.concatenate([e.tree_.feature[e.tree_.children_left >= 0]
+                                               for e in model.estimators_]))
+    indicators = split_features[split_features >= n_numerical] - n_numerical
+    input_column = np.arange(model.n_features_in_)
+    input_column[n_numerical + indicators] = n_numerical + np.arange(len(indicators))
+
+    trees = [_breadth_first(estimator.tree_) for estimator in model.estimators_]
+    offsets = np.cumsum([0] + [len(order) for order, _ in trees])
+    nodes = {"feature": [], "threshold": [], "child": [], "value": []}
+    for estimator, (order, child), offset in zip(model.estimators_, trees, offsets):
+        tree = estimator.tree_
+        is_leaf = tree.children_left[order] < 0
+        nodes["feature"].append(np.where(is_leaf, 0, input_column[np.maximum(tree.feature[order], 0)]))
+        nodes["threshold"].append(np.where(is_leaf, np.inf, _float32_threshold(tree.threshold[order])))
+        nodes["child"].append(child + offset)
+        nodes["value"].append(tree.value[order, 0, 0])
+
+    arrays = {
+        "feature": np.concatenate(nodes["feature"]).astype(np.int32),
+        "threshold": np.concatenate(nodes["threshold"]).astype(np.float32),
+        "child": np.concatenate(nodes["child"]).astype(np.int32),
+        "value": np.concatenate(nodes["value"]).astype(np.float64),
+        "roots": offsets[:-1].astype(np.int32),
+        "medians": medians, "means": np.asarray(means, dtype=np.float64),
+        "scales": np.asarray(scales, dtype=np.float64),
+        "indicator_column": one_hot_column[indicators].astype(np.int32),
+        "indicator_category": one_hot_category[indicators].astype(np.int32),
+    }
+    max_depth = max(estimator.tree_.max_depth for estimator in model.estimators_)
+    offset = int(offsets[-1])
+    meta = {"numerical_columns": list(numerical_columns), "categorical_columns": list(categorical_columns),
+            "categories": categories, "fill_values": fill_values, "n_trees": len(trees), "n_nodes": offset,
+            "max_depth": max_depth, "feature_version": FEATURE_VERSION}
+    return arrays, meta
+
+
+def _breadth_first(tree):
+    """
+    Renumbers the nodes of a tree breadth-first with the right child next to the left one. Returns the original
+    node of every new node and the new number of the first child of every new node (its own number for leaves).
+    """
+    order = [0]
+    child = []
+    for node in order:
+        if tree.children_left[node] < 0:
+            child.append(len(child))
+        else:
+            child.append(len(order))
+            order += [tree.children_left[node], tree.children_right[node]]
+    return np.array(order), np.array(child)
+
+
+def _float32_threshold(thresholds: np.ndarray):
+    """
+    The largest float32 values which are not greater than the thresholds: for float32 inputs x, x <= threshold
+    is the same as x <= float32 threshold, so the trees compare float32 like the forest does in float64
+    """
+    rounded = thresholds.astype(np.float32)
+    return np.where(rounded > thresholds, np.nextafter(rounded, np.float32(-np.inf)), rounded)
+
+
+def _steps(pipeline, types: list):
+    steps = [step for _, step in pipeline.steps] if isinstance(pipeline, Pipeline) else [pipeline]
+    if len(steps) != len(types) or not all(isinstance(step, t) for step, t in zip(steps, types)):
+        raise ValueError(f"Expected a pipeline of {[t.__name__ for t in types]}, got {steps}")
+    if getattr(steps[0], "add_indicator", False):
+        raise ValueError("Imputers with missing indicators are not supported")
+    return steps
+
+
+def _python_value(value):
+    # numpy scalars of the fitted encoders as JSON values
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog="python -m predict.forest",
+                                         description="Compiles a trained model into the arrays of the vectorized "
+                                                     "inference engine, which predict.score uses")
+    arg_parser.add_argument("--model", default="latest", help="Model version, e.g. v3 (default: latest)")
+    args = arg_parser.parse_args()
+
+    start = time.time()
+    artifact = ModelArtifact.load(args.model)
+    compiled_dir = CompiledForest.export(artifact.pipeline, os.path.join(MODELS_DIR, artifact.version), artifact.meta)
+    forest = CompiledForest.load(artifact.version)
+    print(f"Compiled model {artifact.version}: {forest.meta['n_trees']} trees, {forest.meta['n_nodes']} nodes, "
+          f"{sum(a.nbytes for a in forest.arrays.values()) / 1e6:.1f} MB in {compiled_dir} "
+          f"({time.time() - start:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from datetime import datetime
+
+import joblib
+import sklearn
+from sklearn.pipeline import Pipeline
+
+from config import config
+from predict.features import FEATURE_VERSION, feature_frame
+
+# one directory per model version: <MODELS_DIR>/v<n>/model.joblib and meta.json
+MODELS_DIR = f"{config.data_dir}/models"
+
+
+def list_versions(models_dir: str = MODELS_DIR):
+    if not os.path.isdir(models_dir):
+        return []
+    versions = [v for v in os.listdir(models_dir)
+                if v.startswith("v") and v[1:].isdigit() and os.path.isfile(os.path.join(models_dir, v, "meta.json"))]
+    return sorted(versions, key=lambda v: int(v[1:]))
+
+
+@dataclass
+class ModelArtifact:
+    """
+    A fitted sklearn pipeline from flight features to the arrival delay in minutes, with its metadata: version,
+    feature version, sklearn version, training data and scores
+    """
+    pipeline: Pipeline
+    meta: dict
+
+    @property
+    def version(self):
+        return self.meta.get("version")
+
+    def predict(self, flights):
+        return self.pipeline.predict(feature_frame(flights))
+
+    def save(self, models_dir: str = MODELS_DIR):
+        """
+        Saves the model as the next version. The directory is written under a temporary name and renamed, so
+        that a reader never sees a partially written version.
+        """
+        versions = list_versions(models_dir)
+        version = f"v{int(versions[-1][1:]) + 1 if versions else 1}"
+        self.meta.update({"version": version, "feature_version": FEATURE_VERSION,
+                          "sklearn_version": sklearn.__version__, "created": datetime.now().isoformat()})
+        model_dir = os.path.join(models_dir, version)
+        tmp_dir = f"{model_dir}.tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        joblib.dump(self.pipeline, os.path.join(tmp_dir, "model.joblib"))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2, default=str)
+        os.replace(tmp_dir, model_dir)
+        return model_dir
+
+    @staticmethod
+    def load(version: str = "latest", models_dir: str = MODELS_DIR):
+        if version == "latest":
+            versions = list_versions(models_dir)
+            if not versions:
+                raise RuntimeError(f"No model in {models_dir}! Consider running python -m predict.train first.")
+            version = versions[-1]
+        model_dir = os.path.join(models_dir, version)
+        with open(os.path.join(model_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["feature_version"] != FEATURE_VERSION:
+            raise RuntimeError(f"Model {version} was trained on features of version {meta['feature_version']}, "
+                               f"the current version is {FEATURE_VERSION}. Train a new model.")
+        if meta["sklearn_version"] != sklearn.__version__:
+            print(f"Warning: model {version} was saved with scikit-learn {meta['sklearn_version']}, "
+                  f"installed is {sklearn.__version__}")
+        return ModelArtifact(pipeline=joblib.load(os.path.join(model_dir, "model.joblib")), meta=meta)
@@ -0,0 +1,53 @@
+import argparse
+import time
+
+import storage
+from predict.forest import CompiledForest
+from predict.model import ModelArtifact
+
+PREDICTION_COLUMN = "predicted_delay"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog="python -m predict.score",
+                                         description="Predicts the arrival delay of flights. The flights are "
+                                                     "streamed through the model in chunks, so memory is bounded "
+                                                     "by the chunk size.")
+    arg_parser.add_argument("flights", help="CSV file (or Parquet directory) of flights with holiday and weather "
+                                            "columns")
+    arg_parser.add_argument("output", help="Output CSV file (or Parquet directory): the flights with a "
+                                           "predicted_delay column")
+    arg_parser.add_argument("--model", default="latest", help="Model version, e.g. v3 (default: latest)")
+    arg_parser.add_argument("--chunk-size", type=int, default=storage.CHUNK_SIZE, help="Flights per chunk")
+    arg_parser.add_argument("--jobs", type=int, default=-1,
+                            help="Number of cores for the prediction with the sklearn engine (-1: all)")
+    arg_parser.add_argument("--engine", choices=["compiled", "sklearn"], default="compiled",
+                            help="compiled: the memory-mapped arrays of python -m predict.forest, "
+                                 "sklearn: the pickled pipeline")
+    args = arg_parser.parse_args()
+    print(f"program arguments: {args}")
+
+    if args.engine == "compiled":
+        artifact = CompiledForest.load(args.model)
+    else:
+        artifact = ModelArtifact.load(args.model)
+        artifact.pipeline.set_params(model__n_jobs=args.jobs)
+    print(f"Loaded model {artifact.version} ({args.engine})")
+
+    start = time.time()
+
+    def scored_chunks():
+        n_flights = 0
+        for chunk in storage.iter_flights(args.flights, args.chunk_size):
+            chunk[PREDICTION_COLUMN] = artifact.predict(chunk)
+            n_flights += len(chunk)
+            print(f"Scored {n_flights} flights ({n_flights / (time.time() - start):.0f} flights/s)")
+            yield chunk
+
+    # written like every other flights file, with the same time format
+    storage.write_flight_chunks(scored_chunks(), args.output)
+    print(f"Wrote result to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
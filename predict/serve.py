@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from airport_index import AirportIndex
+from config import config
+from holiday_calendar import add_holiday_features
+from predict.features import FLIGHT_COLUMNS
+from predict.model import ModelArtifact
+from weather_store import WeatherStore
+
+WEATHER_CSV = f"{config.data_dir}/weather.csv.gz"
+HOLIDAY_COLUMNS = ["holiday", "days_to_holiday", "days_since_holiday", "holiday_period"]
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys, compute):
+        """
+        Returns the values of the keys. The values of missing keys are computed with one call of
+        compute(missing_keys), which returns one value per key.
+        """
+        with self.lock:
+            missing = [k for k in dict.fromkeys(keys) if k not in self.entries]
+            computed = dict(zip(missing, compute(missing))) if missing else {}
+            values = []
+            for key in keys:
+                if key in computed:
+                    values.append(computed[key])
+                else:
+                    self.entries.move_to_end(key)
+                    values.append(self.entries[key])
+            self.entries.update(computed)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return values
+
+
+class FeatureEnricher:
+    """
+    Adds country, holiday and weather columns to flights like the ETL and the enrichment scripts. Holiday features
+    are cached per (airport, 15 minutes), as all time zone offsets are multiples of 15 minutes, and weather per
+    (airport, hour). Cache misses of a batch are computed together.
+    """
+
+    def __init__(self, airport_index: AirportIndex, weather_store: WeatherStore = None, max_size: int = 100_000):
+        self.airport_index = airport_index
+        self.weather_store = weather_store
+        self.holidays = LRUCache(max_size)
+        self.weather = LRUCache(max_size)
+
+    def enrich(self, flights: pd.DataFrame):
+        dep_countries = self.airport_index.country_code(self.airport_index.positions(flights["dep_iata"]))
+        arr_countries = self.airport_index.country_code(self.airport_index.positions(flights["arr_iata"]))
+        domestic = np.asarray(dep_countries == arr_countries) & np.asarray(pd.notnull(dep_countries))
+        columns = {"dep_country_code": dep_countries, "arr_country_code": arr_countries,
+                   "domestic": domestic, "international": ~domestic}
+
+        for prefix in ["arr", "dep"]:
+            iatas = flights[f"{prefix}_iata"].tolist()
+            times = flights[f"{prefix}_time_utc"]
+            holidays = self.holidays.get_many(list(zip(iatas, times.dt.floor("15min"))), self._holiday_features)
+            for column, values in zip(HOLIDAY_COLUMNS, zip(*holidays)):
+                columns[f"{prefix}_{column}" if column != "holiday" or prefix == "dep" else "holiday"] = values
+            if self.weather_store is not None:
+                weather = self.weather.get_many(list(zip(iatas, times.dt.round("h"))), self._weather_features)
+                for column, values in zip(self.weather_store.variables, zip(*weather)):
+                    columns[f"{prefix}_{column}"] = values
+        return pd.concat([flights, pd.DataFrame(columns, index=flights.index)], axis=1)
+
+    def _holiday_features(self, keys):
+        frame = pd.DataFrame(keys, columns=["iata", "time"])
+        frame = add_holiday_features(frame, "time", "iata", self.airport_index, "x", name_column="holiday")
+        frame["holiday"] = frame["holiday"].astype(object).where(frame["holiday"].notnull(), None)
+        return list(frame[["holiday", "x_days_to_holiday", "x_days_since_holiday", "x_holiday_period"]]
+                    .itertuples(index=False, name=None))
+
+    def _weather_features(self, keys):
+        iatas, hours = zip(*keys)
+        weather = self.weather_store.lookup(list(iatas), pd.Series(hours))
+        return list(weather.itertuples(index=False, name=None))
+
+
+class MicroBatcher:
+    """
+    Collects the flights (validated DataFrames) of concurrent requests for at most max_wait_ms or until max_batch
+    flights are waiting and scores them with one call of score(flights)
+    """
+
+    def __init__(self, score, max_batch: int = 64, max_wait_ms: float = 2.0):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, flights: pd.DataFrame):
+        future = Future()
+        self.queue.put((flights, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            n_flights = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while n_flights < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                n_flights += len(batch[-1][0])
+
+            try:
+                predictions = self.score(pd.concat([flights for flights, _ in batch], ignore_index=True))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for flights, future in batch:
+                future.set_result(predictions[offset:offset + len(flights)])
+                offset += len(flights)
+
+
+class DelayService:
+    def __init__(self, artifact: ModelArtifact, enricher: FeatureEnricher, max_batch: int, max_wait_ms: float):
+        self.artifact = artifact
+        self.enricher = enricher
+        self.batcher = MicroBatcher(self.score, max_batch, max_wait_ms)
+
+    def score(self, flights: pd.DataFrame):
+        return self.artifact.predict(self.enricher.enrich(flights)).tolist()
+
+    def predict(self, records: list):
+        """
+        Validates the flights of a request before they join a batch, so that an invalid flight only fails its own
+        request. Raises ValueError or TypeError for invalid flights.
+        """
+        return self.batcher.submit(flight_frame(records)).result()
+
+
+def flight_frame(records: list):
+    """
+    The flights of a request with parsed times. Times with an offset are converted to UTC, times without are UTC.
+    """
+    if not records:
+        raise ValueError("No flights in the request")
+    if not all(isinstance(record, dict) for record in records):
+        raise TypeError("Flights must be JSON objects")
+    missing = {c for record in records for c in FLIGHT_COLUMNS if record.get(c) is None}
+    if missing:
+        raise ValueError(f"Missing flight fields: {sorted(missing)}")
+    if not all(isinstance(record[c], str) for record in records for c in FLIGHT_COLUMNS):
+        raise TypeError(f"Flight fields must be strings: {FLIGHT_COLUMNS}")
+    flights = pd.DataFrame.from_records(records)
+    for column in ["dep_time_utc", "arr_time_utc"]:
+        try:
+            times = pd.to_datetime(flights[column], format="ISO8601", utc=True)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid {column}: {str(e).splitlines()[0]}") from None
+        flights[column] = times.dt.tz_localize(None)
+    return flights
+
+
+class DelayServer(ThreadingHTTPServer):
+    # concurrent clients wait in the listen queue instead of being refused
+    request_queue_size = 128
+
+
+def handler_class(service: DelayService):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/health":
+                return self._send(404, {"error": "not found"})
+            self._send(200, {"status": "ok", "model_version": service.artifact.version})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                return self._send(404, {"error": "not found"})
+            start = time.perf_counter()
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                records = body if isinstance(body, list) else [body]
+                predictions = service.predict(records)
+            except (ValueError, TypeError) as e:
+                return self._send(400, {"error": str(e)})
+            except Exception as e:
+                return self._send(500, {"error": f"{type(e).__name__}: {e}"})
+            self._send(200, {"model_version": service.artifact.version, "predictions": predictions,
+                             "latency_ms": (time.perf_counter() - start) * 1000})
+
+        def _send(self, status: int, data: dict):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog="python -m predict.serve",
+                                         description="HTTP endpoint for delay predictions. POST /predict with a "
+                                                     "flight (airline_iata, dep_iata, arr_iata, dep_time_utc, "
+                                                     "arr_time_utc) or a list of flights as JSON.")
+    arg_parser.add_argument("--model", default="latest", help="Model version, e.g. v3 (default: latest)")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--weather", default=WEATHER_CSV, help="CSV file of weather reports")
+    arg_parser.add_argument("--max-batch", type=int, default=64,
+                            help="Maximum number of flights of concurrent requests which are scored together")
+    arg_parser.add_argument("--max-wait-ms", type=float, default=2.0,
+                            help="Maximum time a request waits for other requests to be scored together")
+    arg_parser.add_argument("--cache-size", type=int, default=100_000,
+                            help="Number of cached holiday and weather features (each)")
+    args = arg_parser.parse_args()
+    print(f"program arguments: {args}")
+
+    artifact = ModelArtifact.load(args.model)
+    artifact.pipeline.set_params(model__n_jobs=None)
+    weather_store = WeatherStore.open(args.weather) if os.path.isfile(args.weather) else None
+    if weather_store is None:
+        print(f"Warning: {args.weather} doesn't exist, predicting without weather")
+    enricher = FeatureEnricher(AirportIndex.load(), weather_store, args.cache_size)
+    service = DelayService(artifact, enricher, args.max_batch, args.max_wait_ms)
+    server = DelayServer((args.host, args.port), handler_class(service))
+    print(f"Serving model {artifact.version} on http://{args.host}:{args.port}/predict")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
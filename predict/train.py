@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+
+import storage
+from predict.feature_matrix import FeatureMatrix, dataset_fingerprint
+from predict.features import DEFAULT_PARAMS, make_model
+from predict.forest import CompiledForest
+from predict.model import ModelArtifact
+from predict.validation import PARAM_GRID, cross_validate, mean_scores, successive_halving
+
+
+def scores(labels, predictions):
+    errors = np.asarray(predictions) - np.asarray(labels)
+    return {"rmse": float(np.sqrt(np.mean(errors ** 2))), "mae": float(np.mean(np.abs(errors)))}
+
+
+def load_matrix(args):
+    """
+    Returns the encoded feature matrix of the flights, from the cache if the flights file didn't change
+    """
+    filters = storage.filters_from_args(args)
+    fingerprint = dataset_fingerprint(args.flights, holdout=args.holdout, **filters)
+    matrix = None if args.no_cache else FeatureMatrix.load(fingerprint)
+    if matrix is not None:
+        print(f"Using cached feature matrix {fingerprint}")
+        return matrix
+
+    start = time.time()
+    flights = storage.read_flights(args.flights, **filters)
+    matrix = FeatureMatrix.build(flights, args.holdout, fingerprint)
+    matrix.save()
+    print(f"Built feature matrix {fingerprint} with {matrix.X.shape[1]} columns ({time.time() - start:.1f}s)")
+    return matrix
+
+
+def print_cv(records: list):
+    for record in records:
+        print(f"  round {record['round']} fold {record['fold']}: {record['params']} rows {record['n_train']}, "
+              f"fit {record['fit_time_s']:.2f}s, score {record['score_time_s']:.2f}s, RMSE {record['rmse']:.3f}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog="python -m predict.train",
+                                         description="Trains the delay model and saves it as a new version")
+    arg_parser.add_argument("flights", help="CSV file (or Parquet directory) of flights with holiday and weather "
+                                            "columns, e.g. data/history/flightsHistory-weather.csv")
+    arg_parser.add_argument("--holdout", type=float, default=0.1,
+                            help="Fraction of the latest flights which is used to score the final model")
+    arg_parser.add_argument("--n-estimators", type=int, default=DEFAULT_PARAMS["n_estimators"])
+    arg_parser.add_argument("--max-depth", type=int, default=DEFAULT_PARAMS["max_depth"])
+    arg_parser.add_argument("--folds", type=int, default=5,
+                            help="Number of time-series cross-validation folds over the training flights (0: none)")
+    arg_parser.add_argument("--search", action="store_true",
+                            help="Choose the parameters from PARAM_GRID of validation.py by successive halving")
+    arg_parser.add_argument("--factor", type=int, default=3,
+                            help="Successive halving keeps 1/factor of the candidates per round and multiplies "
+                                 "the number of rows by factor")
+    arg_parser.add_argument("--jobs", type=int, default=-1, help="Number of cores for fitting (-1: all)")
+    arg_parser.add_argument("--no-cache", action="store_true", help="Rebuild the feature matrix")
+    storage.add_filter_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    print(f"program arguments: {args}")
+
+    matrix = load_matrix(args)
+    X_train, y_train = matrix.X[:matrix.n_train], matrix.y[:matrix.n_train]
+    X_test, y_test = matrix.X[matrix.n_train:], matrix.y[matrix.n_train:]
+    print(f"Training on {len(y_train)} flights until {matrix.times[matrix.n_train - 1]}, "
+          f"scoring on {len(y_test)} flights")
+
+    start = time.time()
+    params = {"n_estimators": args.n_estimators, "max_depth": args.max_depth}
+    records = []
+    if args.search and args.folds > 1:
+        params, records = successive_halving(X_train, y_train, PARAM_GRID, args.folds, args.factor,
+                                             n_jobs=args.jobs)
+    elif args.folds > 1:
+        records = cross_validate(X_train, y_train, [params], args.folds, args.jobs)
+    if records:
+        print_cv(records)
+        last_round = [r for r in records if r["round"] == records[-1]["round"]]
+        print(f"Parameters {params}: mean CV RMSE {mean_scores(last_round, [params])[0]:.3f} "
+              f"({time.time() - start:.1f}s)")
+
+    start = time.time()
+    model = make_model(n_jobs=args.jobs, **params).fit(X_train, y_train)
+    # the model is used for single flights and small batches, where parallel trees only add overhead
+    model.set_params(n_jobs=None)
+    fit_time = time.time() - start
+    pipeline = Pipeline([("preprocessing", matrix.preprocessing), ("model", model)])
+
+    artifact = ModelArtifact(pipeline=pipeline, meta={
+        "trained_on": args.flights, "dataset_fingerprint": matrix.fingerprint,
+        "train_rows": len(y_train), "test_rows": len(y_test),
+        "train_date_from": matrix.times[0], "train_date_to": matrix.times[matrix.n_train - 1],
+        "columns": matrix.columns, "params": params, "fit_time_s": fit_time,
+        "train_scores": scores(y_train, model.predict(X_train)), "cv": records,
+    })
+    if len(y_test):
+        artifact.meta["test_scores"] = scores(y_test, model.predict(X_test))
+    model_dir = artifact.save()
+    CompiledForest.export(pipeline, model_dir, artifact.meta)
+    print(f"Scores: train {artifact.meta['train_scores']}, test {artifact.meta.get('test_scores')}")
+    print(f"Saved model {artifact.version} to {model_dir} ({fit_time:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
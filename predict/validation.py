@@ -0,0 +1,88 @@
+import math
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.model_selection import ParameterGrid, TimeSeriesSplit
+
+from predict.features import make_model
+
+# searched by successive halving, all other parameters are the DEFAULT_PARAMS
+PARAM_GRID = {
+    "n_estimators": [30, 100],
+    "max_depth": [8, 12, 20, None],
+    "max_features": [1.0, 0.3],
+    "min_samples_leaf": [1, 5],
+}
+
+
+def rmse(labels, predictions):
+    return float(np.sqrt(np.mean((np.asarray(predictions) - np.asarray(labels)) ** 2)))
+
+
+def time_series_folds(n_rows: int, n_folds: int):
+    """
+    Expanding-window folds over rows sorted by time: every fold trains on the flights before its test flights
+    """
+    return list(TimeSeriesSplit(n_splits=n_folds).split(np.empty((n_rows, 1))))
+
+
+def fit_and_score(X, y, params: dict, train_idx, test_idx, n_samples: int = None):
+    """
+    Fits a model on the most recent n_samples training rows of a fold and scores it on the test rows
+    """
+    if n_samples is not None:
+        train_idx = train_idx[-n_samples:]
+    start = time.perf_counter()
+    model = make_model(n_jobs=1, **params).fit(X[train_idx], y[train_idx])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    score = rmse(y[test_idx], model.predict(X[test_idx]))
+    return {"n_train": len(train_idx), "n_test": len(test_idx), "fit_time_s": fit_time,
+            "score_time_s": time.perf_counter() - start, "rmse": score}
+
+
+def cross_validate(X, y, candidates: list, n_folds: int, n_jobs: int = -1, n_samples: int = None, round_: int = 0):
+    """
+    Scores every candidate parameter set on every fold. All (candidate, fold) fits run in parallel.
+    Returns one record per fit with its timings and score.
+    """
+    folds = time_series_folds(len(y), n_folds)
+    tasks = [(c, f) for c in range(len(candidates)) for f in range(len(folds))]
+    results = Parallel(n_jobs=n_jobs)(delayed(fit_and_score)(X, y, candidates[c], *folds[f], n_samples)
+                                      for c, f in tasks)
+    return [{"round": round_, "params": candidates[c], "fold": f, **result}
+            for (c, f), result in zip(tasks, results)]
+
+
+def mean_scores(records: list, candidates: list):
+    return [np.mean([r["rmse"] for r in records if r["params"] == params]) for params in candidates]
+
+
+def successive_halving(X, y, param_grid: dict, n_folds: int, factor: int = 3, min_samples: int = 1000,
+                       n_jobs: int = -1):
+    """
+    Cross-validates all candidates on a small number of recent training rows per fold, keeps the best 1/factor
+    of them and multiplies the number of rows by factor, until one candidate is left or all rows are used.
+    The number of rounds is limited so that the first one uses at least min_samples rows.
+    Returns the best parameters and the records of all fits.
+    """
+    candidates = list(ParameterGrid(param_grid))
+    # rounds until one candidate is left, but the first round needs at least min_samples rows
+    n_required = 1 + math.ceil(math.log(len(candidates), factor)) if len(candidates) > 1 else 1
+    n_possible = 1 + math.floor(math.log(max(1.0, len(y) / min_samples), factor))
+    n_rounds = min(n_required, n_possible)
+    records = []
+    for round_ in range(n_rounds):
+        n_samples = int(len(y) / factor ** (n_rounds - 1 - round_))
+        start = time.perf_counter()
+        round_records = cross_validate(X, y, candidates, n_folds, n_jobs, n_samples, round_)
+        records += round_records
+        scores = mean_scores(round_records, candidates)
+        ranking = np.argsort(scores, kind="stable")
+        print(f"Round {round_}: {len(candidates)} candidates on up to {n_samples} rows per fold, "
+              f"best RMSE {scores[ranking[0]]:.3f} ({time.perf_counter() - start:.1f}s)")
+        if len(candidates) == 1 or n_samples >= len(y):
+            break
+        candidates = [candidates[i] for i in ranking[:max(1, math.ceil(len(candidates) / factor))]]
+    return candidates[int(np.argmin(mean_scores(round_records, candidates)))], records
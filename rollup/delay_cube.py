@@ -0,0 +1,461 @@
+import json
+import os
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT_DIR, "extract"))
+sys.path.append(os.path.join(ROOT_DIR, "add-holidays"))
+import storage  # noqa: E402
+from airport_index import AirportIndex  # noqa: E402
+from config import config  # noqa: E402
+from holiday_calendar import add_holiday_features  # noqa: E402
+
+# dimensions of the cube cells, day and hour are the UTC departure day and hour like the dep_time_utc column
+DIMENSIONS = ["day", "hour", "airline", "dep", "arr", "holiday"]
+# dimensions derived from the day at query time
+DERIVED_DIMENSIONS = ["month", "weekday"]
+CATEGORY_DIMENSIONS = {"airline": "airlines", "dep": "airports", "arr": "airports"}
+MEASURE_COLUMNS = ["flights", "count", "sum", "sum_sq", "min", "max"]
+# upper edges of the delay histogram bins in minutes: one minute wide up to a delay of 3 hours, coarser above.
+# Bin 0 holds the delays of an hour or more ahead of schedule, the last bin the delays of a day and more.
+# The histograms are sparse, so narrow bins only cost memory at query time.
+BIN_EDGES = np.concatenate([np.arange(-59, 181), np.arange(185, 601, 5), np.arange(615, 1441, 15)])
+N_BINS = len(BIN_EDGES) + 1
+DEFAULT_QUANTILES = [0.5, 0.9, 0.99]
+UNKNOWN = "unknown"
+# columns of the flights which the cells depend on, hashed per day to find the days which changed. The holiday
+# columns of add_holidays.py are derived from the departure time and airport.
+HASH_COLUMNS = ["flight_iata", "dep_time_utc", "airline_iata", "dep_iata", "arr_iata", "delayed"]
+
+
+class DelayCube:
+    """
+    Aggregates of the flight delays per cell of (day, hour, airline, departure airport, arrival airport, holiday):
+    number of flights, number of known delays, sum, sum of squares, minimum and maximum of `delayed`, and a
+    histogram of the delays for quantiles, which are exact for delays of up to 3 hours. Histograms are stored sparse
+    as (cell, bin, count) entries. All measures can be merged, so any roll-up or slice is answered from the cells
+    without reading flights.
+
+    The cube is a directory of .npy arrays, memory-mapped when it is opened, and a meta.json with the category
+    dictionaries, the fingerprint of the flights it was built from and a hash of the flights of every day.
+    """
+
+    def __init__(self, cells: dict, hist: dict, meta: dict, cube_dir: str = None):
+        self.cells = cells
+        self.hist = hist
+        self.meta = meta
+        self.cube_dir = cube_dir
+        self._derived = {}
+
+    @staticmethod
+    def load(cube_dir: str):
+        with open(os.path.join(cube_dir, "meta.json")) as f:
+            meta = json.load(f)
+        cells = {c: np.load(os.path.join(cube_dir, f"{c}.npy"), mmap_mode="r") for c in DIMENSIONS + MEASURE_COLUMNS}
+        hist = {c: np.load(os.path.join(cube_dir, f"hist_{c}.npy"), mmap_mode="r") for c in ["cell", "bin", "count"]}
+        return DelayCube(cells, hist, meta, cube_dir)
+
+    @staticmethod
+    def open(flights_path: str, cube_dir: str = None, airport_index: AirportIndex = None):
+        """
+        Opens the cube of the flights. It is built if it doesn't exist or has other histogram bins, and updated if
+        the flights changed since: only the days whose flights were added, removed or updated (e.g. delays
+        corrected by delay_history.py -m update) are aggregated again.
+        """
+        cube_dir = cube_dir or default_cube_dir(flights_path)
+        fingerprint = source_fingerprint(flights_path)
+        if not os.path.isfile(os.path.join(cube_dir, "meta.json")):
+            return DelayCube.build(flights_path, cube_dir, airport_index)
+        cube = DelayCube.load(cube_dir)
+        if cube.meta["bin_edges"] != BIN_EDGES.tolist() or "day_hashes" not in cube.meta:
+            return DelayCube.build(flights_path, cube_dir, airport_index)
+        if cube.meta["fingerprint"] != fingerprint:
+            cube.refresh(flights_path, airport_index)
+        return cube
+
+    @staticmethod
+    def build(flights_path: str, cube_dir: str, airport_index: AirportIndex = None):
+        print(f"Building delay cube {cube_dir} from {flights_path}")
+        flights = storage.read_flights(flights_path)
+        meta = {"fingerprint": source_fingerprint(flights_path), "airlines": [], "airports": [],
+                "bin_edges": BIN_EDGES.tolist(), "day_hashes": day_hashes(flights)}
+        cube = DelayCube(*aggregate(flights, meta, airport_index), meta, cube_dir)
+        cube.save()
+        return cube
+
+    def refresh(self, flights_path: str, airport_index: AirportIndex = None):
+        """
+        Aggregates again the days of the flights which changed since the cube was built and saves the cube
+        """
+        start = time.perf_counter()
+        # a CSV file is read completely anyway, a partitioned dataset is first only read for the hashed columns
+        flights = None if storage.is_partitioned(flights_path) else storage.read_flights(flights_path)
+        hashes = day_hashes(flights if flights is not None
+                            else storage.read_flights(flights_path, columns=HASH_COLUMNS))
+        cube_hashes = self.meta["day_hashes"]
+        changed = {int(day) for day in hashes.keys() | cube_hashes.keys()
+                   if hashes.get(day) != cube_hashes.get(day)}
+        if changed:
+            if flights is None:
+                flights = storage.read_flights(flights_path,
+                                               date_from=pd.Timestamp(np.datetime64(min(changed), "D")),
+                                               date_to=pd.Timestamp(np.datetime64(max(changed), "D") + 1))
+            flights = flights[np.isin(flights["dep_time_utc"].to_numpy().astype("datetime64[D]").astype(np.int64),
+                                      list(changed))]
+            self.replace_days(changed, flights, airport_index)
+        self.meta["fingerprint"] = source_fingerprint(flights_path)
+        self.meta["day_hashes"] = hashes
+        self.save()
+        print(f"Updated {len(changed)} days of the delay cube {self.cube_dir} in {time.perf_counter() - start:.2f}s")
+
+    def replace_days(self, days: set, flights: pd.DataFrame, airport_index: AirportIndex = None):
+        """
+        Replaces the cells of the days (day numbers since 1970-01-01) with the aggregates of the flights, which
+        must be all flights of these days
+        """
+        keep = ~np.isin(self.cells["day"], list(days))
+        new_index = np.cumsum(keep) - 1
+        keep_hist = keep[self.hist["cell"]]
+        new_cells, new_hist = aggregate(flights, self.meta, airport_index)
+        n_kept = int(keep.sum())
+        self.cells = {c: np.concatenate([np.asarray(self.cells[c])[keep], new_cells[c]]) for c in self.cells}
+        self.hist = {"cell": np.concatenate([new_index[np.asarray(self.hist["cell"])[keep_hist]],
+                                             new_hist["cell"] + n_kept]),
+                     "bin": np.concatenate([np.asarray(self.hist["bin"])[keep_hist], new_hist["bin"]]),
+                     "count": np.concatenate([np.asarray(self.hist["count"])[keep_hist], new_hist["count"]])}
+        self._derived = {}
+
+    def save(self):
+        """
+        Writes the cube into a new directory which then replaces the old one, so readers never see a partial cube
+        """
+        tmp_dir = f"{self.cube_dir}.tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for column, values in self.cells.items():
+            np.save(os.path.join(tmp_dir, f"{column}.npy"), values)
+        for column, values in self.hist.items():
+            np.save(os.path.join(tmp_dir, f"hist_{column}.npy"), values)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+        if os.path.isdir(self.cube_dir):
+            shutil.rmtree(self.cube_dir)
+        os.replace(tmp_dir, self.cube_dir)
+
+    def dimension(self, name: str):
+        """
+        Codes of a dimension per cell. Category dimensions are codes of their dictionary, day is the number of
+        days since 1970-01-01, month the number of months since 1970-01, weekday 0 (Monday) to 6.
+        """
+        if name in DIMENSIONS:
+            return self.cells[name]
+        if name not in self._derived:
+            days = np.asarray(self.cells["day"]).astype("datetime64[D]")
+            if name == "month":
+                self._derived[name] = days.astype("datetime64[M]").astype(np.int64)
+            elif name == "weekday":
+                # 1970-01-01 was a Thursday
+                self._derived[name] = (days.astype(np.int64) + 3) % 7
+            else:
+                raise ValueError(f"Unknown dimension {name}, use one of {DIMENSIONS + DERIVED_DIMENSIONS}")
+        return self._derived[name]
+
+    def query(self, by=(), where: dict = None, quantiles=DEFAULT_QUANTILES):
+        """
+        Rolls the cells up to the dimensions `by` and returns a DataFrame with the number of flights, the number of
+        known delays and mean, standard deviation, minimum, maximum and quantiles of the delay per group.
+
+        :param by: dimensions of the result, e.g. ["airline"] or ["dep", "hour"]; all cells in one row if empty
+        :param where: filters per dimension: a value or a list of values, e.g. {"dep": ["HAN", "SGN"],
+                      "holiday": True}, for day and month also a (from, to) tuple of dates, from inclusive and to
+                      exclusive like the date filters of storage.read_flights
+        """
+        by = list(by)
+        mask = self._mask(where or {})
+
+        def selected(values):
+            # copying all cells is skipped for queries without filters
+            return np.asarray(values) if mask is None else np.asarray(values)[mask]
+
+        n_cells = len(self.cells["day"]) if mask is None else int(mask.sum())
+        groups, inverse = group_codes([selected(self.dimension(name)) for name in by], n_cells)
+        n_groups = len(groups[0]) if by else 1
+
+        def total(column):
+            return np.bincount(inverse, weights=selected(self.cells[column]), minlength=n_groups)
+
+        count = total("count")
+        result = {"flights": total("flights").astype(np.int64), "count": count.astype(np.int64)}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total("sum") / count
+            result["mean"] = mean
+            result["std"] = np.sqrt(np.maximum(total("sum_sq") / count - mean ** 2, 0))
+        minimum = np.full(n_groups, np.inf)
+        maximum = np.full(n_groups, -np.inf)
+        np.minimum.at(minimum, inverse, selected(self.cells["min"]))
+        np.maximum.at(maximum, inverse, selected(self.cells["max"]))
+        result["min"] = np.where(count > 0, minimum, np.nan)
+        result["max"] = np.where(count > 0, maximum, np.nan)
+
+        if quantiles:
+            # group of every histogram entry, -1 for entries of cells which are filtered out
+            if mask is None:
+                cell_group = inverse
+            else:
+                cell_group = np.full(len(mask), -1, dtype=np.int64)
+                cell_group[mask] = inverse
+            entry_group = cell_group[self.hist["cell"]]
+            entries = entry_group >= 0
+            histograms = np.bincount(entry_group[entries] * N_BINS + np.asarray(self.hist["bin"])[entries],
+                                     weights=np.asarray(self.hist["count"])[entries],
+                                     minlength=n_groups * N_BINS).reshape(n_groups, N_BINS)
+            for q in quantiles:
+                result[f"p{q * 100:g}"] = histogram_quantile(histograms, q, result["min"], result["max"])
+
+        index = self._labels(by, groups) if by else pd.RangeIndex(1)
+        return pd.DataFrame(result, index=index)
+
+    def _mask(self, where: dict):
+        """
+        Boolean mask of the cells which pass the filters, None without filters
+        """
+        if not where:
+            return None
+        mask = np.ones(len(self.cells["day"]), dtype=bool)
+        for name, value in where.items():
+            values = np.asarray(self.dimension(name))
+            if name in ["day", "month"] and isinstance(value, tuple):
+                date_from, date_to = value
+                if date_from is not None:
+                    mask &= values >= self._code(name, date_from)
+                if date_to is not None:
+                    mask &= values < self._code(name, date_to)
+                continue
+            value_list = value if isinstance(value, (list, np.ndarray, pd.Index, pd.Series)) else [value]
+            mask &= np.isin(values, [self._code(name, v) for v in value_list])
+        return mask
+
+    def _code(self, name: str, value):
+        if name in CATEGORY_DIMENSIONS:
+            dictionary = self.meta[CATEGORY_DIMENSIONS[name]]
+            return dictionary.index(value) if value in dictionary else -1
+        if name == "day":
+            return np.datetime64(pd.Timestamp(value), "D").astype(np.int64)
+        if name == "month":
+            return np.datetime64(pd.Timestamp(value), "M").astype(np.int64)
+        return value
+
+    def _labels(self, by: list, groups: np.ndarray):
+        labels = []
+        for name, codes in zip(by, groups):
+            if name in CATEGORY_DIMENSIONS:
+                labels.append(np.asarray(self.meta[CATEGORY_DIMENSIONS[name]], dtype=object)[codes])
+            elif name == "day":
+                labels.append(codes.astype("datetime64[D]"))
+            elif name == "month":
+                labels.append(pd.PeriodIndex(codes.astype("datetime64[M]"), freq="M"))
+            elif name == "holiday":
+                labels.append(codes.astype(bool))
+            else:
+                labels.append(codes)
+        return pd.MultiIndex.from_arrays(labels, names=by) if len(by) > 1 else pd.Index(labels[0], name=by[0])
+
+
+def aggregate(flights: pd.DataFrame, meta: dict, airport_index: AirportIndex = None):
+    """
+    Aggregates flights into cube cells and sparse histogram entries. New airlines and airports are appended to the
+    dictionaries in meta, so the codes of existing cells stay valid.
+    """
+    flights = flights[flights["dep_time_utc"].notnull()]
+    dimensions = {
+        "day": flights["dep_time_utc"].to_numpy().astype("datetime64[D]").astype(np.int64),
+        "hour": flights["dep_time_utc"].dt.hour.to_numpy().astype(np.int64),
+        "airline": _encode(flights["airline_iata"], meta["airlines"]),
+        "dep": _encode(flights["dep_iata"], meta["airports"]),
+        "arr": _encode(flights["arr_iata"], meta["airports"]),
+        "holiday": holiday_flags(flights, airport_index).astype(np.int64),
+    }
+    keys, inverse = group_codes(list(dimensions.values()), len(flights))
+    n_cells = len(keys[0])
+    delays = pd.to_numeric(flights["delayed"]).to_numpy(dtype=np.float64, na_value=np.nan)
+    known = ~np.isnan(delays)
+    known_delays = np.where(known, delays, 0)
+
+    cells = {name: keys[i].astype(np.int32 if name != "holiday" else bool) for i, name in enumerate(dimensions)}
+    cells["hour"] = cells["hour"].astype(np.int8)
+    cells["flights"] = np.bincount(inverse, minlength=n_cells).astype(np.int32)
+    cells["count"] = np.bincount(inverse, weights=known, minlength=n_cells).astype(np.int32)
+    cells["sum"] = np.bincount(inverse, weights=known_delays, minlength=n_cells)
+    cells["sum_sq"] = np.bincount(inverse, weights=known_delays ** 2, minlength=n_cells)
+    cells["min"] = np.full(n_cells, np.inf)
+    cells["max"] = np.full(n_cells, -np.inf)
+    np.minimum.at(cells["min"], inverse[known], delays[known])
+    np.maximum.at(cells["max"], inverse[known], delays[known])
+
+    entries, counts = np.unique(inverse[known] * N_BINS + np.searchsorted(BIN_EDGES, delays[known], side="right"),
+                                return_counts=True)
+    hist = {"cell": entries // N_BINS, "bin": (entries % N_BINS).astype(np.int16), "count": counts.astype(np.int32)}
+    return cells, hist
+
+
+def day_hashes(flights: pd.DataFrame):
+    """
+    Hash of the HASH_COLUMNS of the flights per departure day, as {day number since 1970-01-01 (as string, like
+    the keys of meta.json): hash}. The row hashes of a day are summed, so the order of the flights doesn't matter.
+    """
+    flights = flights[flights["dep_time_utc"].notnull()]
+    days = flights["dep_time_utc"].to_numpy().astype("datetime64[D]").astype(np.int64)
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    sums = np.zeros(len(unique_days), dtype=np.uint64)
+    np.add.at(sums, inverse, pd.util.hash_pandas_object(flights[HASH_COLUMNS], index=False).to_numpy())
+    return {str(day): int(value) for day, value in zip(unique_days.tolist(), sums)}
+
+
+def group_codes(codes: list, n: int):
+    """
+    Groups rows by the combination of their integer codes of several dimensions. Returns the codes of each group
+    per dimension and the group of every row. The codes are combined into one int64 key per row, which is much
+    faster to group than the columns. Small key ranges are grouped by counting instead of sorting.
+    """
+    if not codes:
+        return [], np.zeros(n, dtype=np.int64)
+    keys = np.zeros(n, dtype=np.int64)
+    offsets, sizes = [], []
+    for values in codes:
+        offset = int(values.min()) if len(values) else 0
+        size = int(values.max()) - offset + 1 if len(values) else 1
+        keys = keys * size + (values.astype(np.int64) - offset)
+        offsets.append(offset)
+        sizes.append(size)
+    if np.prod(sizes, dtype=np.float64) <= 4 * n + 65536:
+        present = np.bincount(keys, minlength=int(np.prod(sizes))) > 0
+        unique_keys = np.flatnonzero(present)
+        inverse = (np.cumsum(present) - 1)[keys]
+    else:
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+    groups = []
+    for offset, size in zip(reversed(offsets), reversed(sizes)):
+        groups.append(unique_keys % size + offset)
+        unique_keys = unique_keys // size
+    return groups[::-1], inverse.ravel()
+
+
+def histogram_quantile(histograms: np.ndarray, q: float, minimum: np.ndarray, maximum: np.ndarray):
+    """
+    Approximate q-quantile (nearest rank) per row of delay histograms. The values of a bin are assumed to be spread
+    evenly over its whole minutes, so the quantile is exact for delays of up to 3 hours. The open first and last bins
+    are bounded by the minimum and maximum.
+    """
+    n = histograms.sum(axis=1)
+    rank = np.maximum(np.ceil(q * n), 1)
+    cumulative = np.cumsum(histograms, axis=1)
+    bins = np.minimum((cumulative < rank[:, None]).sum(axis=1), N_BINS - 1)
+    rows = np.arange(len(histograms))
+    before = np.where(bins > 0, cumulative[rows, np.maximum(bins - 1, 0)], 0)
+    in_bin = histograms[rows, bins]
+    lower = np.where(bins > 0, BIN_EDGES[np.maximum(bins - 1, 0)], minimum)
+    upper = np.where(bins < N_BINS - 1, BIN_EDGES[np.minimum(bins, N_BINS - 2)] - 1, maximum)
+    lower, upper = np.maximum(lower, minimum), np.minimum(upper, maximum)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = np.where(in_bin > 1, (rank - before - 1) / (in_bin - 1), 0)
+    return np.where(n > 0, lower + (upper - lower) * fraction, np.nan)
+
+
+def holiday_flags(flights: pd.DataFrame, airport_index: AirportIndex = None):
+    """
+    True for flights departing on a holiday or within a multi-day holiday period of the departure airport's
+    country. The columns of add_holidays.py are used if the flights have them, otherwise they are computed.
+    """
+    if "dep_holiday" not in flights or "dep_holiday_period" not in flights:
+        features = add_holiday_features(flights[["dep_time_utc", "dep_iata"]].copy(), "dep_time_utc", "dep_iata",
+                                        airport_index or AirportIndex.load(), "dep")
+        flights = features
+    return (flights["dep_holiday"].notnull() | flights["dep_holiday_period"].astype(bool)).to_numpy()
+
+
+def source_fingerprint(flights_path: str):
+    """
+    Size and modification time of the flights CSV or of all files of a Parquet dataset
+    """
+    if os.path.isfile(flights_path):
+        files = [flights_path]
+    else:
+        files = sorted(os.path.join(directory, name) for directory, _, names in os.walk(flights_path)
+                       for name in names)
+    return ";".join(f"{os.path.relpath(f, flights_path)}:{os.stat(f).st_size}:{os.stat(f).st_mtime_ns}"
+                    for f in files)
+
+
+def default_cube_dir(flights_path: str):
+    """
+    Directory of the cube next to the flights, e.g. flightsHistory.csv -> flightsHistory.cube
+    """
+    path = flights_path.rstrip("/")
+    for ext in [".csv.gz", ".csv", ".parquet"]:
+        if path.endswith(ext):
+            return f"{path[:-len(ext)]}.cube"
+    return f"{path}.cube"
+
+
+def _encode(values: pd.Series, dictionary: list):
+    values = values.astype(object).fillna(UNKNOWN).astype(str)
+    index = pd.Index(dictionary)
+    new = pd.Index(values.unique()).difference(index)
+    dictionary.extend(sorted(new))
+    return pd.Index(dictionary).get_indexer(values).astype(np.int64)
+
+
+def parse_filters(args):
+    where = {}
+    if args.date_from or args.date_to:
+        where["day"] = (args.date_from, args.date_to)
+    for name, values in [("airline", args.airlines), ("dep", args.dep), ("arr", args.arr)]:
+        if values:
+            where[name] = values.split(",")
+    if args.holiday is not None:
+        where["holiday"] = args.holiday == "yes"
+    return where
+
+
+def main():
+    pd.set_option('display.max_rows', 100)
+    pd.set_option('display.width', None)
+    arg_parser = ArgumentParser(description="Builds or updates the delay cube of the flights and answers a query "
+                                            "from it")
+    arg_parser.add_argument("FLIGHTS_CSV", nargs="?", default=f"{config.data_dir}/history/flightsHistory.csv",
+                            help="CSV file (or Parquet directory) of the flights, with or without holiday columns")
+    arg_parser.add_argument("--cube", help="Directory of the cube (default: next to the flights, <name>.cube)")
+    arg_parser.add_argument("--rebuild", action="store_true", help="Build the cube from scratch")
+    arg_parser.add_argument("--by", nargs="*", default=["airline"], choices=DIMENSIONS + DERIVED_DIMENSIONS,
+                            help="Dimensions of the result")
+    arg_parser.add_argument("--date-from", help="Only flights departing at or after this date (yyyy-mm-dd)")
+    arg_parser.add_argument("--date-to", help="Only flights departing before this date (yyyy-mm-dd)")
+    arg_parser.add_argument("--airlines", help="Only these airlines (e.g. VN,VJ)")
+    arg_parser.add_argument("--dep", help="Only flights departing from these airports (e.g. HAN,SGN)")
+    arg_parser.add_argument("--arr", help="Only flights arriving at these airports")
+    arg_parser.add_argument("--holiday", choices=["yes", "no"], help="Only flights on or outside of holidays")
+    args = arg_parser.parse_args()
+
+    cube_dir = args.cube or default_cube_dir(args.FLIGHTS_CSV)
+    start = time.perf_counter()
+    if args.rebuild:
+        cube = DelayCube.build(args.FLIGHTS_CSV, cube_dir)
+    else:
+        cube = DelayCube.open(args.FLIGHTS_CSV, cube_dir)
+    print(f"Opened cube with {len(cube.cells['day'])} cells in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    result = cube.query(args.by, parse_filters(args))
+    seconds = time.perf_counter() - start
+    print(result)
+    print(f"Query took {seconds * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# the modules resolve their files relative to the data directory, the tests use temporary directories instead
+os.environ.setdefault("DATA_DIR", os.path.join(ROOT_DIR, "data"))
+for module_dir in ["extract", "add-holidays", "add-weather", "add-congestion", "rollup"]:
+    sys.path.append(os.path.join(ROOT_DIR, module_dir))
@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+AIRPORTS = [
+    {"name": "Noi Bai", "iata_code": "HAN", "icao_code": "VVNB", "lat": 21.2212, "lng": 105.807, "country_code": "VN"},
+    {"name": "Tan Son Nhat", "iata_code": "SGN", "icao_code": "VVTS", "lat": 10.8188, "lng": 106.652,
+     "country_code": "VN"},
+    {"name": "Da Nang", "iata_code": "DAD", "icao_code": "VVDN", "lat": 16.0439, "lng": 108.199, "country_code": "VN"},
+]
+# not a divisor of the number of flights, so that the last chunk is shorter
+CHUNK_SIZE = 7
+FILTERS = [[], ["--date-from", "2024-01-10", "--airports", "HAN,DAD"]]
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = tmp_path / "data"
+    (data_dir / "holidays").mkdir(parents=True)
+    with open(data_dir / "airports.json", "w") as f:
+        json.dump(AIRPORTS, f)
+    pd.DataFrame({"date": ["2024-01-15", "2024-02-10"], "name": ["Test Day", "Tet"]}).to_csv(
+        data_dir / "holidays" / "VN.csv", index=False)
+
+    rng = np.random.default_rng(0)
+    n = 60
+    dep_times = pd.Timestamp("2024-01-01") + pd.to_timedelta(np.sort(rng.integers(0, 45 * 24 * 60, n)), unit="min")
+    dep_iata = rng.choice(["HAN", "SGN", "DAD"], n)
+    flights = pd.DataFrame({
+        "flight_iata": [f"VN{i}" for i in range(n)],
+        "airline_iata": "VN",
+        "dep_time_utc": dep_times,
+        "dep_actual_utc": dep_times.where(rng.random(n) < 0.8),
+        "arr_time_utc": dep_times + pd.Timedelta(hours=2),
+        "arr_actual_utc": dep_times + pd.Timedelta(hours=2) + pd.to_timedelta(rng.integers(-10, 60, n), unit="min"),
+        "dep_iata": dep_iata,
+        "arr_iata": np.where(dep_iata == "HAN", "SGN", "HAN"),
+        "dep_country_code": "VN",
+        "arr_country_code": "VN",
+        "domestic": True,
+        "international": False,
+        "delayed": rng.integers(-10, 60, n),
+    })
+    storage.write_flights(flights, str(data_dir / "flights.csv"))
+
+    # hourly weather of HAN and SGN only, the flights from and to DAD get missing values
+    hours = pd.date_range("2024-01-01", "2024-02-20", freq="h")
+    weather = pd.concat([pd.DataFrame({"iata": iata, "date": hours.strftime("%Y-%m-%d %H:%M:%S.000000"),
+                                       "temperature_2m": rng.normal(25, 5, len(hours)).round(1),
+                                       "weather_code": rng.choice([0, 3, 61], len(hours))})
+                         for iata in ["HAN", "SGN"]])
+    weather.to_csv(data_dir / "weather.csv.gz", index=False)
+    return data_dir
+
+
+def run_script(data_dir, script: str, *args):
+    result = subprocess.run([sys.executable, os.path.join(ROOT_DIR, script), *map(str, args)],
+                            env={**os.environ, "DATA_DIR": str(data_dir)}, capture_output=True, text=True,
+                            timeout=120)
+    assert result.returncode == 0, result.stderr
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def chunked_and_in_memory(data_dir, run):
+    """
+    Runs a script in memory and chunked, `run` takes the output directory and the chunk arguments and returns
+    the output file
+    """
+    outputs = []
+    for name, chunk_args in [("memory", []), ("chunked", ["--chunk-size", CHUNK_SIZE])]:
+        output_dir = data_dir / name
+        output_dir.mkdir()
+        outputs.append(read_bytes(run(output_dir, chunk_args)))
+    return outputs
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_add_holidays_chunked_like_in_memory(data_dir, filters):
+    def run(output_dir, chunk_args):
+        # the result is written next to the flights
+        shutil.copy(data_dir / "flights.csv", output_dir / "flights.csv")
+        run_script(data_dir, "add-holidays/add_holidays.py", output_dir / "flights.csv", *filters, *chunk_args,
+                   "--metrics-dir", data_dir / "metrics")
+        return output_dir / "flights-holidays.csv"
+
+    in_memory, chunked = chunked_and_in_memory(data_dir, run)
+    assert b"dep_holiday_period" in in_memory
+    assert chunked == in_memory
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_add_weather_chunked_like_in_memory(data_dir, filters):
+    def run(output_dir, chunk_args):
+        run_script(data_dir, "add-weather/add-weather-from-existing.py", data_dir / "weather.csv.gz",
+                   data_dir / "flights.csv", output_dir / "flights-weather.csv", *filters, *chunk_args,
+                   "--metrics-dir", data_dir / "metrics")
+        return output_dir / "flights-weather.csv"
+
+    in_memory, chunked = chunked_and_in_memory(data_dir, run)
+    assert b"dep_temperature_2m" in in_memory
+    assert chunked == in_memory
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_get_affected_airports_chunked_like_in_memory(data_dir, filters):
+    def run(output_dir, chunk_args):
+        run_script(data_dir, "extract/get_affected_airports.py", data_dir / "flights.csv", *filters, *chunk_args)
+        # the airports are always written to the data directory
+        return shutil.move(data_dir / "affected-airports.csv", output_dir / "affected-airports.csv")
+
+    in_memory, chunked = chunked_and_in_memory(data_dir, run)
+    assert in_memory
+    assert chunked == in_memory
@@ -0,0 +1,69 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import add_congestion
+import add_inbound
+import storage
+
+AIRPORTS = ["HAN", "SGN", "DAD"]
+
+
+def make_flights(n: int, seed: int, first_departure: str):
+    rng = np.random.default_rng(seed)
+    dep_times = pd.Timestamp(first_departure) + pd.to_timedelta(np.sort(rng.integers(0, 4 * 24 * 60, n)), unit="min")
+    arr_times = dep_times + pd.to_timedelta(rng.integers(60, 180, n), unit="min")
+    delayed = rng.integers(-10, 90, n)
+    dep_iata = rng.choice(AIRPORTS, n)
+    return pd.DataFrame({
+        "flight_iata": [f"VN{seed}{i:03d}" for i in range(n)],
+        "airline_iata": rng.choice(["VN", "VJ"], n),
+        "dep_time_utc": dep_times,
+        "dep_actual_utc": dep_times + pd.to_timedelta(np.maximum(delayed, 0), unit="min"),
+        "arr_time_utc": arr_times,
+        "arr_actual_utc": arr_times + pd.to_timedelta(delayed, unit="min"),
+        "dep_iata": dep_iata,
+        "arr_iata": [AIRPORTS[(AIRPORTS.index(dep) + 1) % 3] for dep in dep_iata],
+        "dep_country_code": "VN",
+        "arr_country_code": "VN",
+        "domestic": True,
+        "international": False,
+        "delayed": delayed,
+    })
+
+
+def run_script(monkeypatch, script, flights_file: str, *args):
+    monkeypatch.setattr(sys, "argv", [script.__file__, flights_file, *args])
+    script.main()
+    suffix = "-congestion" if script is add_congestion else "-inbound"
+    return storage.read_flights(storage.with_suffix(flights_file, suffix))
+
+
+def by_key(flights: pd.DataFrame):
+    return flights.sort_values(["flight_iata", "dep_time_utc"], ignore_index=True)
+
+
+@pytest.mark.parametrize("script", [add_congestion, add_inbound])
+@pytest.mark.parametrize("file_name", ["flights.csv", "flights.parquet"])
+def test_incremental_equals_full_run(tmp_path, monkeypatch, script, file_name):
+    history = make_flights(200, seed=1, first_departure="2024-01-27")
+    flights_file = str(tmp_path / file_name)
+    storage.write_flights(history, flights_file)
+    run_script(monkeypatch, script, flights_file, "--incremental")
+
+    # an update adds flights departing before the previous latest departure and in the next month, and corrects
+    # a delay in place
+    added = make_flights(30, seed=2, first_departure="2024-01-29")
+    assert added["dep_time_utc"].min() < history["dep_time_utc"].max()
+    history.loc[150, ["arr_actual_utc", "delayed"]] = [history.loc[150, "arr_time_utc"] + pd.Timedelta(hours=5), 300]
+    storage.write_flights(pd.concat([history, added], ignore_index=True), flights_file)
+    incremental = run_script(monkeypatch, script, flights_file, "--incremental")
+
+    full_file = str(tmp_path / f"full-{file_name}")
+    storage.write_flights(storage.read_flights(flights_file), full_file)
+    full = run_script(monkeypatch, script, full_file)
+    assert len(incremental) == 230
+    assert set(added["flight_iata"]) <= set(incremental["flight_iata"])
+    pd.testing.assert_frame_equal(by_key(incremental), by_key(full))
@@ -0,0 +1,101 @@
+import argparse
+import json
+
+import pandas as pd
+import pytest
+
+import shards
+import storage
+from delay_history import DelayHistoryProcessor, run
+from shards import Shard
+
+
+def api_time(time: pd.Timestamp):
+    # like the times of Aviation Edge, e.g. 2023-10-05t06:00:00.000
+    return time.strftime("%Y-%m-%dt%H:%M:%S.000")
+
+
+def record(number: int, day: int, delay=None, actual_minutes: int = None):
+    """
+    A raw arrival record of a flight from HAN to SGN, its delay given by the API or by its actual arrival time
+    """
+    scheduled = pd.Timestamp(2024, 1, day, 6) + pd.Timedelta(hours=number % 12)
+    arrival = {"iataCode": "sgn", "scheduledTime": api_time(scheduled + pd.Timedelta(hours=2))}
+    if actual_minutes is not None:
+        arrival["actualTime"] = api_time(scheduled + pd.Timedelta(hours=2, minutes=actual_minutes))
+    if delay is not None:
+        arrival["delay"] = delay
+    return {"flight": {"iataNumber": f"VN{number}"}, "airline": {"iataCode": "VN"},
+            "departure": {"iataCode": "han", "scheduledTime": api_time(scheduled)}, "arrival": arrival}
+
+
+@pytest.fixture
+def processor(tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, "SHARDS_DIR", str(tmp_path))
+    return DelayHistoryProcessor(shard=Shard(name="test", airports=["HAN"]))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_invalid_delays_do_not_stop_the_etl(processor, workers):
+    processor.workers = workers
+    records = [record(1, 1, delay="15"), record(2, 1, delay="abc"), record(3, 1, delay="1.5"),
+               record(4, 1, delay="99999"), record(5, 1, actual_minutes=-5), record(6, 1),
+               # a wrong actual time gives a delay out of range
+               record(7, 1, actual_minutes=60 * 24 * 30)]
+    processor.archive.put("HAN", "arrival", "2024-01-01", "2024-01-10", data=records)
+    flights = processor.etl_flights()
+
+    assert flights["flight_iata"].tolist() == ["VN1", "VN5"]
+    assert flights["delayed"].tolist() == [15, -5]
+    invalid = pd.read_csv(processor.INVALID_CSV)
+    assert sorted(invalid["flight_iata"]) == ["VN2", "VN3", "VN4", "VN6", "VN7"]
+    with open(processor.ETL_STATS_JSON) as f:
+        stats = json.load(f)
+    assert stats["invalid_delay"] == 4
+    assert storage.read_flights(processor.result_path)["flight_iata"].tolist() == ["VN1", "VN5"]
+
+
+def etl_stats(processor: DelayHistoryProcessor):
+    with open(processor.ETL_STATS_JSON) as f:
+        return json.load(f)
+
+
+def test_incremental_etl_stats_count_the_flights_of_each_run(processor):
+    # a flight with unknown delay, and one flight twice
+    records = [record(1, 1, delay="5"), record(2, 1), record(3, 1, delay="7"), record(3, 1, delay="8")]
+    processor.archive.put("HAN", "arrival", "2024-01-01", "2024-01-10", data=records)
+    processor.etl_flights()
+    first = etl_stats(processor)
+    assert (first["raw"], first["missing_information"], first["duplicate_iata_dep_time"]) == (4, 1, 1)
+
+    processor.archive.put("HAN", "arrival", "2024-01-11", "2024-01-20",
+                          data=[record(4, 11, delay="1"), record(5, 11), record(6, 11), record(4, 11, delay="2")])
+    processor.etl_flights(incremental=True)
+    second = etl_stats(processor)
+    assert (second["raw"], second["missing_information"], second["duplicate_iata_dep_time"]) == (4, 2, 1)
+
+    # a changed response is read again, its flights are counted once more as flights of this run
+    processor.archive.put("HAN", "arrival", "2024-01-11", "2024-01-20",
+                          data=[record(4, 11, delay="2"), record(5, 11, delay="3"), record(6, 11)])
+    flights = processor.etl_flights(incremental=True)
+    third = etl_stats(processor)
+    assert (third["raw"], third["missing_information"], third["duplicate_iata_dep_time"]) == (3, 1, 0)
+    assert third["upsert_inserted"] == 1 and third["upsert_updated"] == 1
+
+    assert flights["flight_iata"].tolist() == ["VN1", "VN3", "VN4", "VN5"]
+    # the invalid flights of all runs are kept, unless they are valid now
+    assert sorted(pd.read_csv(processor.INVALID_CSV)["flight_iata"]) == ["VN2", "VN6"]
+
+
+def test_update_processes_collected_responses_without_new_requests(processor, monkeypatch):
+    # the responses were collected by an earlier update whose ETL didn't run
+    processor.archive.put("HAN", "arrival", "2024-01-01", "2024-01-10", data=[record(1, 1, delay="5")])
+    monkeypatch.setattr(processor, "collect_flights", lambda date_from: 0)
+    args = argparse.Namespace(mode="update", incremental=True)
+    run(processor, args)
+    assert storage.read_flights(processor.result_path)["flight_iata"].tolist() == ["VN1"]
+    assert processor.unprocessed_entries() == []
+
+    processor.archive.put("HAN", "arrival", "2024-01-11", "2024-01-20", data=[record(2, 11, delay="3")])
+    run(processor, args)
+    assert storage.read_flights(processor.result_path)["flight_iata"].tolist() == ["VN1", "VN2"]
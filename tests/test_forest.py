@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from predict.features import available_columns, feature_frame, make_pipeline
+from predict.forest import CompiledForest
+from predict.model import ModelArtifact
+
+
+def make_flights(n: int, seed: int, airlines: list, airports: list):
+    rng = np.random.default_rng(seed)
+    dep_times = pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 90 * 24 * 60, n), unit="min")
+    temperature = rng.normal(25, 5, n)
+    temperature[rng.random(n) < 0.2] = np.nan
+    weather_codes = rng.choice(np.array([0, 3, 61, None], dtype=object), n)
+    return pd.DataFrame({
+        "airline_iata": rng.choice(airlines, n),
+        "dep_iata": rng.choice(airports, n),
+        "arr_iata": rng.choice(airports, n),
+        "dep_time_utc": dep_times,
+        "arr_time_utc": dep_times + pd.to_timedelta(rng.integers(60, 180, n), unit="min"),
+        "dep_temperature_2m": temperature,
+        "dep_weather_code": weather_codes,
+        "dep_holiday_period": rng.random(n) < 0.1,
+    })
+
+
+def test_compiled_forest_predicts_like_the_pipeline(tmp_path):
+    flights = make_flights(400, seed=1, airlines=["VN", "VJ", "QH"], airports=["HAN", "SGN", "DAD"])
+    features = feature_frame(flights)
+    pipeline = make_pipeline(available_columns(features), n_estimators=5, max_depth=6, random_state=0)
+    pipeline.fit(features, features["duration_min"] / 10 + np.nan_to_num(flights["dep_temperature_2m"].to_numpy()))
+    artifact = ModelArtifact(pipeline, {})
+    model_dir = artifact.save(models_dir=str(tmp_path))
+    CompiledForest.export(pipeline, model_dir, artifact.meta)
+    forest = CompiledForest.load("latest", models_dir=str(tmp_path))
+
+    # unseen airlines and airports, and missing values of all columns
+    test_flights = make_flights(300, seed=2, airlines=["VN", "BL", None], airports=["HAN", "SGN", "PQC"])
+    test_flights.loc[:20, ["dep_temperature_2m", "dep_weather_code"]] = np.nan
+    # batches smaller than the flights
+    predictions = forest.predict(test_flights, batch_size=64)
+    np.testing.assert_allclose(predictions, pipeline.predict(feature_frame(test_flights)))
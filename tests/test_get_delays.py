@@ -0,0 +1,110 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+import storage
+from config import config
+from get_delays import DelayPoller, transform_records
+
+
+# recent flights, older ones are pruned from the index of the poller
+TODAY = pd.Timestamp.now(tz="UTC").tz_localize(None).floor("D")
+
+
+def flight(number: int, delay: int = 20):
+    dep_time = TODAY + pd.Timedelta(hours=number)
+    arr_time = dep_time + pd.Timedelta(hours=2)
+    return {"flight_iata": f"VN{number}", "airline_iata": "VN", "dep_iata": "HAN", "arr_iata": "SGN",
+            "dep_time_utc": f"{dep_time:%Y-%m-%d %H:%M}", "arr_time_utc": f"{arr_time:%Y-%m-%d %H:%M}",
+            "delayed": delay}
+
+
+class MockAirlabs(BaseHTTPRequestHandler):
+    """
+    The departures of HAN are paged and fail twice before they are returned, the delayed arrivals are not found
+    """
+    departures = []
+    # status codes of the next departure requests
+    failures = []
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.requests.append((url.path, query))
+        if url.path.endswith("/delays") and query.get("type") == "arrivals":
+            self.respond(404, {"error": {"message": "Not found"}})
+        elif url.path.endswith("/schedules") and "dep_iata" in query:
+            if self.failures:
+                self.respond(self.failures.pop(0), {})
+                return
+            offset, limit = int(query["offset"]), int(query["limit"])
+            self.respond(200, {"response": self.departures[offset:offset + limit]})
+        elif url.path.endswith("/schedules"):
+            # a flight is returned again for its arrival airport
+            self.respond(200, {"response": self.departures[1:2]})
+        else:
+            self.respond(200, {"response": []})
+
+    def respond(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def airlabs(monkeypatch):
+    monkeypatch.setattr(MockAirlabs, "departures", [flight(1), flight(2), flight(3)])
+    monkeypatch.setattr(MockAirlabs, "failures", [503, 429])
+    monkeypatch.setattr(MockAirlabs, "requests", [])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockAirlabs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(config, "airlabs_url", f"http://127.0.0.1:{server.server_port}/api/v9")
+    # the waits of the backoff are recorded instead of slept
+    sleeps = []
+    monkeypatch.setattr(DelayPoller.do_request.retry, "sleep", sleeps.append)
+    yield sleeps
+    server.shutdown()
+
+
+def test_poller_retries_pages_and_deduplicates(airlabs, tmp_path):
+    output = str(tmp_path / "flightsCurrent.csv")
+    poller = DelayPoller(["HAN"], output, requests_per_second=0, page_size=2)
+
+    assert poller.poll() == (4, 3)
+    # 503 and 429 are retried with exponential backoff, the 404 is not
+    assert airlabs == [1, 2]
+    assert poller.http.retries == 2
+    departures = [query for path, query in MockAirlabs.requests
+                  if path.endswith("/schedules") and "dep_iata" in query]
+    assert [query["offset"] for query in departures] == ["0", "0", "0", "2"]
+    assert sum(path.endswith("/delays") and query["type"] == "arrivals" for path, query in MockAirlabs.requests) == 1
+
+    # only new or changed flights are appended
+    MockAirlabs.departures = [flight(1), flight(2, delay=45), flight(3)]
+    assert poller.poll() == (4, 1)
+    flights = storage.read_flights(output)
+    assert flights["flight_iata"].tolist() == ["VN1", "VN2", "VN3", "VN2"]
+    assert flights["delayed"].tolist() == [20, 20, 20, 45]
+
+
+def test_transform_records_without_flights():
+    assert transform_records([]).empty
+    # a field which no record has, and a record without a delay
+    records = [flight(1), flight(2)]
+    for record in records:
+        del record["airline_iata"]
+    del records[1]["delayed"]
+    flights = transform_records(records)
+    assert flights["flight_iata"].tolist() == ["VN1"]
+    assert flights["airline_iata"].isna().all()
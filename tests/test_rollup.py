@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+from delay_cube import DelayCube
+
+
+def make_flights():
+    dep_times = pd.to_datetime(["2024-03-01 08:00", "2024-03-01 09:30", "2024-03-02 08:00", "2024-03-03 10:00"])
+    return pd.DataFrame({
+        "flight_iata": ["VN1", "VN2", "VN3", "VN4"],
+        "airline_iata": "VN",
+        "dep_time_utc": dep_times,
+        "arr_time_utc": dep_times + pd.Timedelta(hours=2),
+        "dep_iata": "HAN",
+        "arr_iata": "SGN",
+        "delayed": [10, 10, 20, 30],
+        # holiday columns like add_holidays.py adds them, so that the cube needs no airport index
+        "dep_holiday": np.nan,
+        "dep_holiday_period": False,
+    })
+
+
+def day_means(cube: DelayCube):
+    return cube.query(["day"], quantiles=[])["mean"].to_dict()
+
+
+@pytest.mark.parametrize("file_name", ["flights.csv", "flights.parquet"])
+def test_refresh_aggregates_updated_delays(tmp_path, file_name):
+    flights_file = str(tmp_path / file_name)
+    flights = make_flights()
+    storage.write_flights(flights, flights_file)
+    cube = DelayCube.open(flights_file)
+    assert day_means(cube)[np.datetime64("2024-03-01")] == 10.0
+
+    # delay_history.py -m update corrects delays of earlier days in place, the number of flights stays the same
+    flights.loc[1, "delayed"] = 70
+    storage.write_flights(flights, flights_file)
+    means = day_means(DelayCube.open(flights_file))
+    assert means[np.datetime64("2024-03-01")] == 40.0
+    assert means[np.datetime64("2024-03-03")] == 30.0
+
+    # removed flights are removed from their days
+    storage.write_flights(flights.drop(index=[2]), flights_file)
+    cube = DelayCube.open(flights_file)
+    assert np.datetime64("2024-03-02") not in day_means(cube)
+    assert cube.query(quantiles=[])["flights"].item() == 3
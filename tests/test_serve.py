@@ -0,0 +1,75 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from airport_index import AirportIndex
+from predict.features import available_columns, feature_frame, make_pipeline
+from predict.model import ModelArtifact
+from predict.serve import DelayServer, DelayService, FeatureEnricher, handler_class
+
+AIRPORTS = [
+    {"name": "Noi Bai", "iata_code": "HAN", "icao_code": "VVNB", "lat": 21.2212, "lng": 105.807, "country_code": "VN"},
+    {"name": "Tan Son Nhat", "iata_code": "SGN", "icao_code": "VVTS", "lat": 10.8188, "lng": 106.652,
+     "country_code": "VN"},
+]
+FLIGHT = {"airline_iata": "VN", "dep_iata": "HAN", "arr_iata": "SGN", "dep_time_utc": "2023-05-01T10:00",
+          "arr_time_utc": "2023-05-01T12:00"}
+
+
+@pytest.fixture
+def server(tmp_path):
+    with open(tmp_path / "airports.json", "w") as f:
+        json.dump(AIRPORTS, f)
+    enricher = FeatureEnricher(AirportIndex.load(str(tmp_path / "airports.json")))
+    dep_times = pd.date_range("2023-01-01", periods=40, freq="37h")
+    flights = pd.DataFrame({"airline_iata": "VN", "dep_iata": ["HAN", "SGN"] * 20, "arr_iata": ["SGN", "HAN"] * 20,
+                            "dep_time_utc": dep_times, "arr_time_utc": dep_times + pd.Timedelta(hours=2)})
+    features = feature_frame(enricher.enrich(flights))
+    pipeline = make_pipeline(available_columns(features), n_estimators=3)
+    pipeline.fit(features, np.arange(len(features)) % 30)
+    # a long wait, so that concurrent requests are scored in one batch
+    service = DelayService(ModelArtifact(pipeline, {"version": "v1"}), enricher, max_batch=64, max_wait_ms=300)
+    server = DelayServer(("127.0.0.1", 0), handler_class(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield service, f"http://127.0.0.1:{server.server_port}/predict"
+    server.shutdown()
+
+
+def post(url: str, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_invalid_request_does_not_fail_its_batch(server):
+    service, url = server
+    bodies = [FLIGHT, {**FLIGHT, "dep_time_utc": "not a time"}, [FLIGHT, FLIGHT], [], {**FLIGHT, "dep_iata": 1}]
+    with ThreadPoolExecutor(len(bodies)) as executor:
+        responses = list(executor.map(lambda body: post(url, body), bodies))
+
+    assert [status for status, _ in responses] == [200, 400, 200, 400, 400]
+    assert len(responses[0][1]["predictions"]) == 1
+    assert len(responses[2][1]["predictions"]) == 2
+    assert responses[1][1]["error"].startswith("Invalid dep_time_utc")
+    assert responses[3][1]["error"] == "No flights in the request"
+
+
+def test_unexpected_error_is_a_server_error(server, monkeypatch):
+    service, url = server
+
+    def enrich(flights):
+        raise KeyError("dep_country_code")
+
+    monkeypatch.setattr(service.enricher, "enrich", enrich)
+    status, body = post(url, FLIGHT)
+    assert status == 500
+    assert "KeyError" in body["error"]
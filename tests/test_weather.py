@@ -0,0 +1,195 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from weather_planner import QuotaLedger, existing_days, missing_ranges, plan_chunks, request_weight
+
+GET_WEATHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "add-weather", "get-weather.py")
+AIRPORTS = [
+    {"name": "Noi Bai", "iata_code": "HAN", "icao_code": "VVNB", "lat": 21.2212, "lng": 105.807, "country_code": "VN"},
+    {"name": "Tan Son Nhat", "iata_code": "SGN", "icao_code": "VVTS", "lat": 10.8188, "lng": 106.652,
+     "country_code": "VN"},
+    {"name": "Da Nang", "iata_code": "DAD", "icao_code": "VVDN", "lat": 16.0439, "lng": 108.199, "country_code": "VN"},
+]
+N_VARIABLES = 13
+
+
+def days(*values):
+    return np.array(values, dtype="datetime64[D]")
+
+
+def test_missing_ranges():
+    existing = {"HAN": days("2024-01-03", "2024-01-04", "2024-01-05"), "DAD": days(*[f"2024-01-{d:02d}"
+                                                                                     for d in range(1, 11)])}
+    ranges = missing_ranges(["HAN", "SGN", "DAD"], date(2024, 1, 1), date(2024, 1, 10), existing)
+    assert ranges == [("HAN", date(2024, 1, 1), date(2024, 1, 2)), ("HAN", date(2024, 1, 6), date(2024, 1, 10)),
+                      ("SGN", date(2024, 1, 1), date(2024, 1, 10))]
+
+
+def test_plan_chunks_cover_ranges_within_max_weight():
+    ranges = [("HAN", date(2024, 1, 1), date(2024, 3, 31)), ("SGN", date(2024, 1, 1), date(2024, 3, 31)),
+              ("DAD", date(2024, 2, 1), date(2024, 2, 3))]
+    chunks = plan_chunks(ranges, N_VARIABLES, max_weight=20)
+
+    for chunk in chunks:
+        assert request_weight(len(chunk.iatas), chunk.n_days, N_VARIABLES) <= 20
+    planned = sorted((iata, chunk.start + timedelta(days=d)) for chunk in chunks for iata in chunk.iatas
+                     for d in range(chunk.n_days))
+    expected = sorted((iata, start + timedelta(days=d)) for iata, start, end in ranges
+                      for d in range((end - start).days + 1))
+    assert planned == expected
+    # airports with the same missing range share requests
+    assert any(chunk.iatas == ["HAN", "SGN"] for chunk in chunks)
+
+
+def test_quota_ledger_is_checkpointed(tmp_path):
+    quota_file = str(tmp_path / "quota.json")
+    ledger = QuotaLedger(quota_file, daily_limit=10)
+    assert ledger.reserve(6)
+    assert not ledger.reserve(5)
+    ledger.release(2)
+    assert ledger.reserve(5)
+
+    # a repeated run on the same day continues with the remaining quota
+    assert QuotaLedger(quota_file, daily_limit=10).used == 9
+    with open(quota_file, "w") as f:
+        json.dump({"day": "2000-01-01", "weight": 9}, f)
+    assert QuotaLedger(quota_file, daily_limit=10).used == 0
+
+
+def test_existing_days_of_appended_gzip_members(tmp_path):
+    weather_csv = str(tmp_path / "weather.csv.gz")
+    for i, (iata, day) in enumerate([("HAN", "2024-01-01"), ("HAN", "2024-01-02"), ("SGN", "2024-01-02")]):
+        frame = pd.DataFrame({"iata": [iata] * 24, "date": pd.date_range(day, periods=24, freq="h")})
+        frame.to_csv(weather_csv, mode="a", header=i == 0, index=False, compression="gzip")
+
+    existing = existing_days(weather_csv)
+    assert existing.keys() == {"HAN", "SGN"}
+    np.testing.assert_array_equal(existing["HAN"], days("2024-01-01", "2024-01-02"))
+    np.testing.assert_array_equal(existing["SGN"], days("2024-01-02"))
+
+
+class StandInArchive:
+    """
+    Local stand-in of the Open-Meteo archive API: answers every location with hourly values in the flatbuffers
+    format of openmeteo_requests, or with an error for the latitudes in `failing`
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.failing = set()
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                latitudes = [float(v) for v in query["latitude"]]
+                archive.requests.append((latitudes, query["start_date"][0], query["end_date"][0]))
+                if any(abs(lat - failing) < 1e-3 for lat in latitudes for failing in archive.failing):
+                    body, status = json.dumps({"error": True, "reason": "stand-in failure"}).encode(), 400
+                else:
+                    start, end = (date.fromisoformat(query[k][0]) for k in ["start_date", "end_date"])
+                    body, status = b"".join(weather_message(lat, lon, start, end, len(query["hourly"]))
+                                            for lat, lon in zip(latitudes, map(float, query["longitude"]))), 200
+                self.send_response(status)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1/archive"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def weather_message(latitude: float, longitude: float, start: date, end: date, n_variables: int):
+    """
+    A size-prefixed WeatherApiResponse with the hourly values hour + variable index
+    """
+    import flatbuffers
+    builder = flatbuffers.Builder(1024)
+    start_time = int(pd.Timestamp(start).timestamp())
+    n_hours = ((end - start).days + 1) * 24
+    variables = []
+    for i in range(n_variables):
+        values = builder.CreateNumpyVector(np.arange(n_hours, dtype=np.float32) + i)
+        builder.StartObject(4)
+        builder.PrependUOffsetTRelativeSlot(3, values, 0)
+        variables.append(builder.EndObject())
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    variables_vector = builder.EndVector()
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start_time, 0)
+    builder.PrependInt64Slot(1, start_time + n_hours * 3600, 0)
+    builder.PrependInt32Slot(2, 3600, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    hourly = builder.EndObject()
+    builder.StartObject(12)
+    builder.PrependFloat32Slot(0, latitude, 0)
+    builder.PrependFloat32Slot(1, longitude, 0)
+    builder.PrependUOffsetTRelativeSlot(11, hourly, 0)
+    builder.Finish(builder.EndObject())
+    message = builder.Output()
+    return len(message).to_bytes(4, "little") + bytes(message)
+
+
+def run_get_weather(work_dir, url: str):
+    # get-weather.py resolves its files relative to ../data from its working directory
+    return subprocess.run([sys.executable, GET_WEATHER, "--url", url, "--max-weight", "2.6", "--workers", "2",
+                           "--airports", str(work_dir / ".." / "data" / "airports.json"), "2024-01-01", "2024-01-10"],
+                          cwd=work_dir, env={**os.environ, "DATA_DIR": str(work_dir / ".." / "data")},
+                          capture_output=True, text=True, timeout=120)
+
+
+def test_get_weather_continues_after_a_failed_chunk(tmp_path):
+    pytest.importorskip("openmeteo_requests")
+    pytest.importorskip("requests_cache")
+    pytest.importorskip("retry_requests")
+    data_dir, work_dir = tmp_path / "data", tmp_path / "work"
+    data_dir.mkdir()
+    work_dir.mkdir()
+    with open(data_dir / "airports.json", "w") as f:
+        json.dump(AIRPORTS, f)
+    pd.DataFrame({"iata": ["HAN", "SGN", "DAD"]}).to_csv(data_dir / "affected-airports.csv", index=False)
+    archive = StandInArchive()
+    # 10 days of 13 variables weigh 1.3 per airport, so HAN and SGN share a request and DAD gets its own
+    archive.failing = {16.0439}
+    try:
+        result = run_get_weather(work_dir, archive.url)
+        assert result.returncode == 0, result.stderr
+        assert "[ERROR] Request of 2024-01-01 to 2024-01-10 for DAD failed" in result.stdout
+        weather = pd.read_csv(data_dir / "weather.csv.gz")
+        assert weather.groupby("iata").size().to_dict() == {"HAN": 240, "SGN": 240}
+        # the failed request is given back to the quota
+        with open(data_dir / "weather-quota.json") as f:
+            assert json.load(f)["weight"] == pytest.approx(2.6)
+
+        archive.failing = set()
+        archive.requests.clear()
+        result = run_get_weather(work_dir, archive.url)
+        assert result.returncode == 0, result.stderr
+        assert [(np.round(lat, 3).tolist(), start, end) for lat, start, end in archive.requests] == [
+            ([16.044], "2024-01-01", "2024-01-10")]
+    finally:
+        archive.server.shutdown()
+
+    # the second run is appended as a new gzip member without a second header
+    weather = pd.read_csv(data_dir / "weather.csv.gz")
+    assert weather.groupby("iata").size().to_dict() == {"DAD": 240, "HAN": 240, "SGN": 240}
+    dad = weather[weather["iata"] == "DAD"]
+    assert dad["date"].iloc[0] == "2024-01-01 00:00:00.000000"
+    np.testing.assert_array_equal(dad["temperature_2m"], np.arange(240))
+    with open(data_dir / "weather-quota.json") as f:
+        assert json.load(f)["weight"] == pytest.approx(3.9)